@@ -11,14 +11,30 @@ import time
 import tty
 
 import numpy
-import pykms
+try:
+    import pykms
+except ImportError:
+    # only the tests that use the display need it
+    pykms = None
 from PIL import Image as PIL_Image
 from PIL import ImageDraw as PIL_ImageDraw
-from PIL import ImageFont as PIL_ImageFont
+from gud.fonts import fit_font
+from gud.convert import *
+from gud.patterns import pattern_cache
 
 
+# The display is opened on first use so the tests that don't need it (test_direct.py with
+# GUD_REPLAY and the offline tests) run without a gud DRM device
 def pytest_sessionstart(session):
-    pytest.gud = Display(xrgb8888_format=session.config.getoption('--xrgb8888'))
+    pytest.gud = None
+    pytest.gud_xrgb8888 = session.config.getoption('--xrgb8888')
+    pytest.open_display = open_display
+
+
+def open_display():
+    if not pytest.gud:
+        pytest.gud = Display(xrgb8888_format=pytest.gud_xrgb8888)
+    return pytest.gud
 
 
 def pytest_addoption(parser):
@@ -56,9 +72,7 @@ def test_delay(pytestconfig):
 
 @pytest.fixture(scope='module')
 def display(pytestconfig):
-    if not pytest.gud:
-        pytest.gud = Display(xrgb8888_format=pytestconfig.getoption('--xrgb8888'))
-    return pytest.gud
+    return open_display()
 
 
 # Release DRM device so others can become master
@@ -143,7 +157,7 @@ class Display:
                 tmodes[size] = mode
         return tmodes.values()
 
-    def image(self, mode, fmt=pykms.PixelFormat.XRGB8888):
+    def image(self, mode, fmt=None):
         return Image(self, mode, fmt)
 
     # keep=True: Prevent gc when test variable goes out of scope which will disable the pipeline
@@ -198,8 +212,18 @@ class State:
         self._commit(req)
 
 
+KMS_TO_GUD_FORMAT = {
+    pykms.PixelFormat.XRGB8888: GUD_PIXEL_FORMAT_XRGB8888,
+    pykms.PixelFormat.RGB888: GUD_PIXEL_FORMAT_RGB888,
+    pykms.PixelFormat.RGB565: GUD_PIXEL_FORMAT_RGB565,
+    pykms.PixelFormat.RGB332: GUD_PIXEL_FORMAT_RGB332,
+} if pykms else {}
+
+
 class Image:
-    def __init__(self, display, mode, fmt=pykms.PixelFormat.XRGB8888):
+    def __init__(self, display, mode, fmt=None):
+        if fmt is None:
+            fmt = pykms.PixelFormat.XRGB8888
         if fmt == pykms.PixelFormat.XRGB8888:
             imgmode = 'RGBX'
         elif fmt in (pykms.PixelFormat.RGB888, pykms.PixelFormat.RGB565, pykms.PixelFormat.RGB332):
@@ -230,18 +254,7 @@ class Image:
     def text(self, text, x=None, y=None, color=None, fraction=None):
         font = None
         if fraction:
-            size = 16
-            step = 16
-            while step > 1:
-                font = PIL_ImageFont.truetype("FreeMono", size)
-                w, h = font.getsize(text)
-                #print('step, w, h:', step, w, h)
-                if w < fraction * self.width:
-                    size += step
-                else:
-                    size -= step // 2
-                    step //= 4
-            #print('size', size)
+            font, w, h = fit_font(text, fraction, self.width)
         else:
             w, h = self.draw.textsize(text)
         if x is None:
@@ -250,6 +263,11 @@ class Image:
             y = (self.height - h) / 2
         self.draw.text((x, y), text, font=font, fill=color)
 
+    # Draw one of the gud.patterns, the RGB888 frame is loaded from the pattern cache
+    def pattern(self, name):
+        frame = pattern_cache.load(name, self.width, self.height)
+        self.image.paste(PIL_Image.fromarray(frame))
+
     def test(self):
         if self.display.xrgb8888_format in ('R1',):
             monochrome_image(self)
@@ -259,31 +277,8 @@ class Image:
             smpte_image(self)
 
     def write(self):
-        if self.format == pykms.PixelFormat.XRGB8888:
-            buf = self.image.tobytes('raw', 'BGRX')
-        elif self.format == pykms.PixelFormat.RGB888:
-            buf = self.image.tobytes('raw', 'BGR')
-        elif self.format == pykms.PixelFormat.RGB565:
-            # https://helperbyte.com/questions/180384/than-to-convert-a-picture-in-format-bmp565-in-python
-            rgb888 = numpy.asarray(self.image)
-            assert rgb888.shape[-1] == 3 and rgb888.dtype == numpy.uint8
-
-            # If partial writes are needed:
-            # rgb888 = rgb888[y1 : y1 + height, x1 : x1 + width]
-
-            r5 = (rgb888[..., 0] >> 3 & 0x1f).astype(numpy.uint16)
-            g6 = (rgb888[..., 1] >> 2 & 0x3f).astype(numpy.uint16)
-            b5 = (rgb888[..., 2] >> 3 & 0x1f).astype(numpy.uint16)
-            rgb565 = r5 << 11 | g6 << 5 | b5
-            buf = bytes(rgb565)
-        elif self.format == pykms.PixelFormat.RGB332:
-            rgb888 = numpy.asarray(self.image)
-            assert rgb888.shape[-1] == 3 and rgb888.dtype == numpy.uint8
-            r3 = (rgb888[..., 0] >> 5).astype(numpy.uint8)
-            g3 = (rgb888[..., 1] >> 5).astype(numpy.uint8)
-            b2 = (rgb888[..., 2] >> 6).astype(numpy.uint8)
-            rgb332 = r3 << 5 | g3 << 2 | b2
-            buf = bytes(rgb332)
+        rgb888 = numpy.asarray(self.image)
+        buf = rgb888_to_format(KMS_TO_GUD_FORMAT[self.format], rgb888)
 
         self.map.seek(0)
         self.map.write(buf)
@@ -293,64 +288,13 @@ class Image:
         self.fb.flush(*args)
 
 
-def draw_smpte_rects(img, x, y, width, height, colors):
-    for i in range(len(colors)):
-        img.rect(x + (width * i), y, x + (width * (i + 1)), y + height, fill=colors[i], outline=colors[i])
-
-
 def smpte_image(img):
-    # top colors: grey/silver, yellow, cyan, green, magenta, red, blue
-    y = 0
-    width = img.width // 7
-    height = img.height * 6 // 9
-    draw_smpte_rects(img, 0, 0, width, height, ['#c0c0c0', '#c0c000', '#00c0c0', '#00c000', '#c000c0', '#c00000', '#0000c0'])
-
-    # middle colors: blue, black magenta, black, cyan, black, grey
-    y = height
-    width = img.width / 7
-    height = img.height * 1 / 9
-    draw_smpte_rects(img, 0, y, width, height, ['#0000c0', '#131313', '#c000c0', '#131313', '#00c0c0', '#131313', '#c0c0c0'])
-
-    # bottom colors: in-phase, super white, quadrature, black, 3.5%, 7.5%, 11.5%, black
-    y += height
-    width = img.width / 6
-    height = img.height * 2 / 9
-    draw_smpte_rects(img, 0, y, width, height, ['#00214c', '#ffffff', '#32006a', '#131313'])
-
-    x = width * 4
-    width = img.width / 6 / 3
-    draw_smpte_rects(img, x, y, width, height, ['#090909', '#131313', '#1d1d1d'])
-
-    x = img.width * 5 / 6
-    width = img.width / 6
-    draw_smpte_rects(img, x, y, width, height, ['#131313'])
-
-    # border to show framebuffer boundaries
-    img.rect(0, 0, img.width, img.height, outline='white')
+    img.pattern('smpte-border')
 
 
 def xrgb1111_image(img):
-    # top colors: white, yellow, cyan, green, magenta, red, blue
-    width = img.width // 7
-    height = img.height * 6 // 9
-    draw_smpte_rects(img, 0, 0, width, height, ['#ffffff', '#ffff00', '#00ffff', '#00ff00', '#ff00ff', '#ff0000', '#0000ff'])
-
-    # bottom colors: red, green, blue, black
-    y = height
-    width = img.width / 4
-    height = img.height * 3 / 9
-    draw_smpte_rects(img, 0, y, width, height, ['#ff0000', '#00ff00', '#0000ff', '#000000'])
-
-    # border to show framebuffer boundaries
-    img.rect(0, 0, img.width, img.height, outline='white')
+    img.pattern('xrgb1111')
 
 
 def monochrome_image(img):
-    colors = ('#FFFFFF', '#000000')
-    num_width = 8
-    w = img.width // num_width
-    num_height = img.height // w
-
-    for y in range(num_height):
-        for x in range(num_width):
-            img.rect(x * w, y * w, w, w, fill=colors[(x + y) % len(colors)])
+    img.pattern('checkerboard')
@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: CC0-1.0
+
+# A GUD device in memory for the tests that run without hardware.
+# It answers the enumeration requests, keeps the status of the last request like a device does
+# and decodes SET_BUFFER requests and their bulk data into a framebuffer.
+
+import array
+import collections
+import ctypes
+import errno
+import lz4.block
+import numpy
+import usb.core
+from gud import *
+
+
+class FakeTransport(Transport):
+    # stall: Stall failed requests, the default is to stall unless the device has STATUS_ON_SET
+    def __init__(self, width=64, height=32, formats=(GUD_PIXEL_FORMAT_XRGB8888,), flags=0,
+                 compression=GUD_COMPRESSION_LZ4, max_buffer_size=0, serial='0123', stall=None):
+        desc = gud_drm_usb_vendor_descriptor()
+        desc.magic = GUD_DISPLAY_MAGIC
+        desc.version = 1
+        desc.flags = flags
+        desc.compression = compression
+        desc.max_buffer_size = max_buffer_size
+        desc.min_width = desc.min_height = 1
+        desc.max_width = desc.max_height = 4096
+        self.descriptor = desc
+        self.formats = formats
+        self.mode = gud_drm_req_display_mode(clock=width * height * 60 // 1000, hdisplay=width, htotal=width,
+                                             vdisplay=height, vtotal=height, flags=GUD_DISPLAY_MODE_FLAG_PREFERRED)
+        self.serial = serial
+        self.stall = not flags & GUD_DISPLAY_FLAG_STATUS_ON_SET if stall is None else stall
+
+        self.requests = [] # (_in, request, value) for each control request, GET_STATUS included
+        self.bulk = [] # length of each bulk transfer
+        self.buffers = [] # (x, y, width, height) of each SET_BUFFER that got its bulk data
+        self.dropped = 0 # bulk transfers without an accepted SET_BUFFER
+        self.kept = None # set to a list to keep the buffers passed to bulk_write() alive
+        self.failures = collections.defaultdict(collections.deque)
+        self.status = GUD_STATUS_OK
+        self.enabled = {}
+        self.format = None
+        self.framebuffer = None
+        self._state = None
+        self._buffer = None
+
+    # The next count request requests get status instead of succeeding
+    def fail(self, request, status, count=1):
+        self.failures[request].extend([status] * count)
+
+    def count(self, request):
+        return len([r for r in self.requests if r[1] == request])
+
+    def control(self, _in, request, value, buf):
+        self.requests.append((_in, request, value))
+        if _in and request == GUD_REQ_GET_STATUS:
+            return array.array('B', [self.status])
+
+        failures = self.failures.get(request)
+        self.status = failures.popleft() if failures else GUD_STATUS_OK
+        if self.status == GUD_STATUS_OK:
+            if _in:
+                data = self._get(request, value)
+                length = buf if isinstance(buf, int) else len(buf)
+                return array.array('B', data[:length])
+            self._set(request, bytes(buf) if buf else b'')
+            return len(buf) if buf else 0
+
+        if request == GUD_REQ_SET_BUFFER:
+            self._buffer = None
+        if self.stall:
+            raise usb.core.USBError('Pipe error', errno=errno.EPIPE)
+        return array.array('B') if _in else (len(buf) if buf else 0)
+
+    def _get(self, request, value):
+        if request == GUD_REQ_GET_DESCRIPTOR:
+            return bytes(self.descriptor)
+        elif request == GUD_REQ_GET_FORMATS:
+            return bytes(self.formats)
+        elif request == GUD_REQ_GET_CONNECTORS:
+            return bytes(gud_drm_req_get_connector(connector_type=GUD_CONNECTOR_TYPE_PANEL))
+        elif request == GUD_REQ_GET_CONNECTOR_STATUS:
+            return bytes([GUD_CONNECTOR_STATUS_CONNECTED])
+        elif request == GUD_REQ_GET_CONNECTOR_MODES:
+            return bytes(self.mode)
+        return b''
+
+    def _set(self, request, data):
+        if request == GUD_REQ_SET_STATE_CHECK:
+            self._state = define_gud_drm_req_set_state(0).from_buffer_copy(data[:ctypes.sizeof(define_gud_drm_req_set_state(0))])
+        elif request == GUD_REQ_SET_STATE_COMMIT:
+            mode = self._state.mode
+            self.format = self._state.format
+            self.framebuffer = numpy.zeros((mode.vdisplay, self._line_length(mode.hdisplay)), dtype=numpy.uint8)
+        elif request == GUD_REQ_SET_BUFFER:
+            self._buffer = gud_drm_req_set_buffer.from_buffer_copy(data)
+        elif request in (GUD_REQ_SET_CONTROLLER_ENABLE, GUD_REQ_SET_DISPLAY_ENABLE):
+            self.enabled[request] = data[0]
+
+    def _line_length(self, width):
+        return (width * FORMAT_BPP[self.format] + 7) // 8
+
+    def bulk_write(self, buf, length):
+        self.bulk.append(length)
+        if self.kept is not None:
+            self.kept.append(buf)
+        req, self._buffer = self._buffer, None
+        if req is None and self.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE and self.framebuffer is not None:
+            # The whole framebuffer, uncompressed
+            height, line_length = self.framebuffer.shape
+            req = gud_drm_req_set_buffer(width=self._state.mode.hdisplay, height=height, length=height * line_length)
+        if req is None:
+            self.dropped += 1
+            return length
+
+        self.buffers.append((req.x, req.y, req.width, req.height))
+        data = numpy.frombuffer(buf, dtype=numpy.uint8)[:length].tobytes()
+        if req.compression:
+            assert len(data) == req.compressed_length
+            data = lz4.block.decompress(data, uncompressed_size=req.length)
+        assert len(data) == req.length
+        x = req.x * FORMAT_BPP[self.format] // 8
+        line_length = self._line_length(req.width)
+        lines = numpy.frombuffer(data, dtype=numpy.uint8).reshape(req.height, line_length)
+        self.framebuffer[req.y:req.y + req.height, x:x + line_length] = lines
+        return length
+
+    def ids(self):
+        return 0x1d50, 0x614d, 0x0100, self.serial
+
+    def __str__(self):
+        return 'FakeTransport'
+
+
+# A Device on a FakeTransport with the first mode committed in fmt
+def fake_setup(fmt=GUD_PIXEL_FORMAT_XRGB8888, **kwargs):
+    kwargs.setdefault('formats', (fmt,))
+    transport = FakeTransport(**kwargs)
+    dev = Device(transport)
+    for connector in dev.connectors:
+        connector.update()
+    state = State(dev, fmt=fmt)
+    dev.commit(state)
+    return dev, transport, state
+
+
+# What the device should show for an image: all of Image.data() as lines
+def image_lines(img):
+    return numpy.frombuffer(img.data(0, 0, img.width, img.height), dtype=numpy.uint8).reshape(img.height, -1)
@@ -1,27 +1,48 @@
 # SPDX-License-Identifier: CC0-1.0
 
 from .gud_h import *
+from .cachedir import *
 from .image import *
+from .transport import *
 
+import array
+import collections
+import contextlib
 import errno
+import json
+import os
+import threading
+import time
+
+from timeit import default_timer as timer
 
 import usb.core
-import usb.util
 
 class GUDBaseException(Exception):
+    # request: The request the status belongs to
     @classmethod
-    def from_status(cls, status):
+    def from_status(cls, status, request=None):
 #        if cls is GUDBaseException:
         if status == GUD_STATUS_OK:
             raise ValueError('status is OK')
         sub = GUDBaseException.subclasses.get(status, GUDError)
-        print('sub:', sub)
-        return sub(status)
+        return sub(status, request)
 #        else:
 #            return Exception()
 
-    def __init__(self, status):
+    def __init__(self, status, request=None):
         self.status = status
+        self.request = request
+        # A deferred status error: the request that wasn't sent because of it
+        self.not_sent = None
+
+    def __str__(self):
+        s = f'status={self.status}'
+        if self.request is not None:
+            s += f' request=0x{self.request:02x}'
+        if self.not_sent is not None:
+            s += f' not_sent=0x{self.not_sent:02x}'
+        return s
 
 class GUDBusyError(GUDBaseException):
     pass
@@ -47,6 +68,96 @@ GUDBaseException.subclasses = {
 }
 
 
+# Retries requests the device answers with GUD_STATUS_BUSY instead of losing the frame.
+# It's opt-in: set Device.busy_retry to use it.
+# The waits start at initial µs and grow by factor up to maximum µs, after attempts retries the
+# GUDBusyError is raised. Only requests the device checks synchronously can be retried: the status
+# policy has to be 'always' or the device has to stall on errors.
+#
+# With coalesce a flush sender sets newer on its own copy() to a function that says if a newer
+# frame is waiting, the retry is then given up so the frame can be merged into the newer one.
+#
+# The total busy wait per request is counted in a histogram with power of two µs buckets.
+class BusyRetry(object):
+    REQUESTS = (GUD_REQ_SET_BUFFER, GUD_REQ_SET_STATE_CHECK, GUD_REQ_SET_STATE_COMMIT)
+
+    def __init__(self, initial=50, maximum=5000, factor=2, attempts=10, coalesce=False, requests=REQUESTS):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = attempts
+        self.coalesce = coalesce
+        self.requests = requests
+        self.newer = None
+        self.reset()
+
+    # Same settings, own counters and no newer
+    def copy(self):
+        return BusyRetry(self.initial, self.maximum, self.factor, self.attempts, self.coalesce, self.requests)
+
+    def reset(self):
+        self.busy = 0 # requests that were busy at least once
+        self.retries = 0
+        self.recovered = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.wait_time = 0.0
+        self.histogram = collections.Counter()
+
+    # The waits in µs
+    def delays(self):
+        delay = self.initial
+        for _ in range(self.attempts):
+            yield delay
+            delay = min(delay * self.factor, self.maximum)
+
+    # send() does the request and raises GUDBusyError if the device was busy
+    def run(self, send):
+        delays = None
+        while True:
+            try:
+                ret = send()
+            except GUDBusyError:
+                if delays is None:
+                    self.busy += 1
+                    delays = self.delays()
+                    start = timer()
+                delay = next(delays, None)
+                if delay is None:
+                    self.failed += 1
+                    self._record(timer() - start)
+                    raise
+                if self.coalesce and self.newer and self.newer():
+                    self.coalesced += 1
+                    self._record(timer() - start)
+                    raise
+                self.retries += 1
+                time.sleep(delay / 1000000)
+                continue
+
+            if delays is not None:
+                self.recovered += 1
+                self._record(timer() - start)
+            return ret
+
+    def _record(self, elapsed):
+        self.wait_time += elapsed
+        us = int(elapsed * 1000000)
+        self.histogram[1 << us.bit_length()] += 1
+
+    def histogram_to_str(self):
+        return ' '.join([f'<{bucket}us:{count}' for bucket, count in sorted(self.histogram.items())])
+
+    def __str__(self):
+        s = f'BusyRetry(busy={self.busy}, retries={self.retries}, recovered={self.recovered}, failed={self.failed}'
+        if self.coalesce:
+            s += f', coalesced={self.coalesced}'
+        s += f', wait={(self.wait_time * 1000):.3f} ms'
+        if self.histogram:
+            s += f', [{self.histogram_to_str()}]'
+        return s + ')'
+
+
 class Property(object):
     def __init__(self, req):
         self.prop = req.prop
@@ -91,7 +202,7 @@ class Connector(object):
 
     @property
     def properties(self):
-        if self._properties:
+        if self._properties is not None:
             return self._properties
 
         reqs = self.dev.req_get_connector_properties(self)
@@ -190,56 +301,63 @@ class State(object):
     def __str__(self):
         return f'{self.mode.hdisplay}x{self.mode.vdisplay}-{self.vrefresh}@{format_to_name(self.format)}'
 
+# When to read the status after a SET request on a GUD_DISPLAY_FLAG_STATUS_ON_SET device.
+# A stall always reads the status.
+#
+# With 'deferred' the error of a SET request is raised by the next control request (or
+# check_status()). That request is then not sent: the exception has request set to the request
+# that failed and not_sent to the one that was dropped, the caller has to redo that one. A bulk
+# transfer that followed a failed SET_BUFFER has already gone out and was ignored by the device.
+STATUS_POLICY_ALWAYS = 'always'         # right after every SET request
+STATUS_POLICY_DEFERRED = 'deferred'     # before the next control request, a bulk transfer can go first
+STATUS_POLICY_SAMPLED = 'sampled'       # after every status_interval SET request, errors in the others are missed
+STATUS_POLICY_ERROR_ONLY = 'error-only' # only on stall
+
+STATUS_POLICIES = (STATUS_POLICY_ALWAYS, STATUS_POLICY_DEFERRED, STATUS_POLICY_SAMPLED, STATUS_POLICY_ERROR_ONLY)
+
 class Device(object):
+    # dev: A pyusb device or a Transport
     def __init__(self, dev):
-        self.dev = dev
+        self.transport = dev if isinstance(dev, Transport) else PyUSBTransport(dev)
+        # The pyusb device, None if there's no real device behind the transport
+        self.dev = getattr(self.transport, 'dev', None)
         self._descriptor = None
         self._formats = None
         self._properties = None
         self._connectors = None
-        self._interface = None
-        self.ep = None
         self.state = None
-
-    @property
-    def interface(self):
-        if self._interface is not None:
-            return self._interface
-
-        try:
-            self.dev.set_configuration()
-        except usb.core.USBError as e:
-            if e.errno != errno.EBUSY:
-                raise e from None
-        # Pick the first Vendor Class Interface
-        for itf in self.dev.get_active_configuration():
-            if itf.bInterfaceClass == 0xff:
-                self._interface = itf
-                break
-        assert self._interface is not None
-        self.ep = usb.util.find_descriptor(
-            self._interface,
-            # match the first OUT endpoint
-            custom_match = lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
-        assert self.ep is not None
-
-        return self._interface
+        # Reused for every SET_BUFFER request, see req_set_buffer()
+        self._set_buffer = array.array('B', bytes(ctypes.sizeof(gud_drm_req_set_buffer)))
+        self._set_buffer_req = gud_drm_req_set_buffer.from_buffer(self._set_buffer)
+        # Number of GUD control requests sent, GET_STATUS included
+        self.control_transfers = 0
+        self.status_policy = STATUS_POLICY_ALWAYS
+        self.status_interval = 8
+        self._status_pending = None # deferred: the SET request that hasn't been checked
+        self._status_sets = 0
+        # Status reads done because of the policy or a stall and the time they took
+        self.status_polls = 0
+        self.status_time = 0.0
+        # Set to a BusyRetry to retry requests the device is busy with, by default they raise GUDBusyError
+        self.busy_retry = None
+        self._local = threading.local()
+        self.bulk_writer = None
 
     def reset(self):
-        self.dev.reset()
+        self.transport.reset()
 
     def is_kernel_driver_active(self):
-        return self.dev.is_kernel_driver_active(self.interface.bInterfaceNumber)
+        return self.transport.is_kernel_driver_active()
 
     def detach_kernel_driver(self):
-        self.dev.detach_kernel_driver(self.interface.bInterfaceNumber)
+        self.transport.detach_kernel_driver()
 
     def attach_kernel_driver(self):
-        self.dev.attach_kernel_driver(self.interface.bInterfaceNumber)
+        self.transport.attach_kernel_driver()
 
     @property
     def descriptor(self):
-        if self._descriptor:
+        if self._descriptor is not None:
             return self._descriptor
         self._descriptor = self.req_get_descriptor()
         return self._descriptor
@@ -274,7 +392,7 @@ class Device(object):
 
     @property
     def formats(self):
-        if self._formats:
+        if self._formats is not None:
             return self._formats
 
         self._formats = self.req_get_formats()
@@ -282,7 +400,7 @@ class Device(object):
 
     @property
     def properties(self):
-        if self._properties:
+        if self._properties is not None:
             return self._properties
 
         reqs = self.req_get_properties()
@@ -301,7 +419,7 @@ class Device(object):
 
     @property
     def connectors(self):
-        if self._connectors:
+        if self._connectors is not None:
             return self._connectors
 
         reqs = self.req_get_connectors()
@@ -339,20 +457,39 @@ class Device(object):
         self.controller_disable()
 
     def __str__(self):
-        return f'{self.dev}'
+        return f'{self.transport}'
 
-    def gud_usb_control_msg(self, _in, request, value, buf):
-        requesttype = usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_INTERFACE;
-        if _in:
-            requesttype |= usb.util.CTRL_IN;
+    # Requests from the calling thread use retry instead of busy_retry until the block ends
+    @contextlib.contextmanager
+    def thread_retry(self, retry):
+        self._local.retry = retry
+        try:
+            yield
+        finally:
+            self._local.retry = None
 
-        return self.dev.ctrl_transfer(requesttype, request, value, self.interface.bInterfaceNumber,
-                                      data_or_wLength = buf, timeout = None)
+    def gud_usb_control_msg(self, _in, request, value, buf):
+        self.control_transfers += 1
+        return self.transport.control(_in, request, value, buf)
 
     def gud_usb_transfer(self, _in, request, index, buf):
         #drm_dbg(&gdrm->drm, "%s: request=0x%x index=%u len=%zu\n",
         #    _in ? "get" : "set", request, index, len)
 
+        # The status only covers the last request so a deferred check has to happen now
+        if self._status_pending is not None:
+            try:
+                self.check_status()
+            except GUDBaseException as e:
+                e.not_sent = request
+                raise
+
+        retry = getattr(self._local, 'retry', None) or self.busy_retry
+        if _in or retry is None or request not in retry.requests:
+            return self._gud_usb_transfer(_in, request, index, buf)
+        return retry.run(lambda: self._gud_usb_transfer(_in, request, index, buf))
+
+    def _gud_usb_transfer(self, _in, request, index, buf):
         stall = False
 
         try:
@@ -363,14 +500,42 @@ class Device(object):
             else:
                 raise e from None
 
-        if stall or ((self.flags & GUD_DISPLAY_FLAG_STATUS_ON_SET) and not _in):
+        if stall:
+            self._check_status(request, stall=True)
+        elif not _in and self.flags & GUD_DISPLAY_FLAG_STATUS_ON_SET:
+            policy = self.status_policy
+            if policy == STATUS_POLICY_ALWAYS:
+                self._check_status(request)
+            elif policy == STATUS_POLICY_DEFERRED:
+                self._status_pending = request
+            elif policy == STATUS_POLICY_SAMPLED:
+                self._status_sets += 1
+                if self._status_sets % self.status_interval == 0:
+                    self._check_status(request)
+        return ret;
+
+    # Check the status of a deferred SET request now
+    def check_status(self):
+        request = self._status_pending
+        if request is None:
+            return
+        self._status_pending = None
+        self._check_status(request)
+
+    def _check_status(self, request, stall=False):
+        start = timer()
+        try:
             status = self.status()
-            if stall and not status:
-                raise ValueError('status returned OK on stall')
-            if status:
+        finally:
+            self.status_polls += 1
+            self.status_time += timer() - start
+        if stall and not status:
+            raise ValueError('status returned OK on stall')
+        if status:
+            # busy is expected and retried
+            if status != GUD_STATUS_BUSY:
                 print(f'ERROR: {status} {self.status_to_str(status)}')
-                raise GUDBaseException.from_status(status)
-        return ret;
+            raise GUDBaseException.from_status(status, request)
 
     def gud_usb_get(self, request, index, buf):
         return self.gud_usb_transfer(True, request, index, buf);
@@ -468,8 +633,14 @@ class Device(object):
             return None;
         return bytes(ret)
 
+    # req is a gud_drm_req_set_buffer or a tuple of its field values
     def req_set_buffer(self, req):
-        self.gud_usb_set(GUD_REQ_SET_BUFFER, 0, bytearray(req))
+        r = self._set_buffer_req
+        if isinstance(req, tuple):
+            r.x, r.y, r.width, r.height, r.length, r.compression, r.compressed_length = req
+        else:
+            ctypes.memmove(ctypes.addressof(r), ctypes.addressof(req), ctypes.sizeof(r))
+        self.gud_usb_set(GUD_REQ_SET_BUFFER, 0, self._set_buffer)
 
     def req_set_state_check(self, req):
         self.gud_usb_set(GUD_REQ_SET_STATE_CHECK, 0, bytearray(req))
@@ -483,9 +654,103 @@ class Device(object):
     def req_set_display_enable(self, val):
         self.gud_usb_set(GUD_REQ_SET_DISPLAY_ENABLE, 0, bytearray((val,)))
 
+    # Send the bulk transfers through libusb's asynchronous API with depth transfers of
+    # transfer_size bytes in flight, needs the libusb1 pyusb backend.
+    def async_bulk(self, depth=4, transfer_size=256 * 1024):
+        self.bulk_writer = self.transport.async_bulk(depth, transfer_size)
+        return self.bulk_writer
+
     def bulk_write(self, buf, length):
-        ret = self.dev[0].interfaces()[0].endpoints()[0].write(buf, length)
-        assert ret == len(buf)
+        self.transport.bulk_write(buf, length)
+
+
+def metadata_cache_dir():
+    return cache_dir('devices', 'GUD_METADATA_CACHE')
+
+
+# What a device reports about itself stored on disk so the next start can skip asking again.
+#
+# The file is picked by VID/PID/bcdDevice/serial and it's only used if the display descriptor the
+# device returns (which has the protocol version) matches the stored one, so validating costs one
+# control request. The connector status is still read on open, modes and EDID are only read again
+# if it changed.
+# Devices without a serial number aren't cached, two of them with different panels can't be told apart.
+class MetadataCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory or metadata_cache_dir()
+
+    # None if the device can't be cached
+    def path(self, dev):
+        vid, pid, bcd, serial = dev.transport.ids()
+        if not serial:
+            return None
+        name = f'{vid:04x}-{pid:04x}-{bcd:04x}-{serial}'
+        return os.path.join(self.directory, name + '.json')
+
+    # Returns True if the device was set up from the cache
+    def load(self, dev):
+        path = self.path(dev)
+        if path is None:
+            return False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        desc = dev.descriptor
+        if desc is None or bytes(desc).hex() != data.get('descriptor'):
+            return False
+
+        def array(cls, value):
+            buf = bytes.fromhex(value)
+            return (cls * (len(buf) // ctypes.sizeof(cls))).from_buffer_copy(buf)
+
+        try:
+            dev._formats = tuple(data['formats'])
+            dev._properties = [Property(req) for req in array(gud_drm_req_property, data['properties'])]
+            connectors = []
+            for index, (req, c) in enumerate(zip(array(gud_drm_req_get_connector, data['connectors']), data['connector_data'])):
+                connector = Connector(dev, index, req)
+                connector._properties = [Property(r) for r in array(gud_drm_req_property, c['properties'])]
+                connector._status = c['status']
+                connector.modes = array(gud_drm_req_display_mode, c['modes'])
+                connector.edid = bytes.fromhex(c['edid']) if c['edid'] is not None else None
+                connectors.append(connector)
+        except (KeyError, TypeError, ValueError):
+            dev._formats = None
+            dev._properties = None
+            return False
+        dev._connectors = connectors
+        return True
+
+    # Fetches whatever isn't known yet and stores it
+    def save(self, dev):
+        path = self.path(dev)
+        if path is None:
+            return
+
+        def props(properties):
+            reqs = (gud_drm_req_property * len(properties))()
+            for req, prop in zip(reqs, properties):
+                req.prop = prop.prop
+                req.val = prop.mask if prop.mask is not None else prop.val
+            return bytes(reqs).hex()
+
+        connectors = (gud_drm_req_get_connector * len(dev.connectors))(*[c.req for c in dev.connectors])
+        data = {
+            'descriptor': bytes(dev.descriptor).hex(),
+            'formats': list(dev.formats),
+            'properties': props(dev.properties),
+            'connectors': bytes(connectors).hex(),
+            'connector_data': [{
+                'properties': props(c.properties),
+                'status': c._status,
+                'modes': bytes(c.modes).hex() if c.modes is not None else '',
+                'edid': c.edid.hex() if c.edid is not None else None,
+            } for c in dev.connectors],
+        }
+        atomic_write(path, lambda f: json.dump(data, f), 'w')
 
 
 KNOWN_GUD_IDS = [(0x1d50, 0x614d), (0x16d0, 0x10a9)]
@@ -509,14 +774,25 @@ def find(find_all=False, **args):
             return None
 
 
-def find_first_setup(**kwargs):
-    dev = find(**kwargs)
+# cache: A MetadataCache or True for the default one
+# transport: Use this Transport instead of looking for a device
+# record: Record the transfers to this file, see RecordTransport
+def find_first_setup(cache=None, transport=None, record=None, **kwargs):
+    dev = Device(transport) if transport else find(**kwargs)
     if not dev:
         return None
+    if record:
+        dev.transport = RecordTransport(dev.transport, record)
     if dev.is_kernel_driver_active():
         dev.detach_kernel_driver()
+    if cache is True:
+        cache = MetadataCache()
+    if cache:
+        cache.load(dev)
     for connector in dev.connectors:
         connector.update()
+    if cache:
+        cache.save(dev)
     return dev
 
 
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+import ctypes
+import hashlib
+from .gud_h import *
+
+
+# Content addressed cache of what's sent for a rectangle: the SET_BUFFER request and the
+# (compressed) buffer. Repeating frames then only cost hashing the pixels and the USB transfer.
+# Least recently used entries are evicted when the cache grows beyond max_size bytes.
+class PayloadCache(object):
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # rect and params must be hashable, params covers whatever else changes the payload (format, compression)
+    @staticmethod
+    def key(rect, params, buf):
+        return (rect, params, hashlib.blake2b(buf, digest_size=16).digest())
+
+    @staticmethod
+    def _entry_size(items):
+        return sum([len(buf) + (ctypes.sizeof(gud_drm_req_set_buffer) if req is not None else 0) for req, buf in items])
+
+    def get(self, key):
+        items = self._entries.get(key)
+        if items is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return items
+
+    # items is a list of (request, buffer), the buffers are copied since they can be views of the framebuffer
+    def put(self, key, items):
+        items = [(req, bytes(buf)) for req, buf in items]
+        size = self._entry_size(items)
+        if size > self.max_size:
+            return
+        if key in self._entries:
+            self.size -= self._entry_size(self._entries.pop(key))
+        while self.size + size > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= self._entry_size(evicted)
+            self.evictions += 1
+        self._entries[key] = items
+        self.size += size
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return f'PayloadCache(entries={len(self)}, size={(self.size / 1024 / 1024):.1f} MB, hits={self.hits}, misses={self.misses}, evictions={self.evictions})'
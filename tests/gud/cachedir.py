@@ -0,0 +1,32 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import os
+
+
+# Directory for one kind of cache: the env variable if set, otherwise $XDG_CACHE_HOME/gud/name
+# with ~/.cache as the default XDG_CACHE_HOME
+def cache_dir(name, env=None):
+    path = os.environ.get(env) if env else None
+    if path:
+        return path
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'gud', name)
+
+
+# Replace path in one go so a reader never sees a partly written file: write(f) writes to a
+# temporary file next to it which is then renamed over path.
+# Failing to write a cache is not an error, returns False.
+def atomic_write(path, write, mode='wb'):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    return True
@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import numpy
+from PIL import Image as PIL_Image
+from .damage import *
+
+
+def _rgba(pixels):
+    if isinstance(pixels, PIL_Image.Image):
+        pixels = numpy.asarray(pixels.convert('RGBA'))
+    pixels = numpy.asarray(pixels, dtype=numpy.uint8)
+    if pixels.shape[-1] == 3:
+        alpha = numpy.full(pixels.shape[:2] + (1,), 0xff, dtype=numpy.uint8)
+        pixels = numpy.concatenate((pixels, alpha), axis=-1)
+    return pixels
+
+
+# pixels: (height, width, 4) RGBA or (height, width, 3) RGB array, or a PIL image
+class Sprite(object):
+    def __init__(self, pixels, x=0, y=0, visible=True):
+        self.x = x
+        self.y = y
+        self.visible = visible
+        self._set(pixels)
+
+    def _set(self, pixels):
+        self.pixels = _rgba(pixels)
+        self.height, self.width = self.pixels.shape[:2]
+        # Fully opaque sprites are copied instead of blended
+        self.opaque = bool((self.pixels[..., 3] == 0xff).all())
+
+    @property
+    def bounds(self):
+        return self.x, self.y, self.width, self.height
+
+    def __repr__(self):
+        return f'Sprite({self.x}, {self.y}, {self.width}x{self.height})'
+
+
+# Background layer with sprites on top composited onto an Image.
+#
+# Changing a sprite damages its old and new bounds (merged into one rectangle when they touch),
+# flush() recomposites only the damaged rectangles from the background and the sprites covering
+# them and flushes those.
+#
+# background: (height, width, 3) RGB888 array, by default what is on the image now
+class Compositor(object):
+    def __init__(self, image, background=None, max_rects=4):
+        self.image = image
+        self.sprites = []
+        self.damage = Damage(max_rects)
+        if background is None:
+            background = self._capture()
+        self.background = numpy.array(background[..., :3], dtype=numpy.uint8)
+
+    def _capture(self):
+        img = self.image
+        if img.native:
+            return img._from_native(img._native, img.width)
+        return numpy.asarray(img.image)
+
+    def _damage(self, sprite):
+        if sprite.visible:
+            self.damage.add(*sprite.bounds)
+
+    def set_background(self, background):
+        self.background = numpy.array(background[..., :3], dtype=numpy.uint8)
+        self.damage.add(0, 0, self.image.width, self.image.height)
+
+    # Sprites added later are on top
+    def add(self, sprite):
+        self.sprites.append(sprite)
+        self._damage(sprite)
+        return sprite
+
+    def remove(self, sprite):
+        self._damage(sprite)
+        self.sprites.remove(sprite)
+
+    def move(self, sprite, x, y):
+        if (x, y) == (sprite.x, sprite.y):
+            return
+        self._damage(sprite)
+        sprite.x = x
+        sprite.y = y
+        self._damage(sprite)
+
+    def update(self, sprite, pixels):
+        self._damage(sprite)
+        sprite._set(pixels)
+        self._damage(sprite)
+
+    def show(self, sprite, visible=True):
+        if sprite.visible == visible:
+            return
+        self._damage(sprite)
+        sprite.visible = visible
+        self._damage(sprite)
+
+    def _composite(self, x0, y0, x1, y1):
+        out = self.background[y0 : y1, x0 : x1].copy()
+        for sprite in self.sprites:
+            if not sprite.visible:
+                continue
+            # Intersection with the sprite in frame coordinates
+            sx0 = max(x0, sprite.x)
+            sy0 = max(y0, sprite.y)
+            sx1 = min(x1, sprite.x + sprite.width)
+            sy1 = min(y1, sprite.y + sprite.height)
+            if sx0 >= sx1 or sy0 >= sy1:
+                continue
+            src = sprite.pixels[sy0 - sprite.y : sy1 - sprite.y, sx0 - sprite.x : sx1 - sprite.x]
+            dst = out[sy0 - y0 : sy1 - y0, sx0 - x0 : sx1 - x0]
+            if sprite.opaque:
+                dst[:] = src[..., :3]
+                continue
+            alpha = src[..., 3:].astype(numpy.uint16)
+            dst[:] = (src[..., :3] * alpha + dst * (0xff - alpha) + 0x7f) // 0xff
+        return out
+
+    # Recomposite the damaged rectangles onto the image, returns the rectangles
+    def composite(self):
+        rects = []
+        for rect in self.damage:
+            x0, y0, x1, y1 = self.image._region(*rect)
+            if x0 == x1 or y0 == y1:
+                continue
+            self.image.paste(x0, y0, self._composite(x0, y0, x1, y1))
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+        self.damage.clear()
+        return rects
+
+    def flush(self, compress=True):
+        self.composite()
+        return self.image.flush_damage(compress)
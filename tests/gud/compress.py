@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+import lz4.block
+
+
+# Compress horizontal bands of a buffer concurrently, each band is sent as its own rectangle.
+# lz4.block.compress releases the GIL so the bands are compressed on all cores.
+class BandCompressor(object):
+    def __init__(self, bands=None, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.bands = bands or self.workers
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='gud-lz4')
+        # Compression ratio of each band in the last compress()
+        self.ratios = []
+
+    # Split height lines into at most self.bands (y offset, lines) pairs
+    def split(self, height):
+        lines = (height + self.bands - 1) // self.bands
+        return [(y, min(lines, height - y)) for y in range(0, height, lines)]
+
+    # Returns the compressed buffer for each band
+    def compress(self, bufs):
+        def compress_one(buf):
+            return lz4.block.compress(buf, return_bytearray=True, store_size=False)
+
+        results = list(self.executor.map(compress_one, bufs))
+        self.ratios = [len(buf) / len(compressed) for buf, compressed in zip(bufs, results)]
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __str__(self):
+        ratios = ' '.join([f'{ratio:.1f}' for ratio in self.ratios])
+        return f'BandCompressor(bands={self.bands}, workers={self.workers}, ratios=[{ratios}])'
+
+
+# Decide per buffer whether LZ4 compression is worth it instead of compressing everything and
+# throwing the result away when it grew.
+#
+# The compressibility is estimated by compressing a few small samples spread over the buffer,
+# blended with the ratio previously seen for the same screen region.
+# Compression speed and link speed are measured as we go, when both are known compression is
+# only done if the transfer time it saves is more than the time it takes to compress.
+class AdaptiveCompression(object):
+    def __init__(self, threshold=1.2, samples=4, sample_size=4096, weight=0.5):
+        self.threshold = threshold
+        self.samples = samples
+        self.sample_size = sample_size
+        # History weight for the per region ratio
+        self.weight = weight
+        self.history = {}
+        self.compress_speed = None # bytes/s
+        self.link_speed = None # bytes/s
+
+        self.hits = 0 # compressed and it paid off
+        self.misses = 0 # compressed but it didn't pay off
+        self.skipped = 0 # not compressed
+        self.decision_time = 0.0
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return self.weight * old + (1 - self.weight) * new
+
+    def estimate(self, buf):
+        length = len(buf)
+        if not length:
+            return 1.0
+        size = self.sample_size
+        if length <= size * self.samples:
+            sample = buf
+        else:
+            step = length // self.samples
+            view = memoryview(buf)
+            sample = b''.join([view[i * step : i * step + size] for i in range(self.samples)])
+        return len(sample) / len(lz4.block.compress(sample, store_size=False))
+
+    def worth_it(self, length, ratio):
+        if ratio < self.threshold:
+            return False
+        if self.compress_speed and self.link_speed:
+            saved = length * (1 - 1 / ratio) / self.link_speed
+            return saved > length / self.compress_speed
+        return True
+
+    def should_compress(self, key, buf):
+        start = timer()
+        ratio = self._average(self.history.get(key), self.estimate(buf))
+        ret = self.worth_it(len(buf), ratio)
+        if not ret:
+            self.skipped += 1
+        self.decision_time += timer() - start
+        return ret
+
+    def compressed(self, key, length, compressed_length, elapsed=None):
+        ratio = length / compressed_length
+        self.history[key] = self._average(self.history.get(key), ratio)
+        if elapsed:
+            self.compress_speed = self._average(self.compress_speed, length / elapsed)
+        if self.worth_it(length, ratio):
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def transferred(self, length, elapsed):
+        if elapsed > 0 and length:
+            self.link_speed = self._average(self.link_speed, length / elapsed)
+
+    def __str__(self):
+        s = f'AdaptiveCompression(hits={self.hits}, misses={self.misses}, skipped={self.skipped}, decision={(self.decision_time * 1000):.3f} ms'
+        if self.compress_speed:
+            s += f', compress={(self.compress_speed / 1000000):.1f} MB/s'
+        if self.link_speed:
+            s += f', link={(self.link_speed / 1000000):.1f} MB/s'
+        return s + ')'
@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+import numpy
+from .gud_h import *
+
+
+# PIL doesn't have native RGB -> RGB565 conversion
+# https://github.com/python-pillow/Pillow/blob/master/src/libImaging/Pack.c
+# https://helperbyte.com/questions/180384/than-to-convert-a-picture-in-format-bmp565-in-python
+
+def rgb888_to_rgb565(rgb888):
+    r5 = (rgb888[..., 0] >> 3 & 0x1f).astype(numpy.uint16)
+    g6 = (rgb888[..., 1] >> 2 & 0x3f).astype(numpy.uint16)
+    b5 = (rgb888[..., 2] >> 3 & 0x1f).astype(numpy.uint16)
+    return r5 << 11 | g6 << 5 | b5
+
+def rgb565_to_rgb888(rgb565):
+    r5 = (rgb565 >> 11 & 0x1f).astype(numpy.uint8)
+    g6 = (rgb565 >> 5 & 0x3f).astype(numpy.uint8)
+    b5 = (rgb565 & 0x1f).astype(numpy.uint8)
+    return numpy.stack((r5 << 3 | r5 >> 2, g6 << 2 | g6 >> 4, b5 << 3 | b5 >> 2), axis=-1)
+
+# BGRX is little endian form of XRGB
+def rgb888_to_xrgb8888(rgb888):
+    xrgb8888 = numpy.zeros(rgb888.shape[:2] + (4,), dtype=numpy.uint8)
+    xrgb8888[..., 0] = rgb888[..., 2]
+    xrgb8888[..., 1] = rgb888[..., 1]
+    xrgb8888[..., 2] = rgb888[..., 0]
+    return xrgb8888
+
+def xrgb8888_to_rgb888(xrgb8888):
+    return numpy.ascontiguousarray(xrgb8888[..., 2::-1])
+
+# Each line is padded to a whole number of bytes, the first pixel is in the MSB(s).
+# Both match the per-pixel conversion the kernel driver does.
+
+def rgb888_to_r1(rgb888):
+    r = rgb888[..., 0].astype(numpy.uint16)
+    g = rgb888[..., 1].astype(numpy.uint16)
+    b = rgb888[..., 2].astype(numpy.uint16)
+    # ITU BT.601: Y = 0.299 R + 0.587 G + 0.114 B
+    gray8 = (3 * r + 6 * g + b) // 10
+    return numpy.packbits((gray8 & 1).astype(numpy.uint8), axis=-1)
+
+def r1_to_rgb888(r1, width):
+    gray8 = numpy.unpackbits(r1, axis=-1)[:, :width] * 0xff
+    return numpy.repeat(gray8[..., numpy.newaxis], 3, axis=-1)
+
+def rgb888_to_xrgb1111(rgb888):
+    height, width = rgb888.shape[:2]
+    rgb = rgb888 >> 7
+    # Pad to an even number of pixels so each pair makes up a byte
+    xrgb1111 = numpy.zeros((height, width + (width % 2)), dtype=numpy.uint8)
+    xrgb1111[:, :width] = (rgb[..., 0] << 2) | (rgb[..., 1] << 1) | rgb[..., 2]
+    return (xrgb1111[:, 0::2] << 4) | xrgb1111[:, 1::2]
+
+def xrgb1111_to_rgb888(xrgb1111, width):
+    pixels = numpy.empty((xrgb1111.shape[0], xrgb1111.shape[1] * 2), dtype=numpy.uint8)
+    pixels[:, 0::2] = xrgb1111 >> 4
+    pixels[:, 1::2] = xrgb1111 & 0xf
+    pixels = pixels[:, :width]
+    return numpy.stack((pixels >> 2 & 1, pixels >> 1 & 1, pixels & 1), axis=-1) * 0xff
+
+
+# The packed formats R1 and XRGB1111 as one value per pixel so they can be cut and placed at any x
+def unpack_pixels(fmt, native, width):
+    if fmt == GUD_PIXEL_FORMAT_R1:
+        return numpy.unpackbits(native, axis=-1)[:, :width]
+    pixels = numpy.empty((native.shape[0], native.shape[1] * 2), dtype=numpy.uint8)
+    pixels[:, 0::2] = native >> 4
+    pixels[:, 1::2] = native & 0xf
+    return pixels[:, :width]
+
+def pack_pixels(fmt, pixels):
+    if fmt == GUD_PIXEL_FORMAT_R1:
+        return numpy.packbits(pixels, axis=-1)
+    if pixels.shape[1] % 2:
+        pixels = numpy.pad(pixels, ((0, 0), (0, 1)))
+    return pixels[:, 0::2] << 4 | pixels[:, 1::2]
+
+
+def rgb888_to_r8(rgb888):
+    r = rgb888[..., 0].astype(numpy.uint16)
+    g = rgb888[..., 1].astype(numpy.uint16)
+    b = rgb888[..., 2].astype(numpy.uint16)
+    return ((3 * r + 6 * g + b) // 10).astype(numpy.uint8)
+
+def r8_to_rgb888(r8):
+    return numpy.repeat(r8[..., numpy.newaxis], 3, axis=-1)
+
+def rgb888_to_rgb332(rgb888):
+    return (rgb888[..., 0] >> 5 << 5 | rgb888[..., 1] >> 5 << 2 | rgb888[..., 2] >> 6).astype(numpy.uint8)
+
+def rgb332_to_rgb888(rgb332):
+    r3 = rgb332 >> 5
+    g3 = rgb332 >> 2 & 0x7
+    b2 = rgb332 & 0x3
+    return numpy.stack((r3 << 5 | r3 << 2 | r3 >> 1, g3 << 5 | g3 << 2 | g3 >> 1, b2 * 0x55), axis=-1).astype(numpy.uint8)
+
+# DRM RGB888 is little endian: BGR in memory
+def rgb888_to_bgr888(rgb888):
+    return numpy.ascontiguousarray(rgb888[..., 2::-1])
+
+def bgr888_to_rgb888(bgr888):
+    return numpy.ascontiguousarray(bgr888[..., ::-1])
+
+
+# to_native: RGB888 (lines, pixels, 3) array to the format as (lines, bytes) uint8
+# to_rgb888: The reverse, width is needed for the packed formats
+# rawmode: PIL raw mode that does the conversion directly from an RGB image, None if there's none
+Converter = collections.namedtuple('Converter', ['to_native', 'to_rgb888', 'rawmode'])
+
+CONVERTERS = {
+    GUD_PIXEL_FORMAT_R1: Converter(rgb888_to_r1, r1_to_rgb888, None),
+    GUD_PIXEL_FORMAT_R8: Converter(rgb888_to_r8, lambda native, width: r8_to_rgb888(native), None),
+    GUD_PIXEL_FORMAT_XRGB1111: Converter(rgb888_to_xrgb1111, xrgb1111_to_rgb888, None),
+    GUD_PIXEL_FORMAT_RGB332: Converter(rgb888_to_rgb332, lambda native, width: rgb332_to_rgb888(native), None),
+    GUD_PIXEL_FORMAT_RGB565: Converter(lambda rgb888: rgb888_to_rgb565(rgb888).astype('<u2').view(numpy.uint8),
+                                       lambda native, width: rgb565_to_rgb888(native.view('<u2')), None),
+    GUD_PIXEL_FORMAT_RGB888: Converter(rgb888_to_bgr888,
+                                       lambda native, width: bgr888_to_rgb888(native.reshape(native.shape[0], width, 3)), 'BGR'),
+    GUD_PIXEL_FORMAT_XRGB8888: Converter(rgb888_to_xrgb8888,
+                                         lambda native, width: xrgb8888_to_rgb888(native.reshape(native.shape[0], width, 4)), 'BGRX'),
+}
+CONVERTERS[GUD_PIXEL_FORMAT_ARGB8888] = CONVERTERS[GUD_PIXEL_FORMAT_XRGB8888]
+
+def _converter(fmt):
+    try:
+        return CONVERTERS[fmt]
+    except KeyError:
+        raise ValueError(f'Format 0x{fmt:02x} is not supported')
+
+# Convert the rectangle (x, y, width, height) of an RGB888 array (all of it if rect is None)
+def rgb888_to_format(fmt, rgb888, rect=None):
+    if rect:
+        x, y, width, height = rect
+        rgb888 = rgb888[y : y + height, x : x + width]
+    return _converter(fmt).to_native(rgb888).reshape(rgb888.shape[0], -1)
+
+def format_to_rgb888(fmt, native, width):
+    return _converter(fmt).to_rgb888(native, width)
+
+FORMAT_BPP = {
+    GUD_PIXEL_FORMAT_R1: 1,
+    GUD_PIXEL_FORMAT_R8: 8,
+    GUD_PIXEL_FORMAT_XRGB1111: 4,
+    GUD_PIXEL_FORMAT_RGB332: 8,
+    GUD_PIXEL_FORMAT_RGB565: 16,
+    GUD_PIXEL_FORMAT_RGB888: 24,
+    GUD_PIXEL_FORMAT_XRGB8888: 32,
+    GUD_PIXEL_FORMAT_ARGB8888: 32,
+}
+
+GRAYSCALE_FORMATS = {GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_R8}
+
+# The supported format that needs the least bandwidth with at least min_bpp bits per pixel,
+# color=False allows the grayscale formats.
+def smallest_format(formats, min_bpp=8, color=True):
+    candidates = [fmt for fmt in formats if fmt in FORMAT_BPP and FORMAT_BPP[fmt] >= min_bpp and
+                  not (color and fmt in GRAYSCALE_FORMATS)]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda fmt: FORMAT_BPP[fmt])
@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import numpy
+
+
+# Rectangles are kept as (x1, y1, x2, y2) with x2/y2 being exclusive
+
+def rect_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def rect_area(r):
+    return (r[2] - r[0]) * (r[3] - r[1])
+
+# Overlapping or sharing an edge
+def rect_touches(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Damage(object):
+    def __init__(self, max_rects=4):
+        self.max_rects = max_rects
+        self.rects = []
+
+    def __bool__(self):
+        return bool(self.rects)
+
+    def __iter__(self):
+        for r in self.rects:
+            yield r[0], r[1], r[2] - r[0], r[3] - r[1]
+
+    def clear(self):
+        self.rects = []
+
+    def add(self, x, y, width, height):
+        if width <= 0 or height <= 0:
+            return
+        rect = (x, y, x + width, y + height)
+
+        # Swallow everything the new rectangle touches, repeat since the union can reach further
+        merged = True
+        while merged:
+            merged = False
+            for r in self.rects:
+                if rect_touches(r, rect):
+                    self.rects.remove(r)
+                    rect = rect_union(r, rect)
+                    merged = True
+                    break
+        self.rects.append(rect)
+
+        # Too many rectangles: merge the pair that adds the least area
+        while len(self.rects) > self.max_rects:
+            best = None
+            for i in range(len(self.rects)):
+                for j in range(i + 1, len(self.rects)):
+                    a, b = self.rects[i], self.rects[j]
+                    cost = rect_area(rect_union(a, b)) - rect_area(a) - rect_area(b)
+                    if best is None or cost < best[0]:
+                        best = (cost, i, j)
+            _, i, j = best
+            union = rect_union(self.rects[i], self.rects[j])
+            del self.rects[j]
+            del self.rects[i]
+            self.rects.append(union)
+
+    @property
+    def bounds(self):
+        if not self.rects:
+            return None
+        r = self.rects[0]
+        for rect in self.rects[1:]:
+            r = rect_union(r, rect)
+        return r[0], r[1], r[2] - r[0], r[3] - r[1]
+
+    def __repr__(self):
+        return f'Damage({list(self)})'
+
+
+# Compare two frames tile by tile, returns a (rows, columns) bool array of changed tiles.
+# The frames are 2D arrays (lines, bytes per line) and tile_width is in bytes.
+# The comparison is done one band of tile_height lines at a time to bound the temporary memory.
+def diff_tiles(prev, cur, tile_width, tile_height):
+    height, length = cur.shape
+    rows = (height + tile_height - 1) // tile_height
+    columns = (length + tile_width - 1) // tile_width
+    changed = numpy.zeros((rows, columns), dtype=bool)
+    padded = numpy.zeros(columns * tile_width, dtype=bool)
+
+    for row in range(rows):
+        band = slice(row * tile_height, (row + 1) * tile_height)
+        if numpy.array_equal(prev[band], cur[band]):
+            continue
+        padded[:length] = (prev[band] != cur[band]).any(axis=0)
+        changed[row] = padded.reshape(columns, tile_width).any(axis=1)
+    return changed
+
+# Turn the changed tiles into rectangles, runs of tiles on a row make up one rectangle
+def tiles_to_damage(changed, tile_width, tile_height, width, height, damage):
+    for row, columns in enumerate(changed):
+        indices = numpy.flatnonzero(columns)
+        if not len(indices):
+            continue
+        # split where the run of changed tiles is broken
+        runs = numpy.split(indices, numpy.flatnonzero(numpy.diff(indices) != 1) + 1)
+        y = row * tile_height
+        for run in runs:
+            x = int(run[0]) * tile_width
+            x2 = min((int(run[-1]) + 1) * tile_width, width)
+            damage.add(x, y, x2 - x, min(tile_height, height - y))
+    return damage
@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import functools
+from PIL import ImageFont
+
+
+# Loading a truetype font is slow, keep the fonts around
+@functools.lru_cache(maxsize=32)
+def truetype(name, size):
+    return ImageFont.truetype(name, size)
+
+@functools.lru_cache(maxsize=1)
+def default_font():
+    return ImageFont.load_default()
+
+# Find the font size that makes text take up about fraction of width.
+# Returns the font and the size of the text.
+# The search loads a font for every step so the results are cached per label.
+@functools.lru_cache(maxsize=256)
+def fit_font(text, fraction, width, name='FreeMono'):
+    size = 16
+    step = 16
+    while step > 1:
+        font = truetype(name, size)
+        w, h = font.getsize(text)
+        #print('step, w, h:', step, w, h)
+        if w < fraction * width:
+            size += step
+        else:
+            size -= step // 2
+            step //= 4
+    #print('size', size)
+    return font, w, h
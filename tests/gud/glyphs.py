@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import numpy
+from PIL import Image as PIL_Image
+from PIL import ImageColor
+from PIL import ImageDraw as PIL_ImageDraw
+from .convert import *
+from .fonts import *
+from .planner import *
+
+
+# Each glyph is rasterized once with PIL and kept both as RGB888 and in the pixel format
+# (one value per pixel for R1/XRGB1111, the pixel bytes otherwise). Text is drawn by putting
+# the glyphs next to each other and copying them into the framebuffer, there's no PIL drawing
+# and no conversion after a glyph has been seen once.
+# Glyphs are placed by their advance width, there's no kerning.
+class GlyphAtlas(object):
+    def __init__(self, fmt, font=None, color='white', background='black'):
+        self.format = fmt
+        self.font = font or default_font()
+        self.color = ImageColor.getrgb(color)[:3]
+        self.background = ImageColor.getrgb(background)[:3]
+        if hasattr(self.font, 'getmetrics'):
+            ascent, descent = self.font.getmetrics()
+            self.height = ascent + descent
+        else:
+            self.height = self.font.getbbox('Ag|')[3]
+        self.cpp = format_cpp(fmt)
+        self.glyphs = {}
+
+    def glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            width = max(1, int(round(self.font.getlength(char))))
+            image = PIL_Image.new('RGB', (width, self.height), self.background)
+            PIL_ImageDraw.Draw(image).text((0, 0), char, font=self.font, fill=self.color)
+            rgb888 = numpy.asarray(image)
+            native = rgb888_to_format(self.format, rgb888)
+            if self.cpp:
+                pixels = native.reshape(self.height, width, self.cpp)
+            else:
+                pixels = unpack_pixels(self.format, native, width)
+            glyph = (rgb888, pixels)
+            self.glyphs[char] = glyph
+        return glyph
+
+    # The text as (RGB888, format pixels), padded with the background to width if given
+    def strip(self, text, width=None):
+        glyphs = [self.glyph(char) for char in text]
+        rgb888 = numpy.concatenate([g[0] for g in glyphs], axis=1) if glyphs else numpy.zeros((self.height, 0, 3), dtype=numpy.uint8)
+        if glyphs:
+            pixels = numpy.concatenate([g[1] for g in glyphs], axis=1)
+        else:
+            pixels = self._background_pixels(0)
+        if width is not None and width > rgb888.shape[1]:
+            pad = width - rgb888.shape[1]
+            rgb888 = numpy.concatenate((rgb888, numpy.full((self.height, pad, 3), self.background, dtype=numpy.uint8)), axis=1)
+            pixels = numpy.concatenate((pixels, self._background_pixels(pad)), axis=1)
+        return rgb888, pixels
+
+    def _background_pixels(self, width):
+        rgb888 = numpy.full((self.height, max(width, 1), 3), self.background, dtype=numpy.uint8)
+        native = rgb888_to_format(self.format, rgb888)
+        if self.cpp:
+            return native.reshape(self.height, -1, self.cpp)[:, :width]
+        return unpack_pixels(self.format, native, width)
+
+    def textwidth(self, text):
+        return sum(self.glyph(char)[0].shape[1] for char in text)
+
+    # Copy columns start:end of a strip to the image at x, y. Returns the damage rectangle.
+    def blit(self, image, x, y, strip, start=0, end=None):
+        rgb888, pixels = strip
+        if end is None:
+            end = rgb888.shape[1]
+        x += start
+        # Clip to the framebuffer
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + end - start, image.width)
+        y1 = min(y + self.height, image.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        columns = slice(start + x0 - x, start + x1 - x)
+        lines = slice(y0 - y, y1 - y)
+
+        if not image.native:
+            image.paste(x0, y0, numpy.ascontiguousarray(rgb888[lines, columns]))
+            return x0, y0, x1 - x0, y1 - y0
+
+        image.add_damage(x0, y0, x1 - x0, y1 - y0)
+        native = image._native
+        if self.cpp:
+            native[y0 : y1, x0 * self.cpp : x1 * self.cpp] = pixels[lines, columns].reshape(y1 - y0, -1)
+        else:
+            # Unpack the bytes the text touches, put the pixels in and pack them back
+            ppb = image.ppb
+            b0 = x0 // ppb
+            b1 = (x1 + ppb - 1) // ppb
+            region = unpack_pixels(self.format, native[y0 : y1, b0 : b1], (b1 - b0) * ppb)
+            region[:, x0 - b0 * ppb : x1 - b0 * ppb] = pixels[lines, columns]
+            native[y0 : y1, b0 : b1] = pack_pixels(self.format, region)
+        return x0, y0, x1 - x0, y1 - y0
+
+    # Draw text with its top left corner at x, y. Returns the damage rectangle.
+    def draw(self, image, x, y, text):
+        return self.blit(image, x, y, self.strip(text))
+
+
+# Text at a fixed position that is updated often, like a clock or a counter.
+# set() only redraws the columns that differ from the previous text.
+class TextLabel(object):
+    def __init__(self, image, x, y, atlas=None, **kwargs):
+        self.image = image
+        self.x = x
+        self.y = y
+        self.atlas = atlas or GlyphAtlas(image.format, **kwargs)
+        self.text = None
+        self._strip = None
+
+    # Returns the rectangle that changed, None if nothing did
+    def set(self, text):
+        atlas = self.atlas
+        if self._strip is None:
+            self._strip = atlas.strip(text)
+            self.text = text
+            return atlas.blit(self.image, self.x, self.y, self._strip)
+        if text == self.text:
+            return None
+
+        # Cover what the previous text covered
+        width = max(self._strip[0].shape[1], atlas.textwidth(text))
+        strip = atlas.strip(text, width)
+        old = self._strip[1]
+        new = strip[1]
+        changed = numpy.zeros(width, dtype=bool)
+        common = min(old.shape[1], width)
+        diff = old[:, :common] != new[:, :common]
+        changed[:common] = diff.reshape(diff.shape[0], common, -1).any(axis=(0, 2))
+        changed[common:] = True
+        self._strip = strip
+        self.text = text
+
+        columns = numpy.flatnonzero(changed)
+        if not len(columns):
+            return None
+        return atlas.blit(self.image, self.x, self.y, strip, int(columns[0]), int(columns[-1]) + 1)
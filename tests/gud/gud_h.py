@@ -317,16 +317,22 @@ GUD_REQ_GET_FORMATS                         = 0x40
 GUD_FORMATS_MAX_NUM                 = 32
 # R1 is a 1-bit monochrome transfer format presented to userspace as XRGB8888
 GUD_PIXEL_FORMAT_R1                 = 0x01
+GUD_PIXEL_FORMAT_R8                 = 0x08
 GUD_PIXEL_FORMAT_XRGB1111           = 0x20
+GUD_PIXEL_FORMAT_RGB332             = 0x30
 GUD_PIXEL_FORMAT_RGB565             = 0x40
+GUD_PIXEL_FORMAT_RGB888             = 0x50
 GUD_PIXEL_FORMAT_XRGB8888           = 0x80
 GUD_PIXEL_FORMAT_ARGB8888           = 0x81
 
 def format_to_name(fmt):
     _format_to_name = {
         GUD_PIXEL_FORMAT_R1: 'R1',
+        GUD_PIXEL_FORMAT_R8: 'R8',
         GUD_PIXEL_FORMAT_XRGB1111: 'XRGB1111',
+        GUD_PIXEL_FORMAT_RGB332: 'RGB332',
         GUD_PIXEL_FORMAT_RGB565: 'RGB565',
+        GUD_PIXEL_FORMAT_RGB888: 'RGB888',
         GUD_PIXEL_FORMAT_XRGB8888: 'XRGB8888',
         GUD_PIXEL_FORMAT_ARGB8888: 'ARGB8888',
     }
@@ -336,8 +342,11 @@ def format_to_name(fmt):
 def name_to_format(name):
     _name_to_format = {
         'R1': GUD_PIXEL_FORMAT_R1,
+        'R8': GUD_PIXEL_FORMAT_R8,
         'XRGB1111': GUD_PIXEL_FORMAT_XRGB1111,
+        'RGB332': GUD_PIXEL_FORMAT_RGB332,
         'RGB565': GUD_PIXEL_FORMAT_RGB565,
+        'RGB888': GUD_PIXEL_FORMAT_RGB888,
         'XRGB8888': GUD_PIXEL_FORMAT_XRGB8888,
         'ARGB8888': GUD_PIXEL_FORMAT_ARGB8888,
     }
@@ -1,41 +1,170 @@
 # SPDX-License-Identifier: CC0-1.0
 
-import os
-import struct
+import collections
+import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 import lz4
 import lz4.block
 import numpy
 from PIL import Image as PIL_Image
+from PIL import ImageColor
 from PIL import ImageDraw as PIL_ImageDraw
-from PIL import ImageFont
 from .gud_h import *
+from .cache import *
+from .compositor import *
+from .compress import *
+from .convert import *
+from .damage import *
+from .fonts import *
+from .glyphs import *
+from .planner import *
+from .sender import *
+from .pacing import *
+from .patterns import *
+from .ratio import *
 
 
 class Image(object):
-    def __init__(self, dev, fmt, mode, color=0):
+    # Number of prepared parts that can wait for transfer when pipelining
+    pipeline_depth = 2
+
+    # native=True: Keep the framebuffer as a NumPy array in the device pixel format instead of
+    #              a PIL RGB image. Flushing then only slices out the rectangle, there's no conversion.
+    def __init__(self, dev, fmt, mode, color=0, native=False):
         self.dev = dev
         self.format = fmt
         self.mode = mode
         self.width = mode.hdisplay
         self.height = mode.vdisplay
+        self.native = native
         self._cache = {}
-
-        if fmt == GUD_PIXEL_FORMAT_RGB565:
-            self.cpp = 2
-        elif fmt in (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888):
-            self.cpp = 4
-        elif fmt in (GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_R1):
-            self.cpp = 0
-        else:
-            raise ValueError(f'Format 0x{fmt:02x} is not supported')
+        self.damage = Damage()
+        self._last = None
+        # Set to a BandCompressor to compress each part as bands on all cores
+        self.compressor = None
+        # Set to an AdaptiveCompression to only compress when it's estimated to pay off
+        self.compression_policy = None
+        # Set to a PayloadCache (can be shared between images) to reuse the requests and
+        # compressed buffers of content that has been sent before
+        self.payload_cache = None
+        self._cache_keys = {}
+        # Decides how a rectangle is split into parts
+        self.planner = BufferPlanner()
+        # Created by the first flush_async()
+        self.sender = None
+        # Front buffers and their sender, created by the first swap()
+        self._fronts = None
+        self._swapper = None
+
+        self.cpp = format_cpp(fmt)
         self.pitch = self.width * self.cpp
+        # Pixels per byte, more than one for the packed formats
+        self.ppb = format_pixels_per_byte(fmt)
+
+        if native:
+            self.image = None
+            self.draw = None
+            self._native = numpy.zeros((self.height, self._offset(self.width, True)), dtype=numpy.uint8)
+            if color:
+                self.rectangle(0, 0, self.width, self.height, fill=color)
+        else:
+            self.image = PIL_Image.new('RGB', (self.width, self.height), color)
+            self.draw = PIL_ImageDraw.Draw(self.image)
+
+    # Typed view of the native framebuffer: one uint32/uint16 per pixel or the packed lines for R1 and XRGB1111
+    @property
+    def array(self):
+        if not self.native:
+            raise ValueError('array is only available on native images')
+        if self.cpp == 4:
+            return self._native.view('<u4')
+        elif self.cpp == 2:
+            return self._native.view('<u2')
+        return self._native
+
+    # Byte offset of pixel x within a line, round_up gives the end of a range for the packed formats
+    def _offset(self, x, round_up=False):
+        if self.cpp:
+            return x * self.cpp
+        if round_up:
+            x += self.ppb - 1
+        return x // self.ppb
+
+    def _to_native(self, rgb888):
+        return rgb888_to_format(self.format, rgb888)
+
+    def _from_native(self, native, width):
+        return format_to_rgb888(self.format, native, width)
+
+    # Clip to the framebuffer and widen the packed formats to whole bytes
+    def _region(self, x, y, width, height):
+        x0 = min(max(int(x), 0), self.width)
+        y0 = min(max(int(y), 0), self.height)
+        x1 = min(max(math.ceil(x + width), x0), self.width)
+        y1 = min(max(math.ceil(y + height), y0), self.height)
+        x0 -= x0 % self.ppb
+        x1 = min(x1 + (-x1 % self.ppb), self.width)
+        return x0, y0, x1, y1
+
+    # Get a region of the native framebuffer as a PIL image that can be drawn on
+    def _load(self, x0, y0, x1, y1):
+        native = self._native[y0 : y1, self._offset(x0) : self._offset(x1, True)]
+        return PIL_Image.fromarray(self._from_native(native, x1 - x0), 'RGB')
+
+    def _store(self, x0, y0, image):
+        native = self._to_native(numpy.asarray(image))
+        self._native[y0 : y0 + native.shape[0], self._offset(x0) : self._offset(x0) + native.shape[1]] = native
+
+    def _native_rectangle(self, x, y, width, height, fill, outline):
+        if not all(isinstance(v, int) for v in (x, y, width, height)) or not self.cpp:
+            x0, y0, x1, y1 = self._region(x, y, width, height)
+            if x0 == x1 or y0 == y1:
+                return
+            image = self._load(x0, y0, x1, y1)
+            PIL_ImageDraw.Draw(image).rectangle([(x - x0, y - y0), (x + width - 1 - x0, y + height - 1 - y0)],
+                                                fill=fill, outline=outline)
+            self._store(x0, y0, image)
+            return
 
-        self.image = PIL_Image.new('RGB', (self.width, self.height), color)
-        self.draw = PIL_ImageDraw.Draw(self.image)
+        # Fast path: fill the pixels directly
+        pixels = self._native.reshape(self.height, self.width, self.cpp)
+        def fill_rect(x, y, width, height, color):
+            x0, y0, x1, y1 = self._region(x, y, width, height)
+            rgb888 = numpy.array([[ImageColor.getrgb(color)[:3]]], dtype=numpy.uint8)
+            pixels[y0 : y1, x0 : x1] = self._to_native(rgb888).reshape(self.cpp)
+
+        if fill is not None:
+            fill_rect(x, y, width, height, fill)
+        if outline is not None:
+            fill_rect(x, y, width, 1, outline)
+            fill_rect(x, y + height - 1, width, 1, outline)
+            fill_rect(x, y, 1, height, outline)
+            fill_rect(x + width - 1, y, 1, height, outline)
+
+    # Callers that write directly to image or array need to report what they changed
+    def add_damage(self, x, y, width, height):
+        x0, y0, x1, y1 = self._region(x, y, width, height)
+        self.damage.add(x0, y0, x1 - x0, y1 - y0)
+
+    # Copy a (height, width, 3) RGB888 array to x, y. For the packed formats x has to be on a byte boundary.
+    def paste(self, x, y, rgb888):
+        height, width = rgb888.shape[:2]
+        self.add_damage(x, y, width, height)
+        if self.native:
+            self._store(x, y, rgb888)
+            return
+        self.image.paste(PIL_Image.fromarray(rgb888, 'RGB'), (x, y))
 
     def rectangle(self, x, y, width, height, fill=None, outline=None):
         #print('rectangle:', x, y, width, height)
+        self.add_damage(x, y, width, height)
+
+        if self.native:
+            self._native_rectangle(x, y, width, height, fill, outline)
+            return
 
         # Pillow docs say: The second point is just outside the drawn rectangle.
         # What I see: The second point is just inside the drawn rectangle.
@@ -43,170 +172,109 @@ class Image(object):
         self.draw.rectangle([(x, y), (x + width - 1, y + height - 1)], fill=fill, outline=outline)
 
     def text(self, text, x=None, y=None, color=None, fraction=None):
-        font = None
         if fraction:
-            size = 16
-            step = 16
-            while step > 1:
-                font = ImageFont.truetype("FreeMono", size)
-                w, h = font.getsize(text)
-                #print('step, w, h:', step, w, h)
-                if w < fraction * self.width:
-                    size += step
-                else:
-                    size -= step // 2
-                    step //= 4
-            #print('size', size)
+            font, w, h = fit_font(text, fraction, self.width)
         else:
-            w, h = self.draw.textsize(text)
+            font = default_font()
+            w, h = font.getsize(text)
         if x is None:
             x = (self.width - w) / 2
         if y is None:
             y = (self.height - h) / 2
+        self.add_damage(x, y, w, h)
+
+        if self.native:
+            x0, y0, x1, y1 = self._region(x, y, w, h)
+            if x0 == x1 or y0 == y1:
+                return
+            image = self._load(x0, y0, x1, y1)
+            PIL_ImageDraw.Draw(image).text((x - x0, y - y0), text, font=font, fill=color)
+            self._store(x0, y0, image)
+            return
+
         self.draw.text((x, y), text, font=font, fill=color)
 
-    def random(self, ratio=0):
-        if self.format in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111):
-            # The resulting ratio will not be as precise
-            rand_lines = self.height // (ratio if ratio else 1)
-            zero_lines = self.height - rand_lines
-            zeroes = self.width * 3 * zero_lines
-            buf = bytes(zeroes) + bytes(os.urandom(self.width * 3 * rand_lines))
-            self.image.frombytes(buf, 'raw', 'RGB')
+    # Draw one of the PATTERNS, native images load the converted frame from the pattern cache
+    def pattern(self, name, cache=None):
+        self.add_damage(0, 0, self.width, self.height)
+        if self.native:
+            cache = cache or pattern_cache
+            self._native[:] = cache.load(name, self.width, self.height, self.format, self._to_native)
             return
-
-        length = self.width * self.height * self.cpp
-        if ratio == 0:
-            buf = bytes(os.urandom(length))
-        else:
-            if self.cpp == 4:
-                rand_lines = self.height // ratio
-                zeroes = self.width * (self.height - rand_lines) * 4
-                xrgb8888 = numpy.random.randint(0, 0xFFFFFF00, (self.width, rand_lines), dtype=numpy.uint32)
-                buf = bytearray(zeroes) + bytearray(xrgb8888)
-            else:
-                zeroes = length - (length // ratio)
-                buf = bytearray(zeroes) + bytearray(os.urandom(length - zeroes))
-
-            assert len(buf) == length
-
-            #self.image.frombytes(bytes(buf), 'raw', 'RGB;16')
-            #self.text('Compress', y=200)
-            #buf = self.data(0, 0, self.width, self.height)
-
-            want = len(buf) // ratio
-            i = zeroes
-            while i < length:
-                compressed = lz4.block.compress(buf, return_bytearray=True, store_size=False)
-                if len(compressed) <= want:
-                    #print(f'random: ratio={ratio} i={i} zeroes={zeroes} length-(length/ratio)={length-(length/ratio)} length/i={length/i} length/(length - i)={length/(length - i)}')
-                    break
-                stride = (len(compressed) - want + 1) // 2
-                if not stride:
-                    stride = 1
-                #print(f':: i={i} stride={stride} {len(compressed) - want} ', end='', flush=True)
-                buf[i : i + stride] = bytearray(stride) # Zeros
-                i += stride
-            buf = bytes(buf)
-
-        #print('non zero count:', length - buf.count(b'\x00'))
-
-        if self.format == GUD_PIXEL_FORMAT_RGB565:
-            self.image.frombytes(buf, 'raw', 'RGB;16')
-        elif self.format in (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888):
-            self.image.frombytes(buf, 'raw', 'BGRX')
+        self.image.paste(PIL_Image.fromarray(pattern_rgb888(name, self.width, self.height)))
+
+    # Fill with seeded random data that LZ4 compresses about ratio times (0: incompressible),
+    # returns the achieved ratio
+    def random(self, ratio=0, seed=0):
+        self.add_damage(0, 0, self.width, self.height)
+        shape = (self.height, self._offset(self.width, True))
+        buf, achieved = ratio_buffer(shape[0] * shape[1], ratio, seed)
+        native = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(shape)
+        if self.native:
+            self._native[:] = native
         else:
-            raise ValueError('format not supported')
+            self.image.frombytes(self._from_native(native, self.width).tobytes())
+        return achieved
 
     def data(self, x1, y1, width, height):
-        if self.format in (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888) and width == self.width:
-            # BGRX is little endian form of XRGB
-            buf = self.image.tobytes('raw', 'BGRX')
-            #print('len:', len(buf))
-            offset = y1 * self.pitch
-            buf = buf[offset : offset + height * self.pitch]
-            #print('len:', len(buf))
-            return bytearray(buf)
-
-        # PIL doesn't have native RGB -> RGB565 conversion
-        # https://github.com/python-pillow/Pillow/blob/master/src/libImaging/Pack.c
-        if self.format == GUD_PIXEL_FORMAT_RGB565:
-            import numpy
-            # https://helperbyte.com/questions/180384/than-to-convert-a-picture-in-format-bmp565-in-python
-            rgb888 = numpy.asarray(self.image)
-            assert rgb888.shape[-1] == 3 and rgb888.dtype == numpy.uint8
-
-            rgb888 = rgb888[y1 : y1 + height, x1 : x1 + width]
-
-            r5 = (rgb888[..., 0] >> 3 & 0x1f).astype(numpy.uint16)
-            g6 = (rgb888[..., 1] >> 2 & 0x3f).astype(numpy.uint16)
-            b5 = (rgb888[..., 2] >> 3 & 0x1f).astype(numpy.uint16)
-            rgb565 = r5 << 11 | g6 << 5 | b5
-            buf = bytearray(rgb565)
-            #print('len(buf):', len(buf))
-            return buf
-
-        val = None
-        data = bytearray()
-        #print('data(', x1, y1, width, height, ')')
-        for y in range(y1, y1 + height):
-            for x in range(x1, x1 + width):
-                #print(x,y)
-                pix = self.image.getpixel((x, y))
-                if self.format == GUD_PIXEL_FORMAT_R1:
-                    pixpos = x % 8 # within byte from the left
-                    pixshift = 8 - pixpos - 1
-
-                    if x % 8 == 0:
-                        val = 0
-
-                    r = pix[0] & 0xFF
-                    g = pix[1] & 0xFF
-                    b = pix[2] & 0xFF
-                    # ITU BT.601: Y = 0.299 R + 0.587 G + 0.114 B
-                    gray8 = (3 * r + 6 * g + b) // 10;
-                    val |= (gray8 & 1) << pixshift
-
-                    if x % 8 == 7:
-                        data.append(val)
-                        val = None
-                elif self.format == GUD_PIXEL_FORMAT_XRGB1111:
-                    pixpos = x % 2 # within byte from the left
-                    pixshift = (2 - pixpos - 1) * 4;
-
-                    if x % 2 == 0:
-                        val = 0
-
-                    r = (pix[0] >> 7) & 0x01
-                    g = (pix[1] >> 7) & 0x01
-                    b = (pix[2] >> 7) & 0x01
-                    xrgb1111 = (r << 2) | (g << 1) | b
-                    val |= xrgb1111 << pixshift
-
-                    if x % 2 == 1:
-                        data.append(val)
-                        val = None
-                elif self.format == GUD_PIXEL_FORMAT_RGB565:
-                    r = (pix[0] >> 3) & 0x1F
-                    g = (pix[1] >> 2) & 0x3F
-                    b = (pix[2] >> 3) & 0x1F
-                    data.extend(struct.pack('H', (r << 11) | (g << 5) | b))
-                elif self.format in (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888):
-                    r = pix[0] & 0xFF
-                    g = pix[1] & 0xFF
-                    b = pix[2] & 0xFF
-                    data.extend(struct.pack('I', (r << 16) | (g << 8) | b))
-                else:
-                    raise ValueError('format not supported')
+        if self.native:
+            native = self._native[y1 : y1 + height, self._offset(x1) : self._offset(x1 + width, True)]
+            if not self.cpp and (x1 % self.ppb or width % self.ppb):
+                # Shift out the pixels before x1 and zero the pad bits after the last pixel like PIL does
+                skip = x1 % self.ppb
+                native = pack_pixels(self.format, unpack_pixels(self.format, native, skip + width)[:, skip:])
+            # Full lines are contiguous so this doesn't copy, a partial width copies only the rectangle
+            return memoryview(numpy.ascontiguousarray(native)).cast('B')
+
+        # Only convert the rectangle
+        image = self.image
+        if (x1, y1, width, height) != (0, 0, self.width, self.height):
+            image = image.crop((x1, y1, x1 + width, y1 + height))
+
+        rawmode = CONVERTERS[self.format].rawmode
+        if rawmode:
+            return image.tobytes('raw', rawmode)
+
+        rgb888 = numpy.asarray(image)
+        assert rgb888.shape[-1] == 3 and rgb888.dtype == numpy.uint8
+        return memoryview(self._to_native(rgb888)).cast('B')
+
+    # pipeline=True: Prepare (convert/compress) the next part in a worker thread while the current one is transferred
+    def flush(self, x=0, y=0, width=None, height=None, compress=True, use_cached=False, pipeline=False):
+        x, y, width, height = self._flush_region(x, y, width, height)
+
+        start = timer()
+
+        self._update_last(x, y, width, height)
+        rects = [part[:4] for part in self.plan(x, y, width, height)]
+
+        if pipeline and len(rects) > 1:
+            self._flush_pipelined(rects, compress, use_cached)
+        else:
+            for i, rect in enumerate(rects):
+                self._flush(i, *rect, compress, use_cached)
+
+        return timer() - start, len(rects)
 
-            # R1 or XRGB1111: In case width isn't a pixels per byte multiple
-            if val is not None:
-                data.append(val)
-                val = None
+    # Like flush() but the bands are converted, compressed and sent one at a time through a chain
+    # of generators. Nothing is kept for use_cached so peak memory is about one band of band_size
+    # bytes (plus its compressed copy) instead of a copy of the whole rectangle.
+    def flush_stream(self, x=0, y=0, width=None, height=None, compress=True, band_size=1024 * 1024):
+        x, y, width, height = self._flush_region(x, y, width, height)
 
-        return data
+        start = timer()
+
+        self._update_last(x, y, width, height)
+        parts = BufferPlanner(band_size).plan(self.format, x, y, width, height, self.dev.max_buffer_size)
+        bands = ((part[:4], self.data(*part[:4])) for part in parts)
+        payloads = (self._payload(*rect, buf, compress) for rect, buf in bands)
+        for items in payloads:
+            self._send(items)
+
+        return timer() - start, len(parts)
 
-    def flush(self, x=0, y=0, width=None, height=None, compress=True, use_cached=False):
+    # The rectangle a flush actually sends
+    def _flush_region(self, x, y, width, height):
         if self.dev.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE:
             x = 0
             y = 0
@@ -215,6 +283,8 @@ class Image(object):
         elif width is None or height is None:
             width = self.width
             height = self.height
+        if (x, y, width, height) == (0, 0, self.width, self.height):
+            self.damage.clear()
         #else:
         #    print(f'flush({x}, {y}, {width}, {height})')
 
@@ -227,101 +297,295 @@ class Image(object):
             adj = x % 2
             x -= adj
             width += adj
+        return x, y, width, height
 
-        lines = height
-        if self.dev.max_buffer_size < lines * self.pitch:
-            lines = self.dev.max_buffer_size // self.pitch
-
-        start = timer()
-
-        parts = (height + lines - 1) // lines
-        for i in range(parts):
-            self._flush(i, x, y + (i * lines), width, min(lines, height), compress, use_cached)
-            height -= lines
+    # The parts flush() will send the rectangle in
+    def plan(self, x, y, width, height):
+        return self.planner.plan(self.format, x, y, width, height, self.dev.max_buffer_size)
 
-        return timer() - start, parts
+    # Flush from a sender thread, returns a Future with a FlushResult.
+    # If the previous frame hasn't been sent yet it's replaced by this one and their damage merged.
+    def flush_async(self, x=0, y=0, width=None, height=None, compress=True):
+        if width is None or height is None:
+            width = self.width
+            height = self.height
+        if self.sender is None:
+            self.sender = FlushSender(self)
+        return self.sender.submit(x, y, width, height, compress)
+
+    # Double buffering: this image is the back buffer that is drawn on. swap() copies it to a front
+    # buffer and flushes the damage from there in a sender thread, so drawing the next frame can
+    # start right away. There are two front buffers, the sender only ever reads one that isn't
+    # written to, swap() waits for the send from the front buffer it is about to reuse.
+    # Returns a Future with the (elapsed, parts) of the flush.
+    def swap(self, compress=True):
+        if self._fronts is None:
+            self._fronts = collections.deque([(Image(self.dev, self.format, self.mode, native=self.native), None) for _ in range(2)])
+            self._swapper = ThreadPoolExecutor(1, thread_name_prefix='gud-swap')
+
+        front, future = self._fronts.popleft()
+        if future is not None:
+            future.result()
+
+        if self.native:
+            numpy.copyto(front._native, self._native)
+        else:
+            front.image.paste(self.image)
+        front.planner = self.planner
+        front.compressor = self.compressor
+        front.compression_policy = self.compression_policy
+        front.payload_cache = self.payload_cache
+        front.damage.clear()
+        for rect in self.damage:
+            front.damage.add(*rect)
+        self.damage.clear()
+
+        future = self._swapper.submit(front.flush_damage, compress)
+        self._fronts.append((front, future))
+        return future
+
+    # Wait for what swap() and flush_async() are still sending and stop their threads.
+    # An error from the last swap is raised here.
+    def close(self):
+        if self.sender is not None:
+            self.sender.close()
+            self.sender = None
+        if self._fronts is None:
+            return
+        fronts, self._fronts = self._fronts, None
+        try:
+            for _, future in fronts:
+                if future is not None:
+                    future.result()
+        finally:
+            self._swapper.shutdown()
+            self._swapper = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Frame as lines of bytes: the native array or the PIL RGB pixels
+    def _frame(self):
+        if self.native:
+            return self._native
+        return numpy.asarray(self.image).reshape(self.height, self.width * 3)
+
+    def _frame_columns(self, x0, x1):
+        if self.native:
+            return self._offset(x0), self._offset(x1, True)
+        return x0 * 3, x1 * 3
+
+    # Remember what was sent to the device so flush_diff() can compare against it
+    def _update_last(self, x, y, width, height):
+        if self._last is None:
+            return
+        frame = self._frame()
+        x0, y0, x1, y1 = self._region(x, y, width, height)
+        c0, c1 = self._frame_columns(x0, x1)
+        self._last[y0 : y1, c0 : c1] = frame[y0 : y1, c0 : c1]
+
+    # Compare the frame against the last transmitted one in tiles of tile x tile pixels.
+    # Returns the changed tiles merged into at most max_rects rectangles.
+    def diff(self, tile=64, max_rects=4):
+        damage = Damage(max_rects)
+        if self._last is None:
+            damage.add(0, 0, self.width, self.height)
+            return damage
+
+        # Keep the packed formats on whole bytes
+        tile += -tile % self.ppb
+        c0, c1 = self._frame_columns(0, tile)
+        changed = diff_tiles(self._last, self._frame(), c1 - c0, tile)
+        return tiles_to_damage(changed, tile, tile, self.width, self.height, damage)
+
+    # For callers that redraw everything each frame: flush only the tiles that differ from
+    # the last transmitted frame, nothing is sent if the frame is unchanged.
+    def flush_diff(self, tile=64, max_rects=4, compress=True):
+        if self._last is None:
+            t, parts = self.flush(compress=compress)
+            self._last = self._frame().copy()
+            return t, parts
+
+        damage = self.diff(tile, max_rects)
+        if not damage:
+            self.damage.clear()
+            return 0, 0
+        if self.dev.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE:
+            return self.flush(compress=compress)
+
+        self.damage.clear()
+        elapsed = 0
+        parts = 0
+        for rect in damage:
+            t, p = self.flush(*rect, compress=compress)
+            elapsed += t
+            parts += p
+        return elapsed, parts
+
+    # Flush only what has been drawn since the last full flush, one request per damage rectangle
+    def flush_damage(self, compress=True):
+        if not self.damage:
+            return 0, 0
+        if self.dev.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE:
+            return self.flush(compress=compress)
+
+        rects = list(self.damage)
+        self.damage.clear()
+        elapsed = 0
+        parts = 0
+        for rect in rects:
+            t, p = self.flush(*rect, compress=compress)
+            elapsed += t
+            parts += p
+        return elapsed, parts
 
     def _flush(self, i, x, y, width, height, compress, use_cached):
+        self._send(self._prepare(i, x, y, width, height, compress, use_cached))
+
+    # LZ4 and NumPy release the GIL so preparing overlaps with the bulk transfer
+    def _flush_pipelined(self, rects, compress, use_cached):
+        prepared = queue.Queue(maxsize=self.pipeline_depth)
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for i, rect in enumerate(rects):
+                    if stop.is_set():
+                        return
+                    prepared.put(self._prepare(i, *rect, compress, use_cached))
+            except Exception as e:
+                prepared.put(e)
+
+        thread = threading.Thread(target=worker, name='gud-flush', daemon=True)
+        thread.start()
+        try:
+            for _ in rects:
+                item = prepared.get()
+                if isinstance(item, Exception):
+                    raise item
+                self._send(item)
+        finally:
+            stop.set()
+            # Unblock the worker if it's waiting on a full queue
+            while thread.is_alive():
+                try:
+                    prepared.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    # The gud_drm_req_set_buffer fields, Device.req_set_buffer() fills in its preallocated request
+    def _set_buffer_req(self, x, y, width, height, buf, compressed=None):
+        if compressed is None:
+            return (x, y, width, height, len(buf), 0, 0)
+        return (x, y, width, height, len(buf), GUD_COMPRESSION_LZ4, len(compressed))
+
+    # Returns a list of (SET_BUFFER request, buffer to transfer), the request is None on FULL_UPDATE devices
+    def _prepare(self, i, x, y, width, height, compress, use_cached):
+        cache = self.payload_cache
+        if cache is not None:
+            bands = self.compressor.bands if self.compressor is not None else 1
+            params = (self.format, bool(compress), self.dev.descriptor.flags, self.dev.descriptor.compression, bands)
+        # The content is the same, no need to hash it again if the payload would be built the same way
+        if use_cached and cache is not None and i in self._cache_keys:
+            cached_params, key = self._cache_keys[i]
+            if cached_params == params:
+                items = cache.get(key)
+                if items is not None:
+                    return items
+
         if use_cached:
             buf = self._cache[i]
         else:
             buf = self.data(x, y, width, height)
             self._cache[i] = buf
 
-        if not self.dev.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE:
-            req = gud_drm_req_set_buffer()
-            req.x = x
-            req.y = y
-            req.width = width
-            req.height = height
-            req.length = len(buf)
-            req.compression = 0
-            req.compressed_length = 0
+        if cache is None:
+            return self._payload(x, y, width, height, buf, compress)
+
+        key = cache.key((x, y, width, height), params, buf)
+        self._cache_keys[i] = (params, key)
+        items = cache.get(key)
+        if items is None:
+            items = self._payload(x, y, width, height, buf, compress)
+            cache.put(key, items)
+        return items
 
-            if compress and self.dev.descriptor.compression & GUD_COMPRESSION_LZ4:
-                compressed = lz4.block.compress(buf, return_bytearray=True, store_size=False)
-                if (len(compressed) <= len(buf)):
-                    buf = compressed
-                    req.compression = GUD_COMPRESSION_LZ4
-                    req.compressed_length = len(compressed)
+    def _payload(self, x, y, width, height, buf, compress):
+        if self.dev.descriptor.flags & GUD_DISPLAY_FLAG_FULL_UPDATE:
+            return [(None, buf)]
+
+        if not compress or not self.dev.descriptor.compression & GUD_COMPRESSION_LZ4:
+            return [(self._set_buffer_req(x, y, width, height, buf), buf)]
+
+        policy = self.compression_policy
+        if self.compressor is not None and height > 1:
+            # Every line has the same length so the bands can be sliced out of the buffer
+            line_length = len(buf) // height
+            view = memoryview(buf)
+            bands = [(x, y + band_y, width, lines) for band_y, lines in self.compressor.split(height)]
+            bufs = [view[(rect[1] - y) * line_length : (rect[1] - y + rect[3]) * line_length] for rect in bands]
+            todo = [index for index, rect in enumerate(bands) if policy is None or policy.should_compress(rect, bufs[index])]
+
+            results = [None] * len(bands)
+            start = timer()
+            for index, compressed in zip(todo, self.compressor.compress([bufs[index] for index in todo])):
+                results[index] = compressed
+            # The bands are compressed in parallel, approximate the time each took
+            elapsed = (timer() - start) * min(self.compressor.workers, len(todo)) / len(todo) if todo else 0
+
+            items = []
+            for rect, band, compressed in zip(bands, bufs, results):
+                if compressed is not None and policy:
+                    policy.compressed(rect, len(band), len(compressed), elapsed)
+                if compressed is not None and len(compressed) <= len(band):
+                    items.append((self._set_buffer_req(*rect, band, compressed), compressed))
+                else:
+                    items.append((self._set_buffer_req(*rect, band), band))
+            return items
 
-            self.dev.req_set_buffer(req)
+        rect = (x, y, width, height)
+        if policy and not policy.should_compress(rect, buf):
+            return [(self._set_buffer_req(*rect, buf), buf)]
 
-        self.dev.bulk_write(buf, len(buf))
+        start = timer()
+        compressed = lz4.block.compress(buf, return_bytearray=True, store_size=False)
+        if policy:
+            policy.compressed(rect, len(buf), len(compressed), timer() - start)
+        if (len(compressed) <= len(buf)):
+            return [(self._set_buffer_req(*rect, buf, compressed), compressed)]
+        return [(self._set_buffer_req(*rect, buf), buf)]
+
+    def _send(self, items):
+        for req, buf in items:
+            if req is not None:
+                self.dev.req_set_buffer(req)
+            start = timer()
+            self.dev.bulk_write(buf, len(buf))
+            if self.compression_policy:
+                self.compression_policy.transferred(len(buf), timer() - start)
 
     def __str__(self):
         return f'{self.mode.hdisplay}x{self.mode.vdisplay} {format_to_name(self.format)}'
 
 
-def draw_smpte_rects(img, x, y, width, height, colors):
-    for i in range(len(colors)):
-        img.rectangle(x + (width * i), y, x + (width * (i + 1)), y + height, fill=colors[i], outline=colors[i])
-
 def draw_smpte_pattern(img):
     #print('draw_smpte_pattern', img.width, img.height)
+    for rect in smpte_rects(img.width, img.height):
+        img.rectangle(*rect)
 
-    # top colors: grey/silver, yellow, cyan, green, magenta, red, blue
-    y = 0
-    width = img.width // 7
-    height = img.height * 6 // 9
-    draw_smpte_rects(img, 0, 0, width, height, ['#c0c0c0', '#c0c000', '#00c0c0', '#00c000', '#c000c0', '#c00000', '#0000c0'])
-
-    # middle colors: blue, black magenta, black, cyan, black, grey
-    y = height
-    width = img.width / 7
-    height = img.height * 1 / 9
-    draw_smpte_rects(img, 0, y, width, height, ['#0000c0', '#131313', '#c000c0', '#131313', '#00c0c0', '#131313', '#c0c0c0'])
-
-    # bottom colors: in-phase, super white, quadrature, black, 3.5%, 7.5%, 11.5%, black
-    y += height
-    width = img.width / 6
-    height = img.height * 2 / 9
-    draw_smpte_rects(img, 0, y, width, height, ['#00214c', '#ffffff', '#32006a', '#131313'])
-
-    x = width * 4
-    width = img.width / 6 / 3
-    draw_smpte_rects(img, x, y, width, height, ['#090909', '#131313', '#1d1d1d'])
-
-    x = img.width * 5 / 6
-    width = img.width / 6
-    draw_smpte_rects(img, x, y, width, height, ['#131313'])
-
-def smpte_image(dev, fmt, mode, text=None):
-    img = Image(dev, fmt, mode)
-    draw_smpte_pattern(img)
+def smpte_image(dev, fmt, mode, text=None, native=False):
+    img = Image(dev, fmt, mode, native=native)
+    img.pattern('smpte')
     if text:
         img.text(text, y = img.height / 3)
     return img
 
 
-def checkerboard_image(dev, fmt, mode):
-    colors = ('#FFFFFF', '#000000')
-    img = Image(dev, fmt, mode)
-    num_width = 8
-    w = img.width // num_width
-    num_height = img.height // w
-
-    for y in range(num_height):
-        for x in range(num_width):
-            img.rectangle(x * w, y * w, w, w, fill=colors[(x + y) % len(colors)])
+def checkerboard_image(dev, fmt, mode, native=False):
+    img = Image(dev, fmt, mode, native=native)
+    img.pattern('checkerboard')
     return img
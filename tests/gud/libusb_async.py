@@ -0,0 +1,225 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import ctypes
+import errno
+from timeit import default_timer as timer
+import numpy
+import usb.core
+
+
+LIBUSB_TRANSFER_TYPE_BULK = 2
+
+LIBUSB_TRANSFER_COMPLETED = 0
+LIBUSB_TRANSFER_ERROR = 1
+LIBUSB_TRANSFER_TIMED_OUT = 2
+LIBUSB_TRANSFER_CANCELLED = 3
+LIBUSB_TRANSFER_STALL = 4
+LIBUSB_TRANSFER_NO_DEVICE = 5
+LIBUSB_TRANSFER_OVERFLOW = 6
+
+# The errno pyusb uses for a failed transfer
+LIBUSB_TRANSFER_ERRNO = {
+    LIBUSB_TRANSFER_ERROR: errno.EIO,
+    LIBUSB_TRANSFER_TIMED_OUT: errno.ETIMEDOUT,
+    LIBUSB_TRANSFER_CANCELLED: errno.EAGAIN,
+    LIBUSB_TRANSFER_STALL: errno.EPIPE,
+    LIBUSB_TRANSFER_NO_DEVICE: errno.ENODEV,
+    LIBUSB_TRANSFER_OVERFLOW: errno.EOVERFLOW,
+}
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+class libusb_transfer(ctypes.Structure):
+    pass
+
+libusb_transfer_p = ctypes.POINTER(libusb_transfer)
+libusb_transfer_cb_fn = ctypes.CFUNCTYPE(None, libusb_transfer_p)
+
+# The iso_packet_desc flexible array is left out, the transfers are allocated without iso packets
+libusb_transfer._fields_ = [('dev_handle', ctypes.c_void_p),
+                            ('flags', ctypes.c_uint8),
+                            ('endpoint', ctypes.c_ubyte),
+                            ('type', ctypes.c_ubyte),
+                            ('timeout', ctypes.c_uint),
+                            ('status', ctypes.c_int),
+                            ('length', ctypes.c_int),
+                            ('actual_length', ctypes.c_int),
+                            ('callback', libusb_transfer_cb_fn),
+                            ('user_data', ctypes.c_void_p),
+                            ('buffer', ctypes.c_void_p),
+                            ('num_iso_packets', ctypes.c_int)]
+
+
+# The libusb library, context and device handle pyusb uses for a device.
+# The library is opened again so setting up the prototypes doesn't touch pyusb's function objects.
+def libusb_handle(usbdev):
+    ctx = usbdev._ctx
+    backend = ctx.backend
+    if not hasattr(backend, 'lib') or not hasattr(backend, 'ctx'):
+        raise ValueError(f'The libusb1 pyusb backend is needed, not {type(backend).__module__}')
+    ctx.managed_open()
+
+    lib = ctypes.CDLL(backend.lib._name)
+    lib.libusb_alloc_transfer.argtypes = [ctypes.c_int]
+    lib.libusb_alloc_transfer.restype = libusb_transfer_p
+    lib.libusb_free_transfer.argtypes = [libusb_transfer_p]
+    lib.libusb_free_transfer.restype = None
+    lib.libusb_submit_transfer.argtypes = [libusb_transfer_p]
+    lib.libusb_submit_transfer.restype = ctypes.c_int
+    lib.libusb_cancel_transfer.argtypes = [libusb_transfer_p]
+    lib.libusb_cancel_transfer.restype = ctypes.c_int
+    lib.libusb_handle_events_timeout_completed.argtypes = [ctypes.c_void_p, ctypes.POINTER(timeval), ctypes.POINTER(ctypes.c_int)]
+    lib.libusb_handle_events_timeout_completed.restype = ctypes.c_int
+    lib.libusb_error_name.argtypes = [ctypes.c_int]
+    lib.libusb_error_name.restype = ctypes.c_char_p
+
+    return lib, backend.ctx, ctx.handle.handle
+
+
+# Bulk OUT writes through libusb's asynchronous API.
+#
+# pyusb's Endpoint.write() has one transfer outstanding so the bus idles while the completion
+# makes its way back to Python and the next transfer is submitted. Here a payload is split into
+# transfers of transfer_size bytes and up to depth of them are kept submitted, the next one is
+# queued as soon as one completes. write() returns when the whole payload is on the wire so the
+# next GUD request still comes after the bulk data.
+#
+# transfer_size is rounded down to a multiple of the max packet size so only the last transfer of
+# a payload can end with a short packet.
+class AsyncBulkWriter(object):
+    def __init__(self, usbdev, endpoint, depth=4, transfer_size=256 * 1024, max_packet_size=512, timeout=5000):
+        self.lib, self.ctx, self.handle = libusb_handle(usbdev)
+        self.endpoint = endpoint
+        self.depth = depth
+        self.transfer_size = max(transfer_size // max_packet_size, 1) * max_packet_size
+        self.timeout = timeout
+        self._callback = libusb_transfer_cb_fn(self._complete) # keep it alive
+        self._transfers = {}
+        for _ in range(depth):
+            transfer = self.lib.libusb_alloc_transfer(0)
+            if not transfer:
+                self.close()
+                raise MemoryError('libusb_alloc_transfer failed')
+            self._transfers[ctypes.addressof(transfer.contents)] = transfer
+        self._idle = list(self._transfers.values())
+        self._in_flight = 0
+        self._error = None
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.transfers = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.max_in_flight = 0
+
+    # Achieved bus throughput in bytes/s while writing
+    @property
+    def throughput(self):
+        if not self.elapsed:
+            return None
+        return self.bytes / self.elapsed
+
+    def _complete(self, transfer_p):
+        transfer = transfer_p.contents
+        if transfer.status != LIBUSB_TRANSFER_COMPLETED:
+            self._error = self._error or usb.core.USBError(f'Bulk transfer failed: status={transfer.status}',
+                                                           errno=LIBUSB_TRANSFER_ERRNO.get(transfer.status, errno.EIO))
+        elif transfer.actual_length != transfer.length:
+            self._error = self._error or usb.core.USBError(f'Short bulk transfer: {transfer.actual_length}/{transfer.length}',
+                                                           errno=errno.EIO)
+        self._idle.append(self._transfers[ctypes.addressof(transfer)])
+        self._in_flight -= 1
+
+    def _submit(self, address, length):
+        transfer = self._idle.pop()
+        t = transfer.contents
+        t.dev_handle = self.handle
+        t.flags = 0
+        t.endpoint = self.endpoint
+        t.type = LIBUSB_TRANSFER_TYPE_BULK
+        t.timeout = self.timeout
+        t.status = LIBUSB_TRANSFER_COMPLETED
+        t.length = length
+        t.actual_length = 0
+        t.callback = self._callback
+        t.user_data = None
+        t.buffer = address
+        ret = self.lib.libusb_submit_transfer(transfer)
+        if ret < 0:
+            self._idle.append(transfer)
+            self._error = usb.core.USBError(f'libusb_submit_transfer: {self.lib.libusb_error_name(ret).decode()}',
+                                            error_code=ret)
+            return False
+        self._in_flight += 1
+        self.transfers += 1
+        self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        return True
+
+    # The completion callbacks run from here
+    def _handle_events(self):
+        tv = timeval(0, 100000)
+        ret = self.lib.libusb_handle_events_timeout_completed(self.ctx, ctypes.byref(tv), None)
+        if ret < 0 and ret != -10: # LIBUSB_ERROR_INTERRUPTED
+            raise usb.core.USBError(f'libusb_handle_events: {self.lib.libusb_error_name(ret).decode()}', error_code=ret)
+
+    # Cancel the transfers in flight and wait for their completion callbacks
+    def _cancel(self):
+        idle = [ctypes.addressof(transfer.contents) for transfer in self._idle]
+        for address, transfer in self._transfers.items():
+            if address not in idle:
+                # Fails with LIBUSB_ERROR_NOT_FOUND if it has completed already
+                self.lib.libusb_cancel_transfer(transfer)
+
+        deadline = timer() + 2 * self.timeout / 1000
+        while self._in_flight and timer() < deadline:
+            try:
+                self._handle_events()
+            except usb.core.USBError:
+                pass
+
+    def write(self, buf, length):
+        arr = numpy.frombuffer(buf, dtype=numpy.uint8) # keeps buf alive until all transfers are done
+        address = arr.ctypes.data
+        self._error = None
+        offset = 0
+
+        start = timer()
+        try:
+            while offset < length or self._in_flight:
+                # Stop submitting on error but wait for what's in flight, the buffer is still in use
+                while offset < length and self._idle and self._error is None:
+                    size = min(self.transfer_size, length - offset)
+                    if not self._submit(address + offset, size):
+                        break
+                    offset += size
+                if self._error is not None and not self._in_flight:
+                    break
+                self._handle_events()
+        finally:
+            # Handling events failed (or was interrupted), the transfers in flight point into buf
+            # and the transfer structs so they have to be done before returning
+            if self._in_flight:
+                self._cancel()
+            self.elapsed += timer() - start
+
+        if self._error is not None:
+            raise self._error
+        self.writes += 1
+        self.bytes += length
+        return length
+
+    def close(self):
+        for transfer in self._transfers.values():
+            self.lib.libusb_free_transfer(transfer)
+        self._transfers = {}
+        self._idle = []
+
+    def __str__(self):
+        s = f'AsyncBulkWriter(depth={self.depth}, transfer_size={self.transfer_size // 1024} KiB, writes={self.writes}, max_in_flight={self.max_in_flight}'
+        if self.throughput:
+            s += f', {(self.throughput / 1000000):.1f} MB/s'
+        return s + ')'
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+import statistics
+import time
+from timeit import default_timer as timer
+
+
+# Paces flushes to the refresh rate of the mode (or a fraction of it) or to an explicit fps cap,
+# there's no point sending frames faster than the panel can show them.
+#
+# Call wait() before each frame. If the previous frame took so long that whole frame slots were
+# missed they are skipped instead of trying to catch up with a burst of frames.
+class FramePacer(object):
+    def __init__(self, state=None, fraction=1.0, fps=None, spin=0.001, history=600):
+        if fps is None:
+            if state is None or not state.vrefresh:
+                raise ValueError('Either fps or a state with a refresh rate is needed')
+            fps = state.vrefresh * fraction
+        self.fps = fps
+        self.interval = 1 / fps
+        # time.sleep() can overshoot by a scheduler tick, busy wait the last bit
+        self.spin = spin
+        self.frames = 0
+        self.skipped = 0
+        self._deadline = None
+        self._ticks = collections.deque(maxlen=history)
+        self._late = collections.deque(maxlen=history)
+
+    def reset(self):
+        self.frames = 0
+        self.skipped = 0
+        self._deadline = None
+        self._ticks.clear()
+        self._late.clear()
+
+    def sleep_until(self, deadline):
+        while True:
+            remaining = deadline - timer()
+            if remaining <= 0:
+                return
+            if remaining > self.spin:
+                time.sleep(remaining - self.spin)
+
+    # Wait for the next frame slot, returns the number of slots that were skipped
+    def wait(self):
+        now = timer()
+        skipped = 0
+        if self._deadline is None:
+            self._deadline = now
+        else:
+            self._deadline += self.interval
+            if now - self._deadline >= self.interval:
+                skipped = int((now - self._deadline) // self.interval)
+                self._deadline += skipped * self.interval
+                self.skipped += skipped
+            self.sleep_until(self._deadline)
+
+        tick = timer()
+        self._ticks.append(tick)
+        self._late.append(tick - self._deadline)
+        self.frames += 1
+        return skipped
+
+    # Achieved frames per second
+    @property
+    def cadence(self):
+        if len(self._ticks) < 2:
+            return None
+        return (len(self._ticks) - 1) / (self._ticks[-1] - self._ticks[0])
+
+    # Standard deviation of how late the frames started in seconds
+    @property
+    def jitter(self):
+        if len(self._late) < 2:
+            return None
+        return statistics.pstdev(self._late)
+
+    def __str__(self):
+        s = f'FramePacer(target={self.fps:.1f} fps'
+        if self.cadence:
+            s += f', achieved={self.cadence:.1f} fps, jitter={(self.jitter * 1000):.3f} ms'
+        return s + f', frames={self.frames}, skipped={self.skipped})'
@@ -0,0 +1,156 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import os
+import numpy
+from PIL import ImageColor
+from .gud_h import *
+from .cachedir import *
+
+
+# Bump when a pattern changes to invalidate the frames cached on disk
+PATTERN_VERSION = 1
+
+
+# The patterns are lists of (x, y, width, height, fill, outline) rectangles drawn in order,
+# the same rectangles the PIL drawing functions would draw.
+
+def _smpte_rects(rects, x, y, width, height, colors):
+    for i in range(len(colors)):
+        rects.append((x + (width * i), y, x + (width * (i + 1)), y + height, colors[i], colors[i]))
+
+def smpte_rects(width, height):
+    rects = []
+
+    # top colors: grey/silver, yellow, cyan, green, magenta, red, blue
+    w = width // 7
+    h = height * 6 // 9
+    _smpte_rects(rects, 0, 0, w, h, ['#c0c0c0', '#c0c000', '#00c0c0', '#00c000', '#c000c0', '#c00000', '#0000c0'])
+
+    # middle colors: blue, black magenta, black, cyan, black, grey
+    y = h
+    w = width / 7
+    h = height * 1 / 9
+    _smpte_rects(rects, 0, y, w, h, ['#0000c0', '#131313', '#c000c0', '#131313', '#00c0c0', '#131313', '#c0c0c0'])
+
+    # bottom colors: in-phase, super white, quadrature, black, 3.5%, 7.5%, 11.5%, black
+    y += h
+    w = width / 6
+    h = height * 2 / 9
+    _smpte_rects(rects, 0, y, w, h, ['#00214c', '#ffffff', '#32006a', '#131313'])
+
+    x = w * 4
+    w = width / 6 / 3
+    _smpte_rects(rects, x, y, w, h, ['#090909', '#131313', '#1d1d1d'])
+
+    x = width * 5 / 6
+    w = width / 6
+    _smpte_rects(rects, x, y, w, h, ['#131313'])
+    return rects
+
+# With a border to show framebuffer boundaries
+def smpte_border_rects(width, height):
+    return smpte_rects(width, height) + [(0, 0, width, height, None, 'white')]
+
+def xrgb1111_rects(width, height):
+    rects = []
+
+    # top colors: white, yellow, cyan, green, magenta, red, blue
+    w = width // 7
+    h = height * 6 // 9
+    _smpte_rects(rects, 0, 0, w, h, ['#ffffff', '#ffff00', '#00ffff', '#00ff00', '#ff00ff', '#ff0000', '#0000ff'])
+
+    # bottom colors: red, green, blue, black
+    y = h
+    w = width / 4
+    h = height * 3 / 9
+    _smpte_rects(rects, 0, y, w, h, ['#ff0000', '#00ff00', '#0000ff', '#000000'])
+
+    rects.append((0, 0, width, height, None, 'white'))
+    return rects
+
+def checkerboard_rects(width, height):
+    colors = ('#FFFFFF', '#000000')
+    num_width = 8
+    w = width // num_width
+    num_height = height // w
+    return [(x * w, y * w, w, w, colors[(x + y) % len(colors)], None)
+            for y in range(num_height) for x in range(num_width)]
+
+PATTERNS = {
+    'smpte': smpte_rects,
+    'smpte-border': smpte_border_rects,
+    'xrgb1111': xrgb1111_rects,
+    'checkerboard': checkerboard_rects,
+}
+
+
+# Rasterize a pattern to a (height, width, 3) RGB888 array.
+# Coordinates are truncated and the second corner is inclusive like PIL's ImageDraw.rectangle().
+# The rectangles are drawn as palette indices and expanded at the end so each pixel is written
+# once per rectangle covering it and only once in the output.
+def pattern_rgb888(name, width, height):
+    palette = [(0, 0, 0)]
+    index = numpy.zeros((height, width), dtype=numpy.uint8)
+
+    def color(c):
+        rgb = ImageColor.getrgb(c)[:3]
+        if rgb not in palette:
+            palette.append(rgb)
+        return palette.index(rgb)
+
+    for x, y, w, h, fill, outline in PATTERNS[name](width, height):
+        x0, y0, x1, y1 = int(x), int(y), int(x + w - 1), int(y + h - 1)
+        columns = slice(max(x0, 0), min(x1 + 1, width))
+        lines = slice(max(y0, 0), min(y1 + 1, height))
+        if fill is not None:
+            index[lines, columns] = color(fill)
+        if outline is not None:
+            c = color(outline)
+            for line in (y0, y1):
+                if 0 <= line < height:
+                    index[line, columns] = c
+            for column in (x0, x1):
+                if 0 <= column < width:
+                    index[lines, column] = c
+
+    return numpy.array(palette, dtype=numpy.uint8)[index]
+
+
+def pattern_cache_dir():
+    return cache_dir('patterns', 'GUD_PATTERN_CACHE')
+
+
+# Pattern frames converted to a pixel format stored as .npy files.
+# convert turns the RGB888 frame into the format, without fmt the RGB888 frame is cached.
+# Failing to write the cache is not an error, the frame is just generated the next time as well.
+class PatternCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory or pattern_cache_dir()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name, width, height, fmt=None):
+        fmt_name = format_to_name(fmt) if fmt else 'RGB888'
+        return os.path.join(self.directory, f'{name}-{width}x{height}-{fmt_name}-v{PATTERN_VERSION}.npy')
+
+    def load(self, name, width, height, fmt=None, convert=None):
+        path = self.path(name, width, height, fmt)
+        try:
+            frame = numpy.load(path)
+            self.hits += 1
+            return frame
+        except (OSError, ValueError):
+            pass
+
+        self.misses += 1
+        frame = pattern_rgb888(name, width, height)
+        if convert:
+            frame = convert(frame)
+        atomic_write(path, lambda f: numpy.save(f, frame))
+        return frame
+
+    def __str__(self):
+        return f'PatternCache({self.directory}, hits={self.hits}, misses={self.misses})'
+
+
+pattern_cache = PatternCache()
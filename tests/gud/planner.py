@@ -0,0 +1,74 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+from .gud_h import *
+
+
+Part = collections.namedtuple('Part', ['x', 'y', 'width', 'height', 'length'])
+
+def format_pixels_per_byte(fmt):
+    if fmt == GUD_PIXEL_FORMAT_R1:
+        return 8
+    elif fmt == GUD_PIXEL_FORMAT_XRGB1111:
+        return 2
+    return 1
+
+def format_cpp(fmt):
+    if fmt in (GUD_PIXEL_FORMAT_R8, GUD_PIXEL_FORMAT_RGB332):
+        return 1
+    elif fmt == GUD_PIXEL_FORMAT_RGB565:
+        return 2
+    elif fmt == GUD_PIXEL_FORMAT_RGB888:
+        return 3
+    elif fmt in (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888):
+        return 4
+    elif fmt in (GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_R1):
+        return 0
+    raise ValueError(f'Format 0x{fmt:02x} is not supported')
+
+# Payload bytes for one line of a rectangle, the packed formats pad each line to whole bytes
+def format_line_length(fmt, width):
+    cpp = format_cpp(fmt)
+    if cpp:
+        return width * cpp
+    ppb = format_pixels_per_byte(fmt)
+    return (width + ppb - 1) // ppb
+
+
+# Splits a rectangle into parts that fit the device buffer.
+#
+# part_size: Use parts smaller than the device maximum.
+# min_parts: Split rectangles bigger than min_part_size into at least this many parts. With
+#            compression the device can then decompress one part while the next is transferred.
+class BufferPlanner(object):
+    def __init__(self, part_size=None, min_parts=1, min_part_size=64 * 1024):
+        self.part_size = part_size
+        self.min_parts = min_parts
+        self.min_part_size = min_part_size
+
+    def max_part_size(self, fmt, width, height, max_size):
+        size = max_size
+        if self.part_size:
+            size = min(size, self.part_size)
+        length = format_line_length(fmt, width) * height
+        if self.min_parts > 1 and length > self.min_part_size:
+            size = min(size, max(self.min_part_size, (length + self.min_parts - 1) // self.min_parts))
+        return size
+
+    def plan(self, fmt, x, y, width, height, max_size):
+        size = self.max_part_size(fmt, width, height, max_size)
+
+        # Split into columns when a single line doesn't fit
+        columns = [(x, width)]
+        if format_line_length(fmt, width) > size:
+            cpp = format_cpp(fmt)
+            tile_width = size // cpp if cpp else size * format_pixels_per_byte(fmt)
+            columns = [(tx, min(tile_width, x + width - tx)) for tx in range(x, x + width, tile_width)]
+
+        parts = []
+        lines = max(1, size // format_line_length(fmt, columns[0][1]))
+        for ty in range(y, y + height, lines):
+            part_height = min(lines, y + height - ty)
+            for tx, tile_width in columns:
+                parts.append(Part(tx, ty, tile_width, part_height, format_line_length(fmt, tile_width) * part_height))
+        return parts
@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+import functools
+import lz4.block
+import numpy
+
+
+# Least recently used cache for functions returning (buffer, ...) that is bounded by the total
+# size of the cached buffers instead of the number of entries, whole frames add up quickly.
+# The wrapper has max_size, size and cache_clear() like functools.lru_cache has.
+def buffer_cache(max_size):
+    def decorator(func):
+        entries = collections.OrderedDict()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            ret = entries.get(key)
+            if ret is not None:
+                entries.move_to_end(key)
+                return ret
+            ret = func(*args, **kwargs)
+            size = len(ret[0])
+            if size > wrapper.max_size:
+                return ret
+            while entries and wrapper.size + size > wrapper.max_size:
+                _, evicted = entries.popitem(last=False)
+                wrapper.size -= len(evicted[0])
+            entries[key] = ret
+            wrapper.size += size
+            return ret
+
+        def cache_clear():
+            entries.clear()
+            wrapper.size = 0
+
+        wrapper.max_size = max_size
+        wrapper.size = 0
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+# Generate a buffer that LZ4 compresses to about size / ratio.
+#
+# The buffer is made of blocks that start with random bytes and end with zeroes. LZ4 emits the
+# random bytes as literals and the zeroes as a match costing about 1 byte per 255, so the
+# compressed size is close to the number of random bytes plus a fixed overhead. The overhead is
+# measured by compressing and the number of random bytes corrected, this converges in a couple of
+# compressions instead of zeroing a little at a time and recompressing.
+# Since every block has the same mix any part or band of the buffer has about the same ratio.
+#
+# ratio=0 gives a buffer of random bytes.
+# Returns the buffer and the ratio achieved (None for ratio=0). The results are cached up to
+# 128 MiB, callers that move on to another mode or format should call ratio_buffer.cache_clear().
+@buffer_cache(128 * 1024 * 1024)
+def ratio_buffer(size, ratio, seed=0, tolerance=0.02, block_size=4096):
+    rng = numpy.random.default_rng(seed)
+    if not ratio:
+        return rng.bytes(size), None
+
+    blocks = (size + block_size - 1) // block_size
+    data = numpy.frombuffer(rng.bytes(blocks * block_size), dtype=numpy.uint8).reshape(blocks, block_size)
+    columns = numpy.arange(block_size)
+    indices = numpy.arange(blocks + 1)
+
+    def build(literals):
+        # Spread the random bytes evenly over the blocks
+        ends = literals * indices // blocks
+        lengths = numpy.diff(ends)
+        buf = numpy.where(columns < lengths[:, None], data, 0).astype(numpy.uint8)
+        return buf.reshape(-1)[:size].tobytes()
+
+    want = size / ratio
+    literals = min(int(want), size)
+    for _ in range(8):
+        buf = build(literals)
+        compressed = len(lz4.block.compress(buf, store_size=False))
+        achieved = size / compressed
+        if abs(achieved - ratio) <= tolerance * ratio:
+            break
+        overhead = compressed - literals
+        adjusted = max(0, min(size, int(want - overhead)))
+        if adjusted == literals:
+            break
+        literals = adjusted
+    return buf, achieved
@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import collections
+import contextlib
+import threading
+from concurrent.futures import Future
+from timeit import default_timer as timer
+from .gud_h import *
+from .damage import *
+
+
+# submitted: When flush_async() was called for this frame
+# started/finished: When the flush that carried this frame started and finished
+# parts: Number of parts the flush was sent in
+# merged: Number of frames that were merged into the flush
+FlushResult = collections.namedtuple('FlushResult', ['submitted', 'started', 'finished', 'parts', 'merged'])
+
+
+# Sends flushes from a dedicated thread so the caller doesn't wait for the USB transfers.
+# At most one frame is pending: a frame submitted while another is waiting replaces it and
+# the damage of both is merged (like the kernel driver's async_flush), so a producer that
+# renders faster than the link can keep up with drops frames instead of building a backlog.
+# The image is read when the flush is sent, not when it's submitted.
+#
+# The sender retries busy requests with its own copy of the device's BusyRetry so two senders
+# don't share settings or counters. With coalesce a busy flush isn't retried when a newer frame
+# is waiting, the frame is merged into the newer one instead.
+class FlushSender(object):
+    def __init__(self, image):
+        self.image = image
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self._cond = threading.Condition()
+        self._pending = None
+        self._stop = False
+        retry = getattr(image.dev, 'busy_retry', None)
+        self.retry = retry.copy() if retry is not None else None
+        if self.retry is not None and self.retry.coalesce:
+            self.retry.newer = lambda: self._pending is not None
+        self._thread = threading.Thread(target=self._run, name='gud-sender', daemon=True)
+        self._thread.start()
+
+    def submit(self, x, y, width, height, compress=True):
+        future = Future()
+        with self._cond:
+            if self._stop:
+                raise RuntimeError('FlushSender is closed')
+            self.submitted += 1
+            if self._pending is None:
+                self._pending = (Damage(), [], compress)
+            else:
+                self.dropped += 1
+            damage, futures, _ = self._pending
+            damage.add(x, y, width, height)
+            futures.append((future, timer()))
+            # The latest frame decides
+            self._pending = (damage, futures, compress)
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stop:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                damage, futures, compress = self._pending
+                self._pending = None
+
+            started = timer()
+            try:
+                parts = 0
+                with self._thread_retry():
+                    for rect in damage:
+                        parts += self.image.flush(*rect, compress=compress)[1]
+            except Exception as e:
+                if self._coalesce(e, damage, futures):
+                    continue
+                for future, _ in futures:
+                    future.set_exception(e)
+                continue
+            finished = timer()
+
+            with self._cond:
+                self.sent += 1
+            for future, submitted in futures:
+                future.set_result(FlushResult(submitted, started, finished, parts, len(futures)))
+
+    def _thread_retry(self):
+        if self.retry is None:
+            return contextlib.nullcontext()
+        return self.image.dev.thread_retry(self.retry)
+
+    def _coalesce(self, e, damage, futures):
+        retry = self.retry
+        if retry is None or not retry.coalesce or getattr(e, 'status', None) != GUD_STATUS_BUSY:
+            return False
+        with self._cond:
+            if self._pending is None:
+                return False
+            pending, pending_futures, compress = self._pending
+            for rect in damage:
+                pending.add(*rect)
+            self._pending = (pending, futures + pending_futures, compress)
+            self.dropped += 1
+        return True
+
+    # Waits for the pending frame to be sent
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
+
+    def __str__(self):
+        return f'FlushSender(submitted={self.submitted}, sent={self.sent}, dropped={self.dropped})'
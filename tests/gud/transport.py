@@ -0,0 +1,335 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import array
+import errno
+import json
+import os
+import struct
+import time
+from timeit import default_timer as timer
+import numpy
+import usb.core
+import usb.util
+from .libusb_async import *
+
+
+# The I/O a gud.Device does. PyUSBTransport talks to a real device, RecordTransport logs what
+# another transport does to a file and ReplayTransport plays that file back without a device.
+# Failures are raised as usb.core.USBError like pyusb does, a stall has errno EPIPE.
+class Transport(object):
+    # Vendor request to the GUD interface. buf is the data for OUT and the buffer (or length) to
+    # read into for IN. Returns the data read for IN and the number of bytes sent for OUT.
+    def control(self, _in, request, value, buf):
+        raise NotImplementedError
+
+    def bulk_write(self, buf, length):
+        raise NotImplementedError
+
+    # (idVendor, idProduct, bcdDevice, serial number or None)
+    def ids(self):
+        raise NotImplementedError
+
+    # Returns an AsyncBulkWriter that bulk_write() uses from now on
+    def async_bulk(self, depth, transfer_size):
+        raise NotImplementedError(f'{type(self).__name__} has no asynchronous bulk transfers')
+
+    def reset(self):
+        pass
+
+    def is_kernel_driver_active(self):
+        return False
+
+    def detach_kernel_driver(self):
+        pass
+
+    def attach_kernel_driver(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# pyusb hands array('B') objects straight to libusb using buffer_info(), anything else is first
+# copied into a new array. This array is empty but points libusb at the memory of another buffer
+# so bytes, bytearrays, memoryviews and NumPy arrays can be sent without a copy.
+#
+# This depends on pyusb internals (checked with pyusb 1.3.1): Endpoint.write() passing the data
+# through usb._interop.as_array(), which returns array('B') objects as they are, and the backends
+# only looking at buffer_info(). BUFFER_ARRAY_ZERO_COPY checks the first part, when it's False
+# PyUSBTransport.bulk_write() copies the data instead.
+class BufferArray(array.array):
+    def __new__(cls):
+        return super().__new__(cls, 'B')
+
+    def __init__(self):
+        self.set(None)
+
+    def set(self, buf):
+        self._buf = buf # keep it alive until the transfer is done
+        if buf is None:
+            self._info = (0, 0)
+        else:
+            arr = numpy.frombuffer(buf, dtype=numpy.uint8)
+            self._info = (arr.ctypes.data, arr.nbytes)
+
+    def buffer_info(self):
+        return self._info
+
+
+def buffer_array_zero_copy():
+    try:
+        from usb._interop import as_array
+    except ImportError:
+        return False
+    arr = BufferArray()
+    return as_array(arr) is arr
+
+BUFFER_ARRAY_ZERO_COPY = buffer_array_zero_copy()
+
+
+class PyUSBTransport(Transport):
+    def __init__(self, dev):
+        self.dev = dev
+        self._interface = None
+        self.ep = None
+        # Reused for every bulk transfer, see bulk_write()
+        self._bulk_buffer = BufferArray()
+        self.bulk_writer = None
+
+    @property
+    def interface(self):
+        if self._interface is not None:
+            return self._interface
+
+        try:
+            self.dev.set_configuration()
+        except usb.core.USBError as e:
+            if e.errno != errno.EBUSY:
+                raise e from None
+        # Pick the first Vendor Class Interface
+        for itf in self.dev.get_active_configuration():
+            if itf.bInterfaceClass == 0xff:
+                self._interface = itf
+                break
+        assert self._interface is not None
+        self.ep = usb.util.find_descriptor(
+            self._interface,
+            # match the first OUT endpoint
+            custom_match = lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        assert self.ep is not None
+
+        return self._interface
+
+    def control(self, _in, request, value, buf):
+        requesttype = usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_INTERFACE;
+        if _in:
+            requesttype |= usb.util.CTRL_IN;
+
+        return self.dev.ctrl_transfer(requesttype, request, value, self.interface.bInterfaceNumber,
+                                      data_or_wLength = buf, timeout = None)
+
+    def bulk_write(self, buf, length):
+        if self.bulk_writer is not None:
+            return self.bulk_writer.write(buf, length)
+        if self.ep is None:
+            self.interface # looks up the endpoint
+        if not BUFFER_ARRAY_ZERO_COPY:
+            ret = self.ep.write(numpy.frombuffer(buf, dtype=numpy.uint8)[:length].tobytes())
+            assert ret == length
+            return ret
+        self._bulk_buffer.set(buf)
+        try:
+            ret = self.ep.write(self._bulk_buffer, length)
+        finally:
+            self._bulk_buffer.set(None)
+        assert ret == len(buf)
+        return ret
+
+    def ids(self):
+        try:
+            serial = self.dev.serial_number if self.dev.iSerialNumber else None
+        except (usb.core.USBError, ValueError):
+            serial = None
+        return self.dev.idVendor, self.dev.idProduct, self.dev.bcdDevice, serial
+
+    # Needs the libusb1 pyusb backend
+    def async_bulk(self, depth, transfer_size):
+        self.interface # looks up the endpoint
+        usb.util.claim_interface(self.dev, self.interface)
+        self.bulk_writer = AsyncBulkWriter(self.dev, self.ep.bEndpointAddress, depth, transfer_size, self.ep.wMaxPacketSize)
+        return self.bulk_writer
+
+    def reset(self):
+        self.dev.reset()
+
+    def is_kernel_driver_active(self):
+        return self.dev.is_kernel_driver_active(self.interface.bInterfaceNumber)
+
+    def detach_kernel_driver(self):
+        self.dev.detach_kernel_driver(self.interface.bInterfaceNumber)
+
+    def attach_kernel_driver(self):
+        self.dev.attach_kernel_driver(self.interface.bInterfaceNumber)
+
+    def close(self):
+        if self.bulk_writer is not None:
+            self.bulk_writer.close()
+            self.bulk_writer = None
+
+    def __str__(self):
+        return f'{self.dev}'
+
+
+# Recording file:
+#   RECORD_MAGIC
+#   ids() as a JSON line
+#   records: RECORD header followed by the data sent (control OUT) or read (control IN).
+#            Bulk data isn't stored, only its length.
+# start is seconds since the recording started, duration is how long the transfer took and
+# result is the return value or -errno if it failed.
+RECORD_MAGIC = b'GUDREC1\n'
+RECORD = struct.Struct('<BBHIidf') # kind, request, value, length, result, start, duration
+
+RECORD_CONTROL_OUT = 0
+RECORD_CONTROL_IN = 1
+RECORD_BULK = 2
+
+def record_kind_to_str(kind):
+    return {
+        RECORD_CONTROL_OUT: 'control OUT',
+        RECORD_CONTROL_IN: 'control IN',
+        RECORD_BULK: 'bulk',
+    }.get(kind, str(kind))
+
+
+class RecordTransport(Transport):
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self.records = 0
+        self._file = open(path, 'wb')
+        self._file.write(RECORD_MAGIC)
+        self._file.write(json.dumps(transport.ids()).encode() + b'\n')
+        self._start = timer()
+
+    def _record(self, kind, request, value, length, func, data=None):
+        start = timer()
+        try:
+            ret = func()
+        except usb.core.USBError as e:
+            self._write(kind, request, value, length, -(e.errno or errno.EIO), start, data)
+            raise
+        if kind == RECORD_CONTROL_IN:
+            self._write(kind, request, value, length, len(ret), start, bytes(ret))
+        else:
+            self._write(kind, request, value, length, ret, start, data)
+        return ret
+
+    def _write(self, kind, request, value, length, result, start, data):
+        duration = timer() - start
+        self._file.write(RECORD.pack(kind, request, value, length, result, start - self._start, duration))
+        if data:
+            self._file.write(data)
+        self.records += 1
+
+    def control(self, _in, request, value, buf):
+        func = lambda: self.transport.control(_in, request, value, buf)
+        if _in:
+            length = buf if isinstance(buf, int) else len(buf)
+            return self._record(RECORD_CONTROL_IN, request, value, length, func)
+        data = bytes(buf) if buf else b''
+        return self._record(RECORD_CONTROL_OUT, request, value, len(data), func, data)
+
+    def bulk_write(self, buf, length):
+        return self._record(RECORD_BULK, 0, 0, length, lambda: self.transport.bulk_write(buf, length))
+
+    def ids(self):
+        return self.transport.ids()
+
+    def async_bulk(self, depth, transfer_size):
+        return self.transport.async_bulk(depth, transfer_size)
+
+    def reset(self):
+        self.transport.reset()
+
+    def is_kernel_driver_active(self):
+        return self.transport.is_kernel_driver_active()
+
+    def detach_kernel_driver(self):
+        self.transport.detach_kernel_driver()
+
+    def attach_kernel_driver(self):
+        self.transport.attach_kernel_driver()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        self.transport.close()
+
+    def __str__(self):
+        return f'RecordTransport({self.transport} > {self.path})'
+
+
+class ReplayError(Exception):
+    pass
+
+
+# Serves the responses from a recording. The requests have to come in the recorded order, the
+# kind, request and value are checked but the OUT data and bulk lengths are not so a frame with
+# different content still replays.
+#
+# timing: Each transfer takes as long as it did when recorded
+class ReplayTransport(Transport):
+    def __init__(self, path, timing=False):
+        self.path = path
+        self.timing = timing
+        with open(path, 'rb') as f:
+            if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+                raise ReplayError(f'{path}: Not a GUD recording')
+            self._ids = tuple(json.loads(f.readline()))
+            data = f.read()
+
+        self.records = []
+        offset = 0
+        while offset < len(data):
+            kind, request, value, length, result, start, duration = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            size = 0
+            if kind == RECORD_CONTROL_OUT:
+                size = length
+            elif kind == RECORD_CONTROL_IN and result > 0:
+                size = result
+            self.records.append((kind, request, value, result, duration, data[offset:offset + size]))
+            offset += size
+        self.index = 0
+
+    def _next(self, kind, request, value):
+        if self.index >= len(self.records):
+            raise ReplayError(f'{self.path}: Recording ended, {record_kind_to_str(kind)} request=0x{request:02x} not recorded')
+        rkind, rrequest, rvalue, result, duration, data = self.records[self.index]
+        if (rkind, rrequest, rvalue) != (kind, request, value):
+            raise ReplayError(f'{self.path}: Record {self.index} is {record_kind_to_str(rkind)} request=0x{rrequest:02x} value={rvalue}, ' +
+                              f'got {record_kind_to_str(kind)} request=0x{request:02x} value={value}')
+        self.index += 1
+        if self.timing:
+            time.sleep(duration)
+        if result < 0:
+            raise usb.core.USBError(os.strerror(-result), errno=-result)
+        return result, data
+
+    def control(self, _in, request, value, buf):
+        if _in:
+            result, data = self._next(RECORD_CONTROL_IN, request, value)
+            return array.array('B', data)
+        result, data = self._next(RECORD_CONTROL_OUT, request, value)
+        return result
+
+    def bulk_write(self, buf, length):
+        result, data = self._next(RECORD_BULK, 0, 0)
+        return result
+
+    def ids(self):
+        return self._ids
+
+    def __str__(self):
+        return f'ReplayTransport({self.path}, record {self.index}/{len(self.records)})'
@@ -9,30 +9,44 @@ from time import sleep
 from gud import *
 
 
-def compression_ratio(dev, state, ratio, iterations):
+def compression_ratio(dev, state, ratio, iterations, pipeline=False, compressor=None, policy=None, cache=None, planner=None):
     img = Image(dev, state.format, state.mode)
-    length = img.random(ratio)
+    img.planner = planner or img.planner
+    img.payload_cache = cache
+    img.compressor = compressor
+    img.compression_policy = policy
+    achieved = img.random(ratio)
     elapsed = []
     for x in range(iterations):
-        t, parts = img.flush(use_cached=x)
+        t, parts = img.flush(use_cached=x, pipeline=pipeline)
         elapsed.append(t)
     if iterations > 5:
         elapsed.pop(0) # Remove the outlier (includes PIL image conversion time)
-    return min(elapsed), statistics.mean(elapsed), max(elapsed), parts
+    return min(elapsed), statistics.mean(elapsed), max(elapsed), parts, achieved
 
-def no_compression(dev, state, iterations):
+def no_compression(dev, state, iterations, pipeline=False, cache=None, planner=None):
     if state.format < GUD_PIXEL_FORMAT_XRGB1111:
-        img = checkerboard_image(dev, state.format, state.mode)
+        img = checkerboard_image(dev, state.format, state.mode, native=True)
     else:
-        img = smpte_image(dev, state.format, state.mode, text=str(state))
+        img = smpte_image(dev, state.format, state.mode, text=str(state), native=True)
+    img.payload_cache = cache
+    img.planner = planner or img.planner
     elapsed = []
     for x in range(iterations):
-        t, parts = img.flush(compress=False, use_cached=x)
+        t, parts = img.flush(compress=False, use_cached=x, pipeline=pipeline)
         elapsed.append(t)
     if iterations > 5:
         elapsed.pop(0) # Remove the outlier (includes PIL image conversion time)
     return min(elapsed), statistics.mean(elapsed), max(elapsed), parts
 
+# Send the same frame at the paced rate to see if the link keeps up
+def paced(dev, state, iterations, pacer, compress):
+    img = Image(dev, state.format, state.mode)
+    img.random(4 if compress else 0)
+    for x in range(iterations):
+        pacer.wait()
+        img.flush(compress=compress)
+
 
 def device_arg_split(arg):
     vid, pid = str(arg).split(':')
@@ -47,51 +61,115 @@ def main(args):
             print(f'Format not recognized: {args.format}')
             return
 
+    transport = ReplayTransport(args.replay, args.timing) if args.replay else None
+    # there's no display to wait for when replaying
+    settle = 0 if args.replay else 1
+
     if args.device:
         vid, pid = device_arg_split(args.device)
-        gud = find_first_setup(idVendor=vid, idProduct=pid)
+        gud = find_first_setup(args.metadata_cache, transport, args.record, idVendor=vid, idProduct=pid)
     else:
-        gud = find_first_setup()
+        gud = find_first_setup(args.metadata_cache, transport, args.record)
 
     if not gud:
         print('Failed to find a GUD device')
         return
 
+    if args.smallest:
+        fmt = smallest_format(gud.formats)
+
+    print(f'Control transfers at startup: {gud.control_transfers}')
+
+    gud.status_policy = args.status
+    gud.status_interval = args.status_interval
+    status_on_set = gud.flags & GUD_DISPLAY_FLAG_STATUS_ON_SET
+    gud.busy_retry = BusyRetry(attempts=args.busy_attempts) if args.busy_attempts else None
+    if status_on_set:
+        print(f'Status policy: {gud.status_policy}')
+
+    if args.queue_depth:
+        gud.async_bulk(args.queue_depth, args.transfer_size * 1024)
+
     gud.controller_enable()
 
+    compressor = BandCompressor(args.bands) if args.bands else None
+    cache = PayloadCache() if args.cache else None
+    planner = BufferPlanner(args.part_size * 1024, args.min_parts)
+
     print(f'Iterations: {args.iterations}\n')
 
     for state in states(gud, args.preferred_mode, fmt):
         print(state)
         gud.commit(state)
         # give time for modesetting to happen, at least the Pi is slow
-        sleep(3)
+        sleep(3 * settle)
 
         if gud.descriptor.compression & GUD_COMPRESSION_LZ4 and not args.no_compress:
             ratios = (None, 0, 1, 2, 3, 4, 8, 16)
         else:
             ratios = (None,)
 
+        pipelines = (False, True) if args.pipeline else (False,)
+
         for ratio in ratios:
-            if ratio is None:
-                print(f'  No compress : ', flush=True, end='')
-                tmin, tmean, tmax, parts = no_compression(gud, state, args.iterations)
-            else:
-                sr = f'x{ratio:d}'
-                print(f'  Compress {sr:>3}: ', flush=True, end='')
-                tmin, tmean, tmax, parts = compression_ratio(gud, state, ratio, args.iterations)
-            split = f'(split:{parts})' if parts > 1 else ''
-            print(f'{(1 / tmin):4.1f} > {(1 / tmean):4.1f} > {(1 / tmax):4.1f} fps ({(tmean * 1000):.3f} ms) {split}')
-            # keep the last frame visible for a bit
-            sleep(0.5)
+            for pipeline in pipelines:
+                name = ' pipelined' if pipeline else ''
+                gud.status_polls = 0
+                gud.status_time = 0.0
+                if ratio is None:
+                    print(f'  No compress{name} : ', flush=True, end='')
+                    tmin, tmean, tmax, parts = no_compression(gud, state, args.iterations, pipeline, cache, planner)
+                    achieved = None
+                else:
+                    sr = f'x{ratio:d}'
+                    print(f'  Compress {sr:>3}{name}: ', flush=True, end='')
+                    policy = AdaptiveCompression() if args.adaptive else None
+                    tmin, tmean, tmax, parts, achieved = compression_ratio(gud, state, ratio, args.iterations, pipeline, compressor, policy, cache, planner)
+                gud.check_status()
+                split = f'(split:{parts})' if parts > 1 else ''
+                bands = ''
+                if compressor and ratio is not None:
+                    bands = 'bands: ' + ' '.join([f'{r:.1f}' for r in compressor.ratios])
+                achieved = f'(x{achieved:.2f})' if achieved else ''
+                status = ''
+                if status_on_set:
+                    status = f'status: {gud.status_polls} in {(gud.status_time * 1000):.3f} ms'
+                print(f'{(1 / tmin):4.1f} > {(1 / tmean):4.1f} > {(1 / tmax):4.1f} fps ({(tmean * 1000):.3f} ms) {achieved} {split} {bands} {status}')
+                if args.adaptive and ratio is not None:
+                    print(f'    {policy}')
+                # keep the last frame visible for a bit
+                sleep(0.5 * settle)
+
+        if args.rate or args.fps:
+            pacer = FramePacer(state, args.rate or 1.0, args.fps)
+            print(f'  Paced at {pacer.fps:.1f} fps: ', flush=True, end='')
+            paced(gud, state, args.iterations, pacer, len(ratios) > 1)
+            print(pacer)
+        if gud.bulk_writer:
+            print(f'  {gud.bulk_writer}')
+            gud.bulk_writer.reset()
+        if gud.busy_retry and gud.busy_retry.busy:
+            print(f'  {gud.busy_retry}')
+            gud.busy_retry.reset()
+        # the buffers only fit this mode and format
+        ratio_buffer.cache_clear()
         print()
 
+    if compressor:
+        compressor.close()
+    if cache:
+        print(cache)
+
     if not args.keep:
         gud.disable()
         gud.controller_disable()
         # This didn't work gives -EBUSY
         #gud.attach_kernel_driver()
 
+    gud.transport.close()
+    if args.record:
+        print(f'Recorded {gud.transport.records} transfers to {args.record}')
+
 
 def device_arg_check(arg):
     try:
@@ -115,11 +193,29 @@ By default runs performance tests on:
 - all modes covered by {modes} (if not use all modes)
 ''')
     parser.add_argument('--device', '-D', type=device_arg_check, help='Device to monitor: vid:pid (in hexadecimal)')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='Only compress when it is estimated to pay off')
+    parser.add_argument('-A', '--busy-attempts', type=int, default=10, help='Retry requests the device is busy with this many times (default=10, 0: disabled)')
+    parser.add_argument('-b', '--bands', type=int, default=0, help='Compress in this many bands concurrently (default=0: disabled)')
+    parser.add_argument('-F', '--fps', type=float, help='Also run a paced test capped at this fps')
+    parser.add_argument('-c', '--cache', action='store_true', help='Cache compressed buffers and requests, repeated frames only cost the transfer')
     parser.add_argument('-i', '--iterations', type=int, default=10, help='Number of flushes per test (default=10)')
+    parser.add_argument('-M', '--metadata-cache', action='store_true', help='Cache what the device reports about itself on disk for the next run')
     parser.add_argument('-k', '--keep', action='store_true', help="Don't disable display")
+    parser.add_argument('-m', '--min-parts', type=int, default=1, help='Split frames into at least this many parts (default=1)')
     parser.add_argument('-n', '--no-compress', action='store_true', help="Don't do the compression tests")
+    parser.add_argument('-P', '--pipeline', action='store_true', help='Also run each test with pipelined flushing (only differs on split frames)')
+    parser.add_argument('-q', '--queue-depth', type=int, default=0, help='Use libusb asynchronous bulk transfers with this many in flight (default=0: pyusb synchronous)')
+    parser.add_argument('-T', '--transfer-size', type=int, default=256, help='Size of each asynchronous bulk transfer in KiB (default=256)')
+    parser.add_argument('-w', '--record', metavar='FILE', help='Record the USB transfers to FILE')
+    parser.add_argument('-R', '--replay', metavar='FILE', help='Run without a device by replaying a recording made with the same options')
+    parser.add_argument('-t', '--timing', action='store_true', help='Make replayed transfers take as long as they did when recorded')
+    parser.add_argument('-r', '--rate', type=float, help='Also run a paced test at this fraction of the refresh rate')
+    parser.add_argument('-s', '--part-size', type=int, default=0, help='Maximum part size in KiB (default=0: device maximum)')
     parser.add_argument('-p', '--preferred-mode', action='store_true', help='Only use the preferred mode')
-    parser.add_argument('-f', '--format', help='Only use the specified format (ARGB8888, XRGB8888, RGB565, XRGB1111, R1)')
+    parser.add_argument('-f', '--format', help='Only use the specified format (ARGB8888, XRGB8888, RGB888, RGB565, RGB332, XRGB1111, R8, R1)')
+    parser.add_argument('-C', '--status', choices=STATUS_POLICIES, default=STATUS_POLICY_ALWAYS, help='When to check the status after SET requests (default=always)')
+    parser.add_argument('-N', '--status-interval', type=int, default=8, help='Check the status after every Nth SET request with --status=sampled (default=8)')
+    parser.add_argument('-S', '--smallest', action='store_true', help='Only use the supported color format that needs the least bandwidth')
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: CC0-1.0
+
+import argparse
+import ctypes
+import gc
+import os
+import statistics
+import sys
+import time
+from timeit import default_timer as timer
+import lz4.block
+import numpy
+from gud import *
+
+
+def make_mode(width, height):
+    mode = gud_drm_req_display_mode()
+    mode.hdisplay = width
+    mode.vdisplay = height
+    return mode
+
+# Stands in for a device when flushing, the requests and transfers are dropped.
+# link_speed (bytes/s) makes the transfers take time like they would on the wire.
+class NullDevice(object):
+    def __init__(self, compression=GUD_COMPRESSION_LZ4, max_buffer_size=4 * 1024 * 1024, link_speed=None):
+        self.descriptor = gud_drm_usb_vendor_descriptor()
+        self.descriptor.compression = compression
+        self.max_buffer_size = max_buffer_size
+        self.link_speed = link_speed
+
+    def req_set_buffer(self, req):
+        pass
+
+    def bulk_write(self, buf, length):
+        if self.link_speed:
+            time.sleep(length / self.link_speed)
+
+# Peak RSS since the last reset in bytes, the reset needs Linux 4.0.
+# Memory freed by the setup is given back first, otherwise the flush can reuse it without raising RSS.
+def reset_peak_rss():
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def rss(name='VmRSS'):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(name + ':'):
+                return int(line.split()[1]) * 1024
+
+def timeit(func, iterations):
+    elapsed = []
+    for _ in range(iterations):
+        start = timer()
+        func()
+        elapsed.append(timer() - start)
+    return min(elapsed), statistics.mean(elapsed)
+
+
+def bench_convert(mode, args):
+    print('  Converters, full frame (MB/s of device format data, Image.data() also in ms/Mpix):')
+    print(f'    {"":>8}  {"from RGB888":>12}  {"to RGB888":>12}  {"Image.data()":>12}  {"ms/Mpix":>22}')
+    mpix = mode.hdisplay * mode.vdisplay / 1000000
+    rgb888 = numpy.frombuffer(os.urandom(mode.hdisplay * mode.vdisplay * 3), dtype=numpy.uint8)
+    rgb888 = rgb888.reshape(mode.vdisplay, mode.hdisplay, 3)
+    for fmt in CONVERTERS:
+        if fmt == GUD_PIXEL_FORMAT_ARGB8888:
+            continue
+        native = rgb888_to_format(fmt, rgb888)
+        mb = native.nbytes / 1000000
+        img = Image(None, fmt, mode)
+        img.image.frombytes(rgb888.tobytes(), 'raw', 'RGB')
+
+        result = []
+        for func in (lambda: rgb888_to_format(fmt, rgb888),
+                     lambda: format_to_rgb888(fmt, native, mode.hdisplay),
+                     lambda: img.data(0, 0, img.width, img.height)):
+            tmin, tmean = timeit(func, args.iterations)
+            result.append(f'{(mb / tmean):12.1f}')
+        # the last one is Image.data()
+        result.append(f'{(tmean * 1000 / mpix):7.3f} (min {(tmin * 1000 / mpix):7.3f})')
+        print(f'    {format_to_name(fmt):>8}  ' + '  '.join(result))
+
+
+def bench_native(mode, args):
+    print('  Image.data() full frame, PIL RGB vs native backing store:')
+    for fmt in CONVERTERS:
+        if fmt == GUD_PIXEL_FORMAT_ARGB8888:
+            continue
+        result = []
+        for native in (False, True):
+            img = Image(None, fmt, mode, native=native)
+            img.random()
+            tmin, tmean = timeit(lambda: img.data(0, 0, img.width, img.height), args.iterations)
+            result.append(tmean)
+        print(f'    {format_to_name(fmt):>8}: {(result[0] * 1000):8.3f} ms > {(result[1] * 1000):8.3f} ms')
+
+
+def bench_diff(mode, args):
+    print(f'  Frame diff against the last transmitted frame (tile={args.tile}):')
+    for native in (False, True):
+        img = Image(None, GUD_PIXEL_FORMAT_XRGB8888, mode, native=native)
+        full = img.width * img.height * 4
+        img._last = img._frame().copy()
+
+        compare = []
+        sent = 0
+        for i in range(args.iterations):
+            # A dashboard that redraws everything and only a counter changes
+            draw_smpte_pattern(img)
+            img.rectangle(img.width // 2, img.height // 2, 200, 40, fill='black')
+            img.text(f'{i:06d}', x=img.width // 2, y=img.height // 2, color='white')
+
+            start = timer()
+            damage = img.diff(args.tile)
+            compare.append(timer() - start)
+            for rect in damage:
+                sent += len(img.data(*rect))
+            img._last = img._frame().copy()
+
+        saved = 100 * (1 - sent / (full * args.iterations))
+        name = 'native' if native else 'PIL'
+        print(f'    {name:>6}: compare {(statistics.mean(compare) * 1000):.3f} ms, {saved:.1f}% bytes saved')
+
+
+def bench_bands(mode, args):
+    workers = os.cpu_count() or 1
+    print(f'  LZ4 compression of a full XRGB8888 frame, single vs {workers} bands on {workers} cores:')
+    img = Image(None, GUD_PIXEL_FORMAT_XRGB8888, mode, native=True)
+    img.random(4)
+    buf = img.data(0, 0, img.width, img.height)
+
+    tmin, single = timeit(lambda: lz4.block.compress(buf, return_bytearray=True, store_size=False), args.iterations)
+    compressor = BandCompressor()
+    line_length = len(buf) // img.height
+    bufs = [buf[y * line_length : (y + lines) * line_length] for y, lines in compressor.split(img.height)]
+    tmin, bands = timeit(lambda: compressor.compress(bufs), args.iterations)
+    compressor.close()
+
+    ratios = ' '.join([f'{ratio:.1f}' for ratio in compressor.ratios])
+    print(f'    {(single * 1000):.3f} ms > {(bands * 1000):.3f} ms (band ratios: {ratios})')
+
+
+def bench_text(mode, args):
+    print('  Image.text(fraction=0.5) labels, cold vs cached fonts:')
+    img = Image(None, GUD_PIXEL_FORMAT_XRGB8888, mode, native=True)
+    label = f'{mode.hdisplay}x{mode.vdisplay}-60@XRGB8888'
+
+    def cold():
+        fit_font.cache_clear()
+        truetype.cache_clear()
+        img.text(label, fraction=0.5, color='white')
+
+    tmin, uncached = timeit(cold, args.iterations)
+    tmin, cached = timeit(lambda: img.text(label, fraction=0.5, color='white'), args.iterations)
+    print(f'    {(1 / uncached):8.1f} > {(1 / cached):8.1f} labels/s ({(uncached * 1000):.3f} ms > {(cached * 1000):.3f} ms)')
+
+
+def bench_patterns(mode, args):
+    print('  SMPTE frame, drawn with PIL vs loaded from the pattern cache:')
+    for fmt in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_XRGB8888):
+        def drawn():
+            img = Image(None, fmt, mode)
+            draw_smpte_pattern(img)
+            img.data(0, 0, img.width, img.height)
+
+        tmin, pil = timeit(drawn, args.iterations)
+        tmin, cached = timeit(lambda: Image(None, fmt, mode, native=True).pattern('smpte'), args.iterations)
+        print(f'    {format_to_name(fmt):>8}: {(pil * 1000):8.3f} ms > {(cached * 1000):8.3f} ms')
+
+
+def bench_stream(mode, args):
+    print('  Peak RSS during a compressed XRGB8888 full frame flush, flush() vs flush_stream():')
+    for native in (False, True):
+        result = []
+        for stream in (False, True):
+            img = Image(NullDevice(), GUD_PIXEL_FORMAT_XRGB8888, mode, native=native)
+            img.random(4)
+            flush = img.flush_stream if stream else img.flush
+            reset_peak_rss()
+            before = rss()
+            t = timer()
+            flush()
+            elapsed = timer() - t
+            result.append((rss('VmHWM') - before, elapsed))
+            del img, flush
+        name = 'native' if native else 'PIL'
+        (flush_peak, flush_time), (stream_peak, stream_time) = result
+        print(f'    {name:>6}: {(flush_peak / 1000000):6.1f} MB > {(stream_peak / 1000000):6.1f} MB ' +
+              f'({(flush_time * 1000):.3f} ms > {(stream_time * 1000):.3f} ms)')
+
+
+def bench_glyphs(mode, args):
+    print('  Counter updates on a native image, Image.text() vs glyph atlas TextLabel:')
+    for fmt in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_XRGB8888):
+        result = []
+        for atlas in (False, True):
+            img = Image(None, fmt, mode, native=True)
+            label = TextLabel(img, 10, 10)
+            count = [0]
+
+            def update():
+                count[0] += 1
+                text = f'{count[0]:08d}'
+                if atlas:
+                    label.set(text)
+                else:
+                    img.rectangle(10, 10, 8 * 6, 11, fill='black')
+                    img.text(text, 10, 10, color='white')
+
+            tmin, tmean = timeit(update, max(args.iterations, 100))
+            result.append(tmean)
+        print(f'    {format_to_name(fmt):>8}: {(1 / result[0]):9.0f} > {(1 / result[1]):9.0f} updates/s')
+
+
+def bench_swap(mode, args):
+    print('  Draw heavy animation over a 40 MB/s link, flush() vs double buffered swap():')
+    frames = max(args.iterations, 20)
+    for native in (False, True):
+        result = []
+        for swap in (False, True):
+            img = Image(NullDevice(link_speed=40000000), GUD_PIXEL_FORMAT_RGB565, mode, native=native)
+            w = img.width // 8
+
+            start = timer()
+            for i in range(frames):
+                img.rectangle(0, 0, img.width, img.height, fill='black')
+                for y in range(0, img.height, w):
+                    for x in range(0, img.width, w):
+                        img.rectangle(x + i % w, y, w // 2, w // 2, fill='#c0c000' if (x + y) // w % 2 else '#00c0c0')
+                img.text(f'Frame {i}', fraction=0.3, color='white')
+                if swap:
+                    img.swap(compress=False)
+                else:
+                    img.flush(compress=False)
+            img.close()
+            result.append(frames / (timer() - start))
+        name = 'native' if native else 'PIL'
+        print(f'    {name:>6}: {result[0]:5.1f} > {result[1]:5.1f} fps')
+
+
+def mode_arg(arg):
+    try:
+        width, height = [int(v) for v in str(arg).split('x')]
+    except Exception:
+        raise argparse.ArgumentTypeError('Value has to be on the form: WIDTHxHEIGHT')
+    return width, height
+
+
+if __name__ == '__main__':
+    benchmarks = [name[6:] for name in globals().keys() if name.startswith('bench_')]
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=f'''
+GUD image micro-benchmarks
+
+Measures the host side of the direct path (gud.Image) without a device.
+''')
+    parser.add_argument('benchmarks', nargs='*', default=benchmarks, help=f'Benchmarks: {" ".join(benchmarks)}')
+    parser.add_argument('-m', '--mode', type=mode_arg, default=(1920, 1080), help='Mode size (default=1920x1080)')
+    parser.add_argument('-i', '--iterations', type=int, default=10, help='Number of runs per benchmark (default=10)')
+    parser.add_argument('-t', '--tile', type=int, default=64, help='Tile size for frame diffing (default=64)')
+    args = parser.parse_args()
+
+    if not set(args.benchmarks).issubset(benchmarks):
+        print('Unknown benchmarks:', ' '.join(set(args.benchmarks) - set(benchmarks)))
+        sys.exit(1)
+
+    mode = make_mode(*args.mode)
+    print(f'{mode.hdisplay}x{mode.vdisplay}, iterations: {args.iterations}\n')
+    for name in args.benchmarks:
+        globals()['bench_' + name](mode, args)
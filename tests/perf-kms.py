@@ -10,30 +10,7 @@ from time import sleep
 from timeit import default_timer as timer
 import pykms
 
-import lz4.block
-
-def random(size, ratio):
-    if ratio == 0:
-        return bytes(os.urandom(size))
-
-    zeroes = size - (size // ratio)
-    buf = bytearray(zeroes) + bytearray(os.urandom(size - zeroes))
-
-    want = len(buf) // ratio
-    i = zeroes
-    while i < size:
-        compressed = lz4.block.compress(buf, return_bytearray=True, store_size=False)
-        if len(compressed) <= want:
-            break
-        stride = (len(compressed) - want + 1) // 2
-        if not stride:
-            stride = 1
-        buf[i : i + stride] = bytearray(stride) # Zeroes
-        i += stride
-
-    #print(f'actual ratio={(size/len(compressed))}')
-    return bytes(buf)
-
+from gud.ratio import ratio_buffer
 
 TEST_MODES = ((1920, 1080), (1024, 768), (800, 600), (640, 480))
 
@@ -136,7 +113,7 @@ def main(args):
                 sr = f'x{ratio:d}'
                 print(f'  Compress {sr:>3}: ', flush=True, end='')
 
-                buf = random(fb.size(0), ratio)
+                buf, achieved = ratio_buffer(fb.size(0), ratio, args.seed)
                 mm.seek(0)
                 mm.write(buf)
 
@@ -150,10 +127,14 @@ def main(args):
                 tmean = statistics.mean(elapsed)
                 tmax = max(elapsed)
 
-                print(f'{(1 / tmin):4.1f} > {(1 / tmean):4.1f} > {(1 / tmax):4.1f} fps ({(tmean * 1000):.3f} ms)')
+                achieved = f'(x{achieved:.2f})' if achieved else ''
+                print(f'{(1 / tmin):4.1f} > {(1 / tmean):4.1f} > {(1 / tmax):4.1f} fps ({(tmean * 1000):.3f} ms) {achieved}')
 
                 # keep the frame visible for a bit
                 sleep(0.5)
+
+            # the buffers only fit this mode and format
+            ratio_buffer.cache_clear()
         print()
 
 
@@ -179,6 +160,7 @@ Note:
 ''')
     parser.add_argument('-i', '--iterations', type=int, default=10, help='Number of flushes per test (default=10)')
     parser.add_argument('-p', '--preferred-mode', action='store_true', help='Only use the preferred mode')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the generated buffers (default=0)')
     parser.add_argument('-f', '--format', choices=formats, help='Only use the specified format')
     args = parser.parse_args()
 
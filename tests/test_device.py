@@ -0,0 +1,342 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import pytest
+import ctypes
+import errno
+import os
+import sys
+import numpy
+import usb.core
+from gud import *
+from fake_transport import *
+
+# override the default, these tests don't use the display
+@pytest.fixture(autouse=True)
+def test_delay():
+    pass
+
+
+def record_replay_transfers(transport):
+    assert transport.ids() == (0x1d50, 0x614d, 0x0100, '0123')
+    desc = transport.control(True, GUD_REQ_GET_DESCRIPTOR, 0, bytearray(ctypes.sizeof(gud_drm_usb_vendor_descriptor)))
+    assert gud_drm_usb_vendor_descriptor.from_buffer_copy(desc).magic == GUD_DISPLAY_MAGIC
+    assert transport.control(False, GUD_REQ_SET_CONTROLLER_ENABLE, 0, bytearray((1,))) == 1
+    with pytest.raises(usb.core.USBError) as exc_info:
+        transport.control(False, GUD_REQ_SET_DISPLAY_ENABLE, 0, bytearray((1,)))
+    assert exc_info.value.errno == errno.EPIPE
+    assert bytes(transport.control(True, GUD_REQ_GET_STATUS, 0, 1)) == bytes([GUD_STATUS_ERROR])
+    assert transport.bulk_write(bytes(100), 100) == 100
+    transport.close()
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / 'record.gud')
+    fake = FakeTransport()
+    fake.fail(GUD_REQ_SET_DISPLAY_ENABLE, GUD_STATUS_ERROR)
+    record_replay_transfers(RecordTransport(fake, path))
+    replay = ReplayTransport(path)
+    record_replay_transfers(replay)
+    with pytest.raises(ReplayError):
+        replay.control(True, GUD_REQ_GET_STATUS, 0, 1)
+
+# A whole session replays without the device
+def test_replay_device(tmp_path):
+    path = str(tmp_path / 'record.gud')
+    transfers = []
+    for transport in (lambda: RecordTransport(FakeTransport(), path), lambda: ReplayTransport(path)):
+        dev = Device(transport())
+        for connector in dev.connectors:
+            connector.update()
+        dev.commit(State(dev))
+        img = Image(dev, dev.formats[0], dev.connectors[0].modes[0])
+        img.random(4)
+        img.flush()
+        dev.transport.close()
+        transfers.append(dev.control_transfers)
+    assert dev.transport.index == len(dev.transport.records)
+    assert transfers[0] == transfers[1]
+
+def test_metadata_cache(tmp_path):
+    cold = find_first_setup(MetadataCache(str(tmp_path)), FakeTransport())
+    assert cold.control_transfers == 8
+    assert len(os.listdir(tmp_path)) == 1
+    # only the descriptor and the connector status are read
+    warm = find_first_setup(MetadataCache(str(tmp_path)), FakeTransport())
+    assert warm.control_transfers == 2
+    assert warm.formats == cold.formats
+    assert bytes(warm.connectors[0].modes) == bytes(cold.connectors[0].modes)
+
+    # another descriptor doesn't use the stale file
+    transport = FakeTransport(compression=0)
+    assert find_first_setup(MetadataCache(str(tmp_path)), transport).control_transfers == 8
+
+def test_metadata_cache_no_serial(tmp_path):
+    uncached = find_first_setup(None, FakeTransport(serial=None)).control_transfers
+    for _ in range(2):
+        assert find_first_setup(MetadataCache(str(tmp_path)), FakeTransport(serial=None)).control_transfers == uncached
+    assert not os.listdir(tmp_path)
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path / 'dir' / 'file')
+    assert atomic_write(path, lambda f: f.write(b'data'))
+    def fail(f):
+        f.write(b'partial')
+        raise OSError('disk full')
+    assert not atomic_write(path, fail)
+    with open(path, 'rb') as f:
+        assert f.read() == b'data'
+    assert os.listdir(tmp_path / 'dir') == ['file']
+
+# A clock that only moves when the pacer sleeps or the test says so
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def timer(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_frame_pacer(monkeypatch):
+    clock = FakeClock()
+    pacing = sys.modules['gud.pacing']
+    monkeypatch.setattr(pacing, 'timer', clock.timer)
+    monkeypatch.setattr(pacing.time, 'sleep', clock.sleep)
+
+    dev, transport, state = fake_setup(width=100, height=10)
+    assert state.vrefresh == 60
+    pacer = FramePacer(state, fraction=0.5, spin=0)
+    assert pacer.fps == 30
+    for _ in range(4):
+        assert pacer.wait() == 0
+        clock.now += 0.01 # the frame takes less than a slot
+    assert clock.now == pytest.approx(100 + 3 / 30 + 0.01)
+    assert pacer.cadence == pytest.approx(30)
+    assert pacer.jitter == pytest.approx(0)
+
+    # the frame ends 3.5 slots after it started, slots 4 and 5 are skipped and 6 starts late
+    clock.now += 3.2 / 30
+    assert pacer.wait() == 2
+    assert (pacer.frames, pacer.skipped) == (5, 2)
+    assert clock.now == pytest.approx(100 + 6.5 / 30)
+
+    pacer.reset()
+    assert pacer.cadence is None and pacer.frames == 0
+    with pytest.raises(ValueError):
+        FramePacer()
+    assert FramePacer(fps=50).interval == 1 / 50
+
+# Flushes frames with the status policy and returns the GET_STATUS requests sent
+def status_policy_polls(policy, frames=16):
+    dev, transport, state = fake_setup(flags=GUD_DISPLAY_FLAG_STATUS_ON_SET)
+    dev.status_policy = policy
+    img = Image(dev, state.format, state.mode, native=True)
+    before = transport.count(GUD_REQ_GET_STATUS)
+    for _ in range(frames):
+        img.flush(compress=False)
+    dev.check_status()
+    assert transport.bulk[-frames:] == [img.width * img.height * 4] * frames
+    return transport.count(GUD_REQ_GET_STATUS) - before
+
+def test_status_policy_polls():
+    assert status_policy_polls(STATUS_POLICY_ALWAYS) == 16
+    assert status_policy_polls(STATUS_POLICY_DEFERRED) == 16
+    assert status_policy_polls(STATUS_POLICY_SAMPLED) == 16 // 8
+    assert status_policy_polls(STATUS_POLICY_ERROR_ONLY) == 0
+
+def status_policy_error(policy):
+    dev, transport, state = fake_setup(flags=GUD_DISPLAY_FLAG_STATUS_ON_SET)
+    dev.status_policy = policy
+    dev.status_interval = 2
+    dev.status_polls = 0
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_INVALID_PARAMETER)
+    img = Image(dev, state.format, state.mode, native=True)
+    img.flush(compress=False)
+    return dev, transport
+
+def test_status_policy_errors():
+    # always: the flush itself fails, before the bulk transfer
+    with pytest.raises(GUDInvalidParameterError) as exc_info:
+        status_policy_error(STATUS_POLICY_ALWAYS)
+    assert exc_info.value.request == GUD_REQ_SET_BUFFER and exc_info.value.not_sent is None
+
+    # deferred: the bulk data is sent, the next request reports the error and isn't sent
+    dev, transport = status_policy_error(STATUS_POLICY_DEFERRED)
+    assert transport.dropped == 1
+    requests = len(transport.requests)
+    with pytest.raises(GUDInvalidParameterError) as exc_info:
+        dev.enable()
+    assert exc_info.value.request == GUD_REQ_SET_BUFFER
+    assert exc_info.value.not_sent == GUD_REQ_SET_DISPLAY_ENABLE
+    assert transport.requests[requests:] == [(True, GUD_REQ_GET_STATUS, 0)]
+    dev.enable()
+    assert transport.enabled[GUD_REQ_SET_DISPLAY_ENABLE] == 1
+
+    # sampled: the status of the next sampled request is read, the error is missed
+    dev, transport = status_policy_error(STATUS_POLICY_SAMPLED)
+    assert dev.status_polls == 0
+    dev.enable()
+    assert dev.status_polls == 1 and transport.dropped == 1
+
+    # error-only: missed as well
+    dev, transport = status_policy_error(STATUS_POLICY_ERROR_ONLY)
+    dev.enable()
+    assert dev.status_polls == 0 and transport.dropped == 1
+
+    # a stall is always checked
+    dev, transport, state = fake_setup(flags=GUD_DISPLAY_FLAG_STATUS_ON_SET, stall=True)
+    dev.status_policy = STATUS_POLICY_ERROR_ONLY
+    transport.fail(GUD_REQ_SET_DISPLAY_ENABLE, GUD_STATUS_ERROR)
+    with pytest.raises(GUDError) as exc_info:
+        dev.enable()
+    assert exc_info.value.request == GUD_REQ_SET_DISPLAY_ENABLE
+
+def busy_setup(**kwargs):
+    dev, transport, state = fake_setup()
+    dev.busy_retry = BusyRetry(initial=1, maximum=10, **kwargs)
+    img = Image(dev, state.format, state.mode, native=True)
+    img.random(4)
+    return dev, transport, img
+
+def test_busy_no_retry():
+    dev, transport, state = fake_setup()
+    assert dev.busy_retry is None
+    img = Image(dev, state.format, state.mode, native=True)
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_BUSY)
+    with pytest.raises(GUDBusyError) as exc_info:
+        img.flush()
+    assert exc_info.value.request == GUD_REQ_SET_BUFFER
+    assert transport.count(GUD_REQ_SET_BUFFER) == 1
+    # a sender doesn't retry either
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_BUSY)
+    with pytest.raises(GUDBusyError):
+        img.flush_async().result(5)
+    assert img.sender.retry is None
+    img.close()
+
+def test_busy_retry_recovers():
+    dev, transport, img = busy_setup()
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_BUSY, 3)
+    img.flush()
+    retry = dev.busy_retry
+    assert (retry.busy, retry.retries, retry.recovered, retry.failed) == (1, 3, 1, 0)
+    assert transport.count(GUD_REQ_SET_BUFFER) == 4
+    assert transport.dropped == 0
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    assert sum(retry.histogram.values()) == 1
+
+def test_busy_retry_gives_up():
+    dev, transport, img = busy_setup(attempts=3)
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_BUSY, 10)
+    with pytest.raises(GUDBusyError) as exc_info:
+        img.flush()
+    assert exc_info.value.request == GUD_REQ_SET_BUFFER
+    retry = dev.busy_retry
+    assert (retry.busy, retry.retries, retry.recovered, retry.failed) == (1, 3, 0, 1)
+    assert list(retry.delays()) == [1, 2, 4]
+    assert transport.count(GUD_REQ_SET_BUFFER) == 4
+    assert not transport.bulk
+
+def test_busy_retry_requests():
+    dev, transport, img = busy_setup()
+    # only the requests in retry.requests are retried
+    transport.fail(GUD_REQ_SET_DISPLAY_ENABLE, GUD_STATUS_BUSY)
+    with pytest.raises(GUDBusyError) as exc_info:
+        dev.enable()
+    assert exc_info.value.request == GUD_REQ_SET_DISPLAY_ENABLE
+    assert dev.busy_retry.busy == 0
+    # other errors aren't retried
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_ERROR)
+    with pytest.raises(GUDError):
+        img.flush()
+    assert dev.busy_retry.busy == 0
+
+def test_busy_retry_sender():
+    dev, transport, img = busy_setup(coalesce=True)
+    other = Image(dev, img.format, img.mode, native=True)
+    other.flush_async().result(5)
+    # each sender has its own retry, the device's isn't changed
+    assert img.flush_async().result(5)
+    assert img.sender.retry is not other.sender.retry
+    assert img.sender.retry is not dev.busy_retry
+    assert dev.busy_retry.newer is None
+    assert img.sender.retry.attempts == dev.busy_retry.attempts
+
+    # the device is busy while a newer frame is waiting: the frames are merged, not retried
+    newer = []
+    control = transport.control
+    def submit_newer(_in, request, value, buf):
+        if request == GUD_REQ_SET_BUFFER and not newer:
+            newer.append(img.flush_async(20, 20, 4, 4))
+            transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_BUSY)
+        return control(_in, request, value, buf)
+    transport.control = submit_newer
+    first = img.flush_async(0, 0, 8, 8)
+    result = first.result(5)
+    assert result.merged == 2 and newer[0].result(5).merged == 2
+    assert img.sender.retry.coalesced == 1 and img.sender.retry.retries == 0
+    assert dev.busy_retry.busy == 0 and other.sender.retry.busy == 0
+    assert transport.buffers[-2:] in ([(0, 0, 8, 8), (20, 20, 4, 4)], [(20, 20, 4, 4), (0, 0, 8, 8)])
+    img.sender.close()
+    other.sender.close()
+
+# Enough of libusb for AsyncBulkWriter: submitted transfers complete when events are handled,
+# fail_events makes handling events fail once with the transfers still in flight
+class FakeLibusb(object):
+    def __init__(self):
+        self.structs = []
+        self.submitted = []
+        self.cancelled = 0
+        self.fail_events = False
+
+    def libusb_alloc_transfer(self, iso_packets):
+        transfer = libusb_transfer()
+        self.structs.append(transfer)
+        return ctypes.pointer(transfer)
+
+    def libusb_free_transfer(self, transfer):
+        pass
+
+    def libusb_submit_transfer(self, transfer):
+        self.submitted.append(transfer)
+        return 0
+
+    def libusb_cancel_transfer(self, transfer):
+        transfer.contents.status = LIBUSB_TRANSFER_CANCELLED
+        self.cancelled += 1
+        return 0
+
+    def libusb_handle_events_timeout_completed(self, ctx, tv, completed):
+        if self.fail_events:
+            self.fail_events = False
+            return -1 # LIBUSB_ERROR_IO
+        submitted, self.submitted = self.submitted, []
+        for transfer in submitted:
+            t = transfer.contents
+            if t.status == LIBUSB_TRANSFER_COMPLETED:
+                t.actual_length = t.length
+            t.callback(transfer)
+        return 0
+
+    def libusb_error_name(self, ret):
+        return b'LIBUSB_ERROR_IO'
+
+def test_async_bulk_writer(monkeypatch):
+    lib = FakeLibusb()
+    monkeypatch.setattr(sys.modules['gud.libusb_async'], 'libusb_handle', lambda usbdev: (lib, None, None))
+    writer = AsyncBulkWriter(None, 0x01, depth=2, transfer_size=2000, max_packet_size=512)
+    assert writer.transfer_size == 1536
+    buf = bytes(4000)
+    assert writer.write(buf, len(buf)) == len(buf)
+    assert (writer.writes, writer.transfers, writer.max_in_flight) == (1, 3, 2)
+
+    # the transfers in flight are cancelled and done before the error is raised
+    lib.fail_events = True
+    with pytest.raises(usb.core.USBError):
+        writer.write(buf, len(buf))
+    assert lib.cancelled == 2
+    assert writer._in_flight == 0 and len(writer._idle) == 2
+    assert writer.writes == 1
+
+    assert writer.write(buf, len(buf)) == len(buf)
+    writer.close()
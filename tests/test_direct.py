@@ -2,6 +2,7 @@
 
 import pytest
 import ctypes
+import os
 import time
 import usb.core
 from gud import *
@@ -13,11 +14,16 @@ pytestmark = pytest.mark.direct
 def test_delay():
     pass
 
+# GUD_RECORD=file records the transfers, GUD_REPLAY=file runs the same tests again without a device
 @pytest.fixture(name='dev', scope='module')
 def gud_device(nodisplay):
-    dev = find()
+    replay = os.environ.get('GUD_REPLAY')
+    dev = Device(ReplayTransport(replay)) if replay else find()
     if not dev:
         raise RuntimeError('No GUD device found')
+    record = os.environ.get('GUD_RECORD')
+    if record:
+        dev.transport = RecordTransport(dev.transport, record)
 
     try:
         dev.detach_kernel_driver()
@@ -30,7 +36,9 @@ def gud_device(nodisplay):
     yield dev
 
     dev.attach_kernel_driver()
-    time.sleep(1)
+    dev.transport.close()
+    if not replay:
+        time.sleep(1)
 
 @pytest.fixture(scope='module')
 def ensure_status_is_zero(dev):
@@ -70,8 +78,9 @@ def check_formats(formats):
             val = fmt.value
         except AttributeError:
             val = fmt
-        assert val in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_RGB565,
-                       GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_ARGB8888,)
+        assert val in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_R8, GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_RGB332,
+                       GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_RGB888, GUD_PIXEL_FORMAT_XRGB8888,
+                       GUD_PIXEL_FORMAT_ARGB8888,)
 
 def check_properties(props):
     if len(props) == 0:
@@ -0,0 +1,578 @@
+# SPDX-License-Identifier: CC0-1.0
+
+import pytest
+import os
+import sys
+import threading
+import tracemalloc
+import numpy
+from PIL import Image as PIL_Image
+from PIL import ImageDraw as PIL_ImageDraw
+from gud import *
+from fake_transport import *
+
+# override the default, these tests don't use the display
+@pytest.fixture(autouse=True)
+def test_delay():
+    pass
+
+
+def image_data_reference(img, x1, y1, width, height):
+    data = bytearray()
+    for y in range(y1, y1 + height):
+        val = 0
+        for i, x in enumerate(range(x1, x1 + width)):
+            r, g, b = img.image.getpixel((x, y))
+            if img.format == GUD_PIXEL_FORMAT_R1:
+                val |= (((3 * r + 6 * g + b) // 10) & 1) << (7 - i % 8)
+                if i % 8 == 7:
+                    data.append(val)
+                    val = 0
+            else:
+                val |= ((r >> 7) << 2 | (g >> 7) << 1 | (b >> 7)) << ((1 - i % 2) * 4)
+                if i % 2 == 1:
+                    data.append(val)
+                    val = 0
+        if width % (8 if img.format == GUD_PIXEL_FORMAT_R1 else 2):
+            data.append(val)
+    return data
+
+@pytest.mark.parametrize('fmt', [GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111], ids=['R1', 'XRGB1111'])
+def test_image_data_packed(fmt):
+    mode = gud_drm_req_display_mode()
+    mode.hdisplay = 37
+    mode.vdisplay = 5
+    img = Image(None, fmt, mode)
+    img.image.frombytes(os.urandom(img.width * img.height * 3), 'raw', 'RGB')
+    for x in range(0, 16):
+        for width in (1, 2, 7, 8, 9, 17, img.width - x):
+            assert bytes(img.data(x, 1, width, 3)) == image_data_reference(img, x, 1, width, 3)
+
+@pytest.mark.parametrize('fmt', [fmt for fmt in CONVERTERS if fmt != GUD_PIXEL_FORMAT_ARGB8888], ids=format_to_name)
+def test_image_data_native(fmt):
+    mode = gud_drm_req_display_mode()
+    mode.hdisplay = 37
+    mode.vdisplay = 5
+    img = Image(None, fmt, mode)
+    img.image.frombytes(os.urandom(img.width * img.height * 3), 'raw', 'RGB')
+    native = Image(None, fmt, mode, native=True)
+    native._native[:] = native._to_native(numpy.asarray(img.image))
+    for rect in ((0, 0, img.width, img.height), (8, 1, 16, 3)):
+        assert bytes(native.data(*rect)) == bytes(img.data(*rect))
+    # The packed formats shift unaligned rectangles and zero the pad bits
+    for x in range(0, 16):
+        for width in (1, 2, 7, 8, 9, 17, img.width - x):
+            assert bytes(native.data(x, 1, width, 3)) == bytes(img.data(x, 1, width, 3))
+    # Converting back and forth is lossless once in the format
+    assert numpy.array_equal(native._to_native(native._from_native(native._native, img.width)), native._native)
+
+def test_damage_merge():
+    damage = Damage(max_rects=2)
+    damage.add(0, 0, 10, 10)
+    damage.add(10, 0, 10, 10) # shares an edge
+    assert list(damage) == [(0, 0, 20, 10)]
+    damage.add(0, 0, 0, 10)
+    assert list(damage) == [(0, 0, 20, 10)]
+    damage.add(40, 20, 4, 4)
+    damage.add(50, 30, 2, 2)
+    # three rectangles don't fit, the closest pair is merged
+    assert sorted(damage) == [(0, 0, 20, 10), (40, 20, 12, 12)]
+    assert damage.bounds == (0, 0, 52, 32)
+    damage.clear()
+    assert not damage and damage.bounds is None
+
+def test_flush_damage():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    img.flush()
+    img.damage.clear()
+    transport.buffers.clear()
+    assert img.flush_damage() == (0, 0)
+    assert not transport.buffers
+
+    img.rectangle(2, 3, 5, 4, fill='red')
+    img.rectangle(40, 20, 8, 8, fill='blue')
+    img.flush_damage()
+    assert sorted(transport.buffers) == [(2, 3, 5, 4), (40, 20, 8, 8)]
+    assert not img.damage
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_flush_damage_full_update():
+    dev, transport, state = fake_setup(flags=GUD_DISPLAY_FLAG_FULL_UPDATE)
+    img = Image(dev, state.format, state.mode, native=True)
+    img.rectangle(2, 3, 5, 4, fill='red')
+    img.flush_damage()
+    # no SET_BUFFER, the whole frame is sent
+    assert transport.count(GUD_REQ_SET_BUFFER) == 0
+    assert transport.bulk == [img.width * img.height * 4]
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_diff_tiles():
+    prev = numpy.zeros((10, 40), dtype=numpy.uint8)
+    cur = prev.copy()
+    cur[0, 0] = 1
+    cur[9, 39] = 1
+    changed = diff_tiles(prev, cur, 16, 4)
+    assert changed.tolist() == [[True, False, False], [False, False, False], [False, False, True]]
+    damage = tiles_to_damage(changed, 16, 4, 40, 10, Damage())
+    assert sorted(damage) == [(0, 0, 16, 4), (32, 8, 8, 2)]
+
+def test_flush_diff():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    # the first frame is sent whole
+    img.flush_diff(tile=16)
+    assert transport.buffers == [(0, 0, img.width, img.height)]
+
+    transport.buffers.clear()
+    assert img.flush_diff(tile=16) == (0, 0)
+    assert not transport.buffers
+
+    # redraw everything, only the changed tile goes out
+    img.rectangle(0, 0, img.width, img.height, fill='black')
+    img.rectangle(20, 18, 4, 4, fill='green')
+    img.flush_diff(tile=16)
+    assert transport.buffers == [(16, 16, 16, 16)]
+    assert not img.damage
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+@pytest.mark.parametrize('fmt', [GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_RGB565], ids=format_to_name)
+def test_flush_diff_format(fmt):
+    dev, transport, state = fake_setup(fmt)
+    img = Image(dev, fmt, state.mode, native=True)
+    img.flush_diff(tile=12)
+    img.rectangle(17, 1, 2, 2, fill='white')
+    transport.buffers.clear()
+    img.flush_diff(tile=12)
+    # R1 tiles are kept on whole bytes
+    tile = 16 if fmt == GUD_PIXEL_FORMAT_R1 else 12
+    assert transport.buffers == [(tile, 0, tile, tile)]
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_band_compressor():
+    compressor = BandCompressor(bands=4, workers=2)
+    assert compressor.split(10) == [(0, 3), (3, 3), (6, 3), (9, 1)]
+    assert compressor.split(2) == [(0, 1), (1, 1)]
+
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    img.random(4)
+    img.compressor = compressor
+    img.flush()
+    compressor.close()
+    assert transport.buffers == [(0, y, img.width, lines) for y, lines in compressor.split(img.height)]
+    assert sum(transport.bulk) < len(img.data(0, 0, img.width, img.height))
+    assert len(compressor.ratios) == 4
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_adaptive_compression():
+    policy = AdaptiveCompression(threshold=1.5)
+    assert not policy.worth_it(1000, 1.2)
+    assert policy.worth_it(1000, 2)
+    # saves 0.5 s of transfer but compressing takes 1 s
+    policy.compress_speed = 1000
+    policy.link_speed = 1000
+    assert not policy.worth_it(1000, 2)
+
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    img.compression_policy = AdaptiveCompression()
+    length = img.width * img.height * 4
+    img.random(0)
+    img.flush()
+    assert transport.bulk == [length]
+    assert img.compression_policy.skipped == 1
+    img.random(8, seed=1)
+    img.flush()
+    assert transport.bulk[1] < length
+    assert img.compression_policy.hits == 1
+    assert img.compression_policy.link_speed
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_payload_cache_lru():
+    cache = PayloadCache(max_size=250)
+    for i in range(3):
+        cache.put(i, [(None, bytes(100))])
+    # 0 is evicted to make room for 2
+    assert len(cache) == 2 and cache.size == 200 and cache.evictions == 1
+    assert cache.get(0) is None
+    assert cache.get(1) is not None
+    cache.put(3, [(None, bytes(100))])
+    # 1 was used last so 2 goes
+    assert cache.get(2) is None and cache.get(1) is not None
+    cache.put(4, [(None, bytes(300))]) # too big
+    assert cache.get(4) is None
+
+def test_payload_cache_flush():
+    dev, transport, state = fake_setup()
+    cache = PayloadCache()
+    frames = []
+    for seed in range(2):
+        img = Image(dev, state.format, state.mode, native=True)
+        img.random(4, seed=seed)
+        img.payload_cache = cache
+        frames.append(img)
+    for img in frames + frames:
+        img.flush()
+        assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    assert (cache.misses, cache.hits) == (2, 2)
+    assert transport.bulk[:2] == transport.bulk[2:]
+    # use_cached skips hashing
+    frames[0].flush(use_cached=True)
+    assert cache.hits == 3
+    assert numpy.array_equal(transport.framebuffer, image_lines(frames[0]))
+
+# The flush path only allocates a few small objects per part, no copies of the pixels.
+# The transport keeps every buffer it's given so copies can't be freed before the snapshot.
+@pytest.mark.parametrize('compress', [False, True], ids=['uncompressed', 'compressed'])
+def test_flush_allocations(compress):
+    dev, transport, state = fake_setup(width=256, height=64, max_buffer_size=16 * 1024)
+    img = Image(dev, state.format, state.mode, native=True)
+    img.random(4)
+    img.flush(compress=compress) # warm up
+    transport.kept = []
+    transport.bulk.clear()
+
+    gud_files = [tracemalloc.Filter(True, os.path.join(os.path.dirname(sys.modules['gud'].__file__), '*'))]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(gud_files)
+        _, parts = img.flush(compress=compress)
+        after = tracemalloc.take_snapshot().filter_traces(gud_files)
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    count = sum([stat.count_diff for stat in stats])
+    size = sum([stat.size_diff for stat in stats])
+    assert parts == 4
+    assert count <= 8 * parts
+    # apart from the LZ4 output only small objects, nothing the size of a part
+    limit = 1024 * parts
+    if compress:
+        limit += sum(transport.bulk)
+    assert size < limit
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+def test_buffer_array():
+    assert BUFFER_ARRAY_ZERO_COPY
+    buf = numpy.arange(16, dtype=numpy.uint8)
+    arr = BufferArray()
+    arr.set(buf[4:])
+    assert arr.buffer_info() == (buf.ctypes.data + 4, 12)
+    arr.set(None)
+    assert arr.buffer_info() == (0, 0)
+
+def test_planner():
+    planner = BufferPlanner()
+    fmt = GUD_PIXEL_FORMAT_XRGB8888
+    assert planner.plan(fmt, 0, 0, 100, 10, 100000) == [Part(0, 0, 100, 10, 4000)]
+    assert planner.plan(fmt, 0, 0, 100, 10, 1600) == [Part(0, y, 100, 4 if y < 8 else 2, 1600 if y < 8 else 800) for y in (0, 4, 8)]
+    # lines that don't fit are split into columns
+    assert planner.plan(fmt, 10, 0, 100, 2, 160) == [Part(x, y, 40 if x < 90 else 20, 1, 160 if x < 90 else 80)
+                                                     for y in (0, 1) for x in (10, 50, 90)]
+    # packed columns are whole bytes
+    assert [part.width for part in planner.plan(GUD_PIXEL_FORMAT_R1, 0, 0, 100, 1, 5)] == [40, 40, 20]
+    assert len(BufferPlanner(part_size=1000).plan(fmt, 0, 0, 100, 10, 100000)) == 5
+    assert len(BufferPlanner(min_parts=4, min_part_size=100).plan(fmt, 0, 0, 100, 8, 100000)) == 4
+    assert len(BufferPlanner(min_parts=4).plan(fmt, 0, 0, 100, 10, 100000)) == 1
+
+@pytest.mark.parametrize('fmt', [GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB8888], ids=format_to_name)
+@pytest.mark.parametrize('pipeline', [False, True], ids=['sequential', 'pipeline'])
+def test_flush_parts(fmt, pipeline):
+    max_size = 100 if fmt == GUD_PIXEL_FORMAT_XRGB8888 else 20
+    dev, transport, state = fake_setup(fmt, max_buffer_size=max_size)
+    img = Image(dev, fmt, state.mode, native=True)
+    img.random(4)
+    img.planner = BufferPlanner(min_parts=2)
+    x = 4 * img.ppb
+    rect = (x, 1, img.width - x, 20)
+    _, parts = img.flush(*rect, pipeline=pipeline)
+    plan = img.plan(*rect)
+    assert parts == len(plan) > 2
+    assert transport.buffers == [part[:4] for part in plan]
+    assert all([part.length <= max_size for part in plan])
+    expect = numpy.zeros_like(transport.framebuffer)
+    expect[1:21, img._offset(x):] = image_lines(img)[1:21, img._offset(x):]
+    assert numpy.array_equal(transport.framebuffer, expect)
+
+# Holds bulk transfers until the returned event is set, started is set when the first one waits
+def block_bulk(transport):
+    started = threading.Event()
+    release = threading.Event()
+    bulk_write = transport.bulk_write
+    def blocked(buf, length):
+        started.set()
+        release.wait(5)
+        return bulk_write(buf, length)
+    transport.bulk_write = blocked
+    return started, release
+
+def test_flush_async():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    started, release = block_bulk(transport)
+    img.rectangle(0, 0, 8, 8, fill='red')
+    first = img.flush_async(0, 0, 8, 8)
+    assert started.wait(5)
+    # the first frame is on the wire, these two are merged
+    img.rectangle(10, 10, 4, 4, fill='green')
+    second = img.flush_async(10, 10, 4, 4)
+    img.rectangle(30, 20, 4, 4, fill='blue')
+    third = img.flush_async(30, 20, 4, 4)
+    release.set()
+
+    assert first.result(5).merged == 1
+    result = third.result(5)
+    assert second.result(5)[1:] == result[1:]
+    assert result.merged == 2 and result.parts == 2
+    assert result.submitted <= result.started <= result.finished
+    img.sender.close()
+    assert (img.sender.submitted, img.sender.sent, img.sender.dropped) == (3, 2, 1)
+    assert sorted(transport.buffers) == [(0, 0, 8, 8), (10, 10, 4, 4), (30, 20, 4, 4)]
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    with pytest.raises(RuntimeError):
+        img.flush_async()
+
+def test_flush_async_error():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_ERROR)
+    with pytest.raises(GUDError):
+        img.flush_async().result(5)
+    # the sender keeps going
+    assert img.flush_async().result(5).parts == 1
+    img.sender.close()
+
+def test_ratio_buffer_cache():
+    ratio_buffer.cache_clear()
+    max_size = ratio_buffer.max_size
+    ratio_buffer.max_size = 2500
+    try:
+        buf, achieved = ratio_buffer(1000, 4)
+        assert achieved == pytest.approx(4, rel=0.05)
+        assert ratio_buffer(1000, 4)[0] is buf
+        ratio_buffer(1000, 0)
+        ratio_buffer(1000, 2)
+        # the oldest buffer was evicted to stay within max_size
+        assert ratio_buffer.size == 2000
+        assert ratio_buffer(1000, 4)[0] is not buf
+        ratio_buffer(3000, 0) # too big to cache
+        assert ratio_buffer.size == 2000
+        ratio_buffer.cache_clear()
+        assert ratio_buffer.size == 0
+    finally:
+        ratio_buffer.max_size = max_size
+
+def test_compositor():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    img.flush()
+    comp = Compositor(img)
+    transport.buffers.clear()
+
+    red = comp.add(Sprite(numpy.full((4, 4, 3), (0xff, 0, 0), dtype=numpy.uint8), 2, 2))
+    comp.flush()
+    assert transport.buffers == [(2, 2, 4, 4)]
+    assert img.array[2, 2] == 0xff0000 and img.array[6, 6] == 0
+
+    # the old and new bounds touch and are sent as one rectangle
+    transport.buffers.clear()
+    comp.move(red, 4, 2)
+    comp.flush()
+    assert transport.buffers == [(2, 2, 6, 4)]
+    assert img.array[2, 2] == 0 and img.array[2, 7] == 0xff0000
+
+    # blended on top of the red sprite and the background
+    blue = comp.add(Sprite(numpy.full((2, 4, 4), (0, 0, 0xff, 0x80), dtype=numpy.uint8), 6, 2))
+    assert not blue.opaque
+    comp.flush()
+    assert img.array[2, 7] == 0x7f0080
+    assert img.array[2, 9] == 0x000080
+
+    transport.buffers.clear()
+    comp.show(red, False)
+    comp.remove(blue)
+    assert comp.composite() == [(4, 2, 6, 4)]
+    img.flush_damage()
+    assert not img.array[2:6, 4:10].any()
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+
+@pytest.mark.parametrize('fmt', [GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111, GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_XRGB8888], ids=format_to_name)
+def test_glyph_atlas(fmt):
+    mode = gud_drm_req_display_mode(hdisplay=64, vdisplay=32)
+    atlas = GlyphAtlas(fmt)
+    native = Image(None, fmt, mode, native=True)
+    img = Image(None, fmt, mode)
+    # odd x to not land on a byte boundary, clipped on the right
+    for x, y, text in ((3, 2, 'Ag'), (45, 15, 'x|y0')):
+        assert atlas.draw(native, x, y, text) == atlas.draw(img, x, y, text)
+    assert native.damage.bounds == img.damage.bounds
+    assert bytes(native.data(0, 0, 64, 32)) == bytes(img.data(0, 0, 64, 32))
+    assert len(atlas.glyphs) == 6
+
+def test_text_label():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    label = TextLabel(img, 2, 4)
+    rect = label.set('12:00')
+    assert rect[:2] == (2, 4)
+    img.flush_damage()
+    assert label.set('12:00') is None
+
+    # only the last digit changes
+    transport.buffers.clear()
+    rect = label.set('12:01')
+    x = 2 + label.atlas.textwidth('12:0')
+    assert rect[0] >= x and rect[0] + rect[2] <= x + label.atlas.textwidth('1')
+    img.flush_damage()
+    assert transport.buffers == [rect]
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    # a shorter text clears what the longer one covered
+    label.set('1')
+    img.flush_damage()
+    reference = Image(None, state.format, state.mode, native=True)
+    label.atlas.draw(reference, 2, 4, '1')
+    assert numpy.array_equal(transport.framebuffer, image_lines(reference))
+
+def test_swap():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    started, release = block_bulk(transport)
+    img.rectangle(0, 0, 8, 8, fill='red')
+    first = img.swap()
+    assert started.wait(5)
+    assert not img.damage
+    # drawing the next frame doesn't touch the one being sent
+    frame = image_lines(img).copy()
+    img.rectangle(0, 0, 8, 8, fill='blue')
+    release.set()
+    assert first.result(5)[1] == 1
+    assert numpy.array_equal(transport.framebuffer, frame)
+
+    second = img.swap()
+    img.rectangle(20, 20, 4, 4, fill='green')
+    third = img.swap()
+    second.result(5)
+    third.result(5)
+    assert transport.buffers == [(0, 0, 8, 8)] * 2 + [(20, 20, 4, 4)]
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    swapper = img._swapper
+    img.close()
+    assert swapper._shutdown and img._swapper is None
+
+def test_swap_close_error():
+    dev, transport, state = fake_setup()
+    transport.fail(GUD_REQ_SET_BUFFER, GUD_STATUS_ERROR)
+    with pytest.raises(GUDError):
+        with Image(dev, state.format, state.mode, native=True) as img:
+            img.rectangle(0, 0, 8, 8, fill='red')
+            img.swap()
+    assert img._swapper is None
+    img.close()
+
+def test_payload_cache_compress():
+    dev, transport, state = fake_setup()
+    img = Image(dev, state.format, state.mode, native=True)
+    img.random(4)
+    img.payload_cache = PayloadCache()
+    length = len(img.data(0, 0, img.width, img.height))
+    img.flush(compress=True)
+    assert transport.bulk[-1] < length
+    # use_cached doesn't reuse a payload built with other settings
+    for compress in (False, True, False):
+        img.flush(compress=compress, use_cached=True)
+        assert (transport.bulk[-1] == length) != compress
+        assert numpy.array_equal(transport.framebuffer, image_lines(img))
+    assert img.payload_cache.hits == 2
+
+def test_fit_font():
+    try:
+        truetype('FreeMono', 16)
+    except OSError:
+        pytest.skip('FreeMono is not installed')
+    fit_font.cache_clear()
+    for text, fraction, width in (('Hello', 0.5, 320), ('12:00', 0.8, 1024), ('x', 0.1, 64)):
+        font, w, h = fit_font(text, fraction, width)
+        uncached, uw, uh = fit_font.__wrapped__(text, fraction, width)
+        assert (font.size, w, h) == (uncached.size, uw, uh)
+    hits = fit_font.cache_info().hits
+    assert fit_font('Hello', 0.5, 320)[0] is fit_font('Hello', 0.5, 320)[0]
+    assert fit_font.cache_info().hits == hits + 2
+    assert fit_font.cache_info().misses == 3
+
+# Draw a pattern rectangle by rectangle with PIL
+def pattern_pil(name, width, height):
+    image = PIL_Image.new('RGB', (width, height))
+    draw = PIL_ImageDraw.Draw(image)
+    for x, y, w, h, fill, outline in PATTERNS[name](width, height):
+        draw.rectangle([(x, y), (x + w - 1, y + h - 1)], fill=fill, outline=outline)
+    return numpy.asarray(image)
+
+@pytest.mark.parametrize('name', list(PATTERNS))
+def test_patterns(name, tmp_path):
+    cache = PatternCache(str(tmp_path))
+    for width, height in ((37, 23), (101, 59), (161, 97)):
+        reference = pattern_pil(name, width, height)
+        assert pattern_rgb888(name, width, height).tobytes() == reference.tobytes()
+        mode = gud_drm_req_display_mode(hdisplay=width, vdisplay=height)
+        for fmt in (GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_XRGB8888):
+            img = Image(None, fmt, mode, native=True)
+            converted = img._to_native(reference)
+            # generated and then loaded from the disk cache
+            for _ in range(2):
+                img.pattern(name, cache)
+                assert img._native.tobytes() == converted.tobytes()
+    assert (cache.hits, cache.misses) == (9, 9)
+
+def test_pattern_images():
+    mode = gud_drm_req_display_mode(hdisplay=37, vdisplay=23)
+    img = smpte_image(None, GUD_PIXEL_FORMAT_XRGB8888, mode)
+    assert not img.native
+    assert numpy.asarray(img.image).tobytes() == pattern_pil('smpte', 37, 23).tobytes()
+    assert checkerboard_image(None, GUD_PIXEL_FORMAT_RGB565, mode, native=True).native
+
+def test_smallest_format():
+    formats = (GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_RGB565, GUD_PIXEL_FORMAT_R8, GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_XRGB1111)
+    # color content can't use the grayscale formats
+    assert smallest_format(formats) == GUD_PIXEL_FORMAT_RGB565
+    assert smallest_format(formats, min_bpp=4) == GUD_PIXEL_FORMAT_XRGB1111
+    # grayscale content can
+    assert smallest_format(formats, color=False) == GUD_PIXEL_FORMAT_R8
+    assert smallest_format(formats, min_bpp=1, color=False) == GUD_PIXEL_FORMAT_R1
+    # the device lacks RGB332/RGB565, the next best is picked
+    assert smallest_format((GUD_PIXEL_FORMAT_XRGB8888, GUD_PIXEL_FORMAT_RGB888, GUD_PIXEL_FORMAT_R8)) == GUD_PIXEL_FORMAT_RGB888
+    assert smallest_format((GUD_PIXEL_FORMAT_R1, GUD_PIXEL_FORMAT_R8)) is None
+    assert smallest_format((0xff, GUD_PIXEL_FORMAT_XRGB8888)) == GUD_PIXEL_FORMAT_XRGB8888
+
+@pytest.mark.parametrize('fmt', [fmt for fmt in CONVERTERS if fmt != GUD_PIXEL_FORMAT_ARGB8888], ids=format_to_name)
+def test_flush_stream(fmt):
+    framebuffers = []
+    band_size = 300 if format_cpp(fmt) else 20
+    for stream in (False, True):
+        dev, transport, state = fake_setup(fmt, max_buffer_size=4096)
+        img = Image(dev, fmt, state.mode, native=True)
+        img.random(4)
+        rect = (3 * img.ppb, 2, img.width - 5 * img.ppb, 27)
+        if stream:
+            _, parts = img.flush_stream(*rect, band_size=band_size)
+        else:
+            img.flush(*rect)
+        framebuffers.append(transport.framebuffer)
+    assert numpy.array_equal(framebuffers[0], framebuffers[1])
+
+    lengths = [format_line_length(fmt, width) * height for _, _, width, height in transport.buffers]
+    assert parts == len(transport.buffers) > 1
+    assert transport.buffers == [part[:4] for part in BufferPlanner(band_size).plan(fmt, *rect, 4096)]
+    assert all([length <= band_size for length in lengths])
+    assert sum(lengths) == format_line_length(fmt, rect[2]) * rect[3]
+
+def test_flush_stream_max_buffer_size():
+    dev, transport, state = fake_setup(max_buffer_size=1024)
+    img = Image(dev, state.format, state.mode, native=True)
+    img.random(4)
+    # the device limit wins over a bigger band size
+    _, parts = img.flush_stream(band_size=1024 * 1024)
+    assert parts == img.height * img.width * 4 // 1024
+    assert all([width * height * 4 <= 1024 for _, _, width, height in transport.buffers])
+    assert numpy.array_equal(transport.framebuffer, image_lines(img))
@@ -2,20 +2,20 @@
 
 import pytest
 import time
-import pykms
+pykms = pytest.importorskip('pykms')
 
 def pytest_generate_tests(metafunc):
     if list(metafunc.definition.iter_markers(name="parametrize")):
         # pytest parametrize runs each test through all parameters before moving on to the next test
         # at least vc4 (rPi) has slow modesetting so this makes sure that tests are run sequentially using the same display mode
-        modes = pytest.gud.test_modes()
+        modes = pytest.open_display().test_modes()
         metafunc.parametrize('mode', modes, ids=[f'{mode.hdisplay}x{mode.vdisplay}' for mode in modes], scope='class')
 
 @pytest.fixture(scope='class')
 def state(display):
     return display.state()
 
-@pytest.mark.parametrize('format', pytest.gud.formats, ids=[fmt.name for fmt in pytest.gud.formats])
+@pytest.mark.parametrize('format', pytest.open_display().formats, ids=[fmt.name for fmt in pytest.open_display().formats])
 class TestModes:
     def test_smpte(self, state, mode, format):
         fb = state.fb # keep fb from being destroyed before commit (which disables the pipeline)
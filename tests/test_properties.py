@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: CC0-1.0
 
 import pytest
-import pykms
+pykms = pytest.importorskip('pykms')
 import time
 
 
@@ -40,9 +40,9 @@ def test_active(pytestconfig, display):
 
 
 class TestProperties:
-    @pytest.mark.skipif(not pytest.gud.rotation, reason='no rotation support')
-    @pytest.mark.parametrize('reflection', [v for v in pytest.gud.rotation_values if 'reflect' in v] + ['reflect-none'])
-    @pytest.mark.parametrize('rotation', [v for v in pytest.gud.rotation_values if 'rotate' in v and v != 'rotate-0'] + ['rotate-0'])
+    @pytest.mark.skipif(not pytest.open_display().rotation, reason='no rotation support')
+    @pytest.mark.parametrize('reflection', [v for v in pytest.open_display().rotation_values if 'reflect' in v] + ['reflect-none'])
+    @pytest.mark.parametrize('rotation', [v for v in pytest.open_display().rotation_values if 'rotate' in v and v != 'rotate-0'] + ['rotate-0'])
     def test_rotation(self, state, rotation, reflection):
         values = { 'rotate-0': pykms.Rotation.ROTATE_0,
                    'rotate-90': pykms.Rotation.ROTATE_90,
@@ -65,9 +65,9 @@ class TestProperties:
         state.add(state.plane, state.display.rotation, val)
         state.commit()
 
-    @pytest.mark.skipif(not any(p for p in pytest.gud.connector.properties if 'margin' in p.name), reason='no margin properties')
+    @pytest.mark.skipif(not any(p for p in pytest.open_display().connector.properties if 'margin' in p.name), reason='no margin properties')
     @pytest.mark.parametrize('val', range(100, -1, -20))
-    @pytest.mark.parametrize('margin', [p for p in pytest.gud.connector.properties if 'margin' in p.name], ids=lambda p: getattr(p, 'name', 'nomargin'))
+    @pytest.mark.parametrize('margin', [p for p in pytest.open_display().connector.properties if 'margin' in p.name], ids=lambda p: getattr(p, 'name', 'nomargin'))
     def test_margins(self, state, margin, val):
         image = state.image
 
@@ -79,7 +79,7 @@ class TestProperties:
         state.add(state.connector, margin, val)
         state.commit()
 
-    @pytest.mark.skipif(not any(p for p in pytest.gud.connector.properties if 'margin' in p.name), reason='no margin properties')
+    @pytest.mark.skipif(not any(p for p in pytest.open_display().connector.properties if 'margin' in p.name), reason='no margin properties')
     @pytest.mark.parametrize('val', range(100, -1, -25))
     def test_margins_all(self, state, val):
         display = state.display
@@ -95,8 +95,8 @@ class TestProperties:
             state.add(state.connector, margin, val)
         state.commit()
 
-    @pytest.mark.skipif(not pytest.gud.connector.has_brightness, reason='no brightness property')
-    @pytest.mark.skipif(not pytest.gud.connector.access_brightness, reason='no backlight write permission')
+    @pytest.mark.skipif(not pytest.open_display().connector.has_brightness, reason='no brightness property')
+    @pytest.mark.skipif(not pytest.open_display().connector.access_brightness, reason='no backlight write permission')
     def test_brightness(self, state):
         display = state.display
         image = state.image
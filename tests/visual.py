@@ -7,6 +7,7 @@ import os
 import statistics
 import sys
 from time import sleep
+import numpy
 from gud import *
 
 
@@ -58,10 +59,33 @@ def test_all_grid(dev, state, speed):
             print('.', end='', flush=True)
             grid.rectangle(x * w, y * w, w, w, fill='#000000')
             grid.rectangle(x * w + dot_off, y * w + dot_off, dot_w, dot_w, fill=colors[x % len(colors)])
-            grid.flush(x * w, y * w, w, w)
+            grid.flush_damage()
             sleep(0.5 * speed)
     print()
 
+def test_all_sprites(dev, state, speed):
+    print('  Sprites: ', end='', flush=True)
+    img = smpte_image(dev, state.format, state.mode)
+    img.flush()
+    compositor = Compositor(img)
+
+    size = max(8, img.height // 10)
+    square = compositor.add(Sprite(numpy.full((size, size, 3), 0xff, dtype=numpy.uint8)))
+    # Half transparent
+    shade = numpy.zeros((size, size * 2, 4), dtype=numpy.uint8)
+    shade[..., 3] = 0x80
+    bar = compositor.add(Sprite(shade, 0, (img.height - size) // 2))
+    compositor.flush()
+
+    steps = 20
+    for step in range(steps + 1):
+        compositor.move(square, step * (img.width - size) // steps, step * (img.height - size) // steps)
+        compositor.move(bar, (steps - step) * (img.width - size * 2) // steps, bar.y)
+        compositor.flush()
+        print('.', end='', flush=True)
+        sleep(0.1 * speed)
+    print()
+
 def test_one_rotation(dev, state, speed):
     if not dev.properties or dev.properties[0].prop != GUD_PROPERTY_ROTATION:
         return